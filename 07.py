@@ -1,6 +1,12 @@
+import argparse
 import random
 import time
 
+try:
+    import numpy as np
+except ImportError:  # 只有矢量化引擎需要 NumPy
+    np = None
+
 
 class Animal:
     def __init__(self, x, y):
@@ -35,40 +41,83 @@ class Animal:
 
 
 class Wolf(Animal):
-    def __init__(self, x, y):
+    def __init__(self, x, y, number=1):
         super().__init__(x, y)
+        self.number = number  # 编号，多只狼到达同一格时编号小的先吃
         self.energy = 100  # 初始体力为100
 
 
 class Sheep(Animal):
-    def __init__(self, x, y):
+    def __init__(self, x, y, number=1):
         super().__init__(x, y)
+        self.number = number
 
 
-class Game:
+class SpatialGrid:
+    """按格子索引动物的空间哈希：{(x, y): {动物: None}}
+
+    动物移动后只需把它从旧格子移到新格子（O(1)），查找某一格的动物不需要遍历所有动物。
+    每个格子用字典作有序集合，删除是 O(1)，遍历顺序确定。
+    """
+
     def __init__(self):
-        self.boundary = (10, 10)  # 游戏场景范围：0≤x≤9,0≤y≤9
-        self.wolf = None
+        self.cells = {}
+
+    def add(self, animal):
+        self.cells.setdefault((animal.x, animal.y), {})[animal] = None
+
+    def move(self, animal, old_cell):
+        """animal 已从 old_cell 移动到当前位置"""
+        if old_cell == (animal.x, animal.y):
+            return
+        animals = self.cells[old_cell]
+        del animals[animal]
+        if not animals:
+            del self.cells[old_cell]
+        self.add(animal)
+
+    def pop(self, x, y):
+        """取出并返回格子 (x, y) 中的所有动物"""
+        return list(self.cells.pop((x, y), ()))
+
+
+class Game:
+    def __init__(self, boundary=(10, 10), sheep_count=10, delay=0.5, wolf_count=1):
+        self.boundary = boundary  # 游戏场景范围：默认 0≤x≤9,0≤y≤9
+        self.sheep_count = sheep_count
+        self.wolf_count = wolf_count
+        self.delay = delay  # 每轮之间的延迟（秒）
+        self.pack = []  # 所有的狼，按编号排列
+        self.wolves = []  # 存活的狼
         self.sheep_list = []
+        self.sheep_grid = SpatialGrid()  # 羊所在的格子，随羊的移动增量更新
         self.round = 0
 
+    def wolf_name(self, wolf):
+        return "狼" if self.wolf_count == 1 else f"狼{wolf.number}"
+
     def initialize(self):
-        """初始化游戏，生成1只狼和10只羊"""
+        """初始化游戏，生成 wolf_count 只狼和 sheep_count 只羊"""
         # 生成狼
-        wolf_x = random.randint(0, self.boundary[0] - 1)
-        wolf_y = random.randint(0, self.boundary[1] - 1)
-        self.wolf = Wolf(wolf_x, wolf_y)
+        for i in range(self.wolf_count):
+            wolf_x = random.randint(0, self.boundary[0] - 1)
+            wolf_y = random.randint(0, self.boundary[1] - 1)
+            self.pack.append(Wolf(wolf_x, wolf_y, i + 1))
+        self.wolves = list(self.pack)
 
-        # 生成10只羊
-        for _ in range(10):
+        # 生成羊
+        for i in range(self.sheep_count):
             sheep_x = random.randint(0, self.boundary[0] - 1)
             sheep_y = random.randint(0, self.boundary[1] - 1)
-            self.sheep_list.append(Sheep(sheep_x, sheep_y))
+            sheep = Sheep(sheep_x, sheep_y, i + 1)
+            self.sheep_list.append(sheep)
+            self.sheep_grid.add(sheep)
 
         print("游戏初始化完成！")
-        print(f"狼的初始位置: ({self.wolf.x}, {self.wolf.y}), 体力: {self.wolf.energy}")
-        for i, sheep in enumerate(self.sheep_list):
-            print(f"羊{i + 1}的初始位置: ({sheep.x}, {sheep.y})")
+        for wolf in self.wolves:
+            print(f"{self.wolf_name(wolf)}的初始位置: ({wolf.x}, {wolf.y}), 体力: {wolf.energy}")
+        for sheep in self.sheep_list:
+            print(f"羊{sheep.number}的初始位置: ({sheep.x}, {sheep.y})")
         print("-" * 50)
 
     def play_round(self):
@@ -76,32 +125,42 @@ class Game:
         self.round += 1
         print(f"\n第{self.round}轮游戏开始")
 
-        # 狼移动
-        steps = self.wolf.move(2, self.boundary)
-        self.wolf.energy -= steps  # 体力消耗与移动步数相等
-        print(f"狼移动到位置: ({self.wolf.x}, {self.wolf.y}), 消耗体力: {steps}, 剩余体力: {self.wolf.energy}")
+        # 狼按编号顺序移动
+        for wolf in self.wolves:
+            steps = wolf.move(2, self.boundary)
+            wolf.energy -= steps  # 体力消耗与移动步数相等
+            print(f"{self.wolf_name(wolf)}移动到位置: ({wolf.x}, {wolf.y}), 消耗体力: {steps}, 剩余体力: {wolf.energy}")
 
-        # 如果狼体力为0，游戏结束
-        if self.wolf.energy <= 0:
-            print("狼的体力耗尽，游戏结束！")
-            return False
+        # 体力耗尽的狼退出游戏，所有狼都耗尽时游戏结束
+        if any(wolf.energy <= 0 for wolf in self.wolves):
+            if self.wolf_count > 1:
+                for wolf in self.wolves:
+                    if wolf.energy <= 0:
+                        print(f"{self.wolf_name(wolf)}的体力耗尽")
+            self.wolves = [wolf for wolf in self.wolves if wolf.energy > 0]
+            if not self.wolves:
+                print("狼的体力耗尽，游戏结束！" if self.wolf_count == 1 else "所有的狼都体力耗尽，游戏结束！")
+                return False
 
-        # 羊移动
-        for i, sheep in enumerate(self.sheep_list):
+        # 羊移动，同时把移到新格子的羊在网格中挪过去
+        for sheep in self.sheep_list:
+            cell = (sheep.x, sheep.y)
             sheep.move(1, self.boundary)
-            print(f"羊{i + 1}移动到位置: ({sheep.x}, {sheep.y})")
+            self.sheep_grid.move(sheep, cell)
+            print(f"羊{sheep.number}移动到位置: ({sheep.x}, {sheep.y})")
 
-        # 检查狼是否能吃到羊
-        sheep_eaten = []
-        for i, sheep in enumerate(self.sheep_list):
-            if self.wolf.x == sheep.x and self.wolf.y == sheep.y:
-                sheep_eaten.append(i)
-                self.wolf.energy += 20
-                print(f"狼吃掉了羊{i + 1}，体力增加20，当前体力: {self.wolf.energy}")
+        # 每只狼只查看自己所在的格子；狼按编号顺序取走格子里的羊，
+        # 多只狼在同一格时编号最小的吃掉全部，后面的狼看到的是空格子
+        sheep_eaten = set()
+        for wolf in self.wolves:
+            for sheep in sorted(self.sheep_grid.pop(wolf.x, wolf.y), key=lambda sheep: sheep.number):
+                sheep_eaten.add(sheep)
+                wolf.energy += 20
+                print(f"{self.wolf_name(wolf)}吃掉了羊{sheep.number}，体力增加20，当前体力: {wolf.energy}")
 
-        # 从后往前删除被吃掉的羊，避免索引错误
-        for i in sorted(sheep_eaten, reverse=True):
-            del self.sheep_list[i]
+        # 一次性去掉被吃掉的羊
+        if sheep_eaten:
+            self.sheep_list = [sheep for sheep in self.sheep_list if sheep not in sheep_eaten]
 
         # 如果所有羊都被吃掉，游戏结束
         if not self.sheep_list:
@@ -121,16 +180,155 @@ class Game:
             continue_game = self.play_round()
             if not continue_game:
                 break
-            time.sleep(0.5)  # 添加一些延迟，使输出更易于阅读
+            time.sleep(self.delay)  # 添加一些延迟，使输出更易于阅读
 
         # 游戏结束，显示结果
         print("\n游戏结束！")
         print(f"总回合数: {self.round}")
-        print(f"狼剩余体力: {self.wolf.energy}")
+        if self.wolf_count == 1:
+            print(f"狼剩余体力: {self.pack[0].energy}")
+        else:
+            print(f"存活的狼: {len(self.wolves)}")
+            for wolf in self.wolves:
+                print(f"{self.wolf_name(wolf)}剩余体力: {wolf.energy}")
         print(f"剩余羊的数量: {len(self.sheep_list)}")
 
 
+def move_all(rng, positions, max_step, boundary):
+    """Animal.move 的矢量化版本：原地移动 positions（形状为 (n, 2) 的整数数组）中的每只动物，返回各自的步数
+
+    每只动物的轴、步数和方向由同一个随机整数编码：code 在 [0, 4 * max_step) 中均匀分布，
+    最低位是轴，次低位是方向，其余是步数减一，三者相互独立且各自均匀，一次 RNG 调用生成全部。
+    越界时与 Animal.move 一样改为反向移动。
+    """
+    count = len(positions)
+    code = rng.integers(0, 4 * max_step, size=count)
+    axis = code & 1
+    steps = (code >> 2) + 1
+    delta = steps * ((code & 2) - 1)  # 次低位为 0 时向负方向，为 1 时向正方向
+
+    rows = np.arange(count)
+    current = positions[rows, axis]
+    moved = current + delta
+    limit = np.asarray(boundary)[axis]
+    moved = np.where((moved < 0) | (moved >= limit), current - delta, moved)
+    positions[rows, axis] = moved
+    return steps
+
+
+class VectorGame:
+    """矢量化引擎：狼和羊的坐标各存放在一个 NumPy 数组中，适合上百万只羊
+
+    规则与 Game 相同：狼先移动并消耗体力，体力耗尽的狼退出，全部耗尽即结束；然后所有羊移动；
+    与狼位置相同的羊全部被吃掉，每只增加 20 点体力，同一格有多只狼时编号最小的吃。
+    每轮只打印汇总信息。
+    """
+
+    def __init__(self, boundary=(10, 10), sheep_count=10, delay=0.0, seed=None, wolf_count=1):
+        if np is None:
+            raise RuntimeError("矢量化引擎需要安装 NumPy")
+        self.boundary = boundary
+        self.sheep_count = sheep_count
+        self.wolf_count = wolf_count
+        self.delay = delay
+        self.rng = np.random.default_rng(seed)
+        self.wolves = None  # 存活的狼的坐标，形状为 (w, 2)，行按狼的编号排列（淘汰时保持顺序）
+        self.energy = np.full(wolf_count, 100)
+        self.sheep = None  # 形状为 (n, 2) 的坐标数组
+        self.round = 0
+
+    def initialize(self):
+        """初始化游戏，生成 wolf_count 只狼和 sheep_count 只羊"""
+        self.wolves = self.rng.integers(0, self.boundary, size=(self.wolf_count, 2))
+        self.sheep = self.rng.integers(0, self.boundary, size=(self.sheep_count, 2))
+        print("游戏初始化完成！")
+        if self.wolf_count == 1:
+            print(f"狼的初始位置: ({self.wolves[0, 0]}, {self.wolves[0, 1]}), 体力: {self.energy[0]}")
+        else:
+            print(f"狼的数量: {self.wolf_count}")
+        print(f"羊的数量: {len(self.sheep)}")
+        print("-" * 50)
+
+    def cells(self, positions):
+        """坐标 -> 格子编号"""
+        return positions[:, 0] * self.boundary[1] + positions[:, 1]
+
+    def play_round(self):
+        """进行一轮游戏"""
+        self.round += 1
+
+        # 狼移动，体力耗尽的狼退出
+        steps = move_all(self.rng, self.wolves, 2, self.boundary)
+        self.energy -= steps
+        alive = self.energy > 0
+        if not alive.all():
+            self.wolves = self.wolves[alive]
+            self.energy = self.energy[alive]
+            if not len(self.wolves):
+                print(f"第{self.round}轮: 狼的体力耗尽，游戏结束！")
+                return False
+
+        # 羊移动
+        move_all(self.rng, self.sheep, 1, self.boundary)
+
+        # 有狼的格子排序去重；np.unique 返回每个格子第一次出现的下标，即该格中编号最小的狼。
+        # 每只羊在其中二分查找自己的格子，代价为 O((羊 + 狼) log 狼)，与狼羊两两比较无关
+        wolf_cells, first = np.unique(self.cells(self.wolves), return_index=True)
+        sheep_cells = self.cells(self.sheep)
+        slots = np.minimum(np.searchsorted(wolf_cells, sheep_cells), len(wolf_cells) - 1)
+        eaten = wolf_cells[slots] == sheep_cells
+        count = int(np.count_nonzero(eaten))
+        if count:
+            self.energy += 20 * np.bincount(first[slots[eaten]], minlength=len(self.wolves))
+            self.sheep = self.sheep[~eaten]
+
+        print(f"第{self.round}轮: 存活的狼 {len(self.wolves)}，吃掉 {count} 只羊，"
+              f"狼的平均体力 {self.energy.mean():.1f}，剩余羊 {len(self.sheep)}")
+        if not len(self.sheep):
+            print("所有的羊都被吃掉了，狼获胜！游戏结束！")
+            return False
+        return True
+
+    def play(self):
+        """进行游戏主循环"""
+        self.initialize()
+        start = time.perf_counter()
+        while self.play_round():
+            if self.delay:
+                time.sleep(self.delay)
+        elapsed = time.perf_counter() - start
+
+        print("\n游戏结束！")
+        print(f"总回合数: {self.round}，用时 {elapsed:.3f} 秒")
+        print(f"存活的狼: {len(self.wolves)}，体力合计: {int(self.energy.sum())}")
+        print(f"剩余羊的数量: {len(self.sheep)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="狼吃羊游戏")
+    parser.add_argument('--engine', choices=['object', 'numpy'], default='object',
+                        help="object: 每只动物一个对象; numpy: 坐标存放在数组中的矢量化引擎，适合大量的羊")
+    parser.add_argument('--wolves', type=int, default=1, help="狼的数量")
+    parser.add_argument('--sheep', type=int, default=10, help="羊的数量")
+    parser.add_argument('--size', type=int, nargs=2, default=[10, 10], metavar=('WIDTH', 'HEIGHT'), help="场景大小")
+    parser.add_argument('--delay', type=float, help="每轮之间的延迟（秒），默认 object 引擎 0.5，numpy 引擎 0")
+    parser.add_argument('--seed', type=int, help="随机数种子，用于复现一局游戏")
+    args = parser.parse_args()
+    if args.engine == 'numpy' and np is None:
+        parser.error("numpy 引擎需要安装 NumPy")
+    # 狼一次最多走 2 步：长和宽至少为 2 + 2，才能保证从任何位置出发总有一个方向走得开
+    if args.wolves < 1 or args.sheep < 1 or min(args.size) < 4:
+        parser.error("至少需要 1 只狼和 1 只羊，场景的长和宽至少为 4")
+    return args
+
+
 # 运行游戏
 if __name__ == "__main__":
-    game = Game()
+    args = parse_args()
+    boundary = tuple(args.size)
+    if args.engine == 'numpy':
+        game = VectorGame(boundary, args.sheep, args.delay or 0.0, args.seed, args.wolves)
+    else:
+        random.seed(args.seed)
+        game = Game(boundary, args.sheep, 0.5 if args.delay is None else args.delay, args.wolves)
     game.play()
\ No newline at end of file
@@ -0,0 +1,289 @@
+import argparse
+import random
+import selectors
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+from chat.codec import BINARY, JSON
+from chat.metrics import Metrics
+from chat.outbound import OutboundQueue, advance, send_frames
+from chat.protocol import decode_message, encode_message
+from chat.registry import Registry
+
+
+def make_pairs(count):
+    """创建 count 对本地套接字，返回 (发送端列表, 接收端列表)"""
+    senders, receivers = [], []
+    for _ in range(count):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        b.setblocking(False)
+        senders.append(a)
+        receivers.append(b)
+    return senders, receivers
+
+
+def drain(selector):
+    """读空所有接收端（不计时）"""
+    while True:
+        events = selector.select(timeout=0)
+        if not events:
+            return
+        for key, _ in events:
+            try:
+                while key.fileobj.recv(1 << 20):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+def flush(sock, frames):
+    """非阻塞地写出 frames（测试中接收缓冲足够，不会写不完）"""
+    while frames:
+        frames = advance(frames, send_frames(sock, frames))
+
+
+def per_recipient(senders, message, burst):
+    """旧路径：每个接收者各自序列化一次，每条消息一次 send"""
+    for _ in range(burst):
+        for sock in senders:
+            sock.send(encode_message(message))
+
+
+def encode_once(senders, queues, message, burst):
+    """新路径：每条广播只分帧一次，同一个 bytes 放入所有队列，攒够 burst 条后用 sendmsg 一次写出"""
+    for _ in range(burst):
+        frame = encode_message(message)
+        for queue in queues:
+            queue.put(frame)
+    for sock, queue in zip(senders, queues):
+        flush(sock, queue.pop_batch())
+
+
+def bench_fanout(fanout, duration, burst, size):
+    """返回 (旧路径, 新路径) 每秒投递的消息数"""
+    senders, receivers = make_pairs(fanout)
+    selector = selectors.DefaultSelector()
+    for sock in receivers:
+        selector.register(sock, selectors.EVENT_READ)
+    queues = [OutboundQueue(max_frames=burst * 2) for _ in senders]
+    message = {
+        'type': 'chat_message',
+        'group_id': 'group_1',
+        'from_user': 'bench',
+        'content': 'x' * size,
+        'timestamp': time.time(),
+    }
+
+    results = []
+    for run in (lambda: per_recipient(senders, message, burst),
+                lambda: encode_once(senders, queues, message, burst)):
+        delivered = 0
+        elapsed = 0.0
+        while elapsed < duration:
+            start = time.perf_counter()
+            run()
+            elapsed += time.perf_counter() - start
+            delivered += burst * fanout
+            drain(selector)
+        results.append(delivered / elapsed)
+
+    selector.close()
+    for sock in senders + receivers:
+        sock.close()
+    return results
+
+
+def run_fanout(args):
+    print(f"广播扇出基准（消息 {args.size} 字节，每轮 {args.burst} 条）")
+    print(f"{'扇出':>6} {'逐个编码 msg/s':>16} {'编码一次 msg/s':>16} {'提升':>8}")
+    for fanout in args.fanout:
+        old, new = bench_fanout(fanout, args.duration, args.burst, args.size)
+        print(f"{fanout:>6} {old:>16,.0f} {new:>16,.0f} {new / old:>7.2f}x")
+
+
+def bench_codec(codec, message, duration):
+    """返回 (帧字节数, 每秒编码次数, 每秒解码次数)"""
+    frame = encode_message(message, codec)
+    payload = frame[4:]
+    rates = []
+    for run in (lambda: encode_message(message, codec), lambda: decode_message(payload)):
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            for _ in range(1000):
+                run()
+            count += 1000
+        rates.append(count / (time.perf_counter() - start))
+    return len(frame), rates[0], rates[1]
+
+
+def run_codec(args):
+    message = {
+        'type': 'chat_message',
+        'group_id': 'group_42',
+        'from_user': 'alice',
+        'content': 'x' * args.size,
+        'timestamp': time.time(),
+    }
+    print(f"消息编码基准（chat_message，内容 {args.size} 字节）")
+    print(f"{'编码':>8} {'帧字节':>8} {'编码/s':>12} {'解码/s':>12}")
+    for codec in (JSON, BINARY):
+        size, encode_rate, decode_rate = bench_codec(codec, message, args.duration)
+        print(f"{codec:>8} {size:>8} {encode_rate:>12,.0f} {decode_rate:>12,.0f}")
+
+
+class GlobalLockRegistry:
+    """对照组：所有状态放在一把全局锁后面，广播时在锁内复制成员集合"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.groups = {}
+
+    def register(self, username, conn):
+        with self.lock:
+            self.clients[username] = conn
+            return True
+
+    def get(self, username):
+        with self.lock:
+            return self.clients.get(username)
+
+    def members(self, group_id):
+        with self.lock:
+            return tuple(self.groups.get(group_id, ()))
+
+    def fanout(self, group_id):
+        """与 Registry.fanout 相同的结果，每次都在锁内遍历成员并查找连接"""
+        with self.lock:
+            conns = []
+            absent = []
+            for username in self.groups.get(group_id, ()):
+                conn = self.clients.get(username)
+                if conn is not None:
+                    conns.append(conn)
+                else:
+                    absent.append(username)
+            return tuple(conns), tuple(absent)
+
+    def add_members(self, group_id, usernames):
+        with self.lock:
+            self.groups.setdefault(group_id, set()).update(usernames)
+
+    def remove_member(self, group_id, username):
+        with self.lock:
+            members = self.groups.get(group_id)
+            if members is None or username not in members:
+                return False, members is not None
+            members.discard(username)
+            if not members:
+                del self.groups[group_id]
+            return True, bool(members)
+
+
+def registry_worker(registry, group_ids, usernames, churn, deadline, counts, index):
+    """混合负载：大多数操作是广播（与服务器相同，取 fanout() 快照并遍历连接），churn 比例的操作是加入/离开"""
+    rng = random.Random(index)
+    done = 0
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            group_id = rng.choice(group_ids)
+            if rng.random() < churn:
+                username = rng.choice(usernames)
+                if not registry.remove_member(group_id, username)[0]:
+                    registry.add_members(group_id, (username,))
+            else:
+                conns, _ = registry.fanout(group_id)
+                for conn in conns:
+                    conn.queue  # 与广播一样逐个访问接收者的发送队列
+        done += 100
+    counts[index] = done
+
+
+def bench_registry(registry, threads, groups, group_size, churn, duration):
+    """返回 threads 个线程并发访问 registry 时每秒完成的操作数"""
+    usernames = [f'user_{i}' for i in range(groups * group_size)]
+    for username in usernames:
+        registry.register(username, SimpleNamespace(username=username, queue=OutboundQueue()))
+    group_ids = [f'group_{i}' for i in range(groups)]
+    for i, group_id in enumerate(group_ids):
+        registry.add_members(group_id, usernames[i * group_size:(i + 1) * group_size])
+
+    counts = [0] * threads
+    deadline = time.perf_counter() + duration
+    workers = [
+        threading.Thread(target=registry_worker, args=(registry, group_ids, usernames, churn, deadline, counts, i))
+        for i in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def run_registry(args):
+    print(f"注册表并发基准（{args.groups} 个组，每组 {args.group_size} 人，加入/离开占 {args.churn:.0%}）")
+    print(f"{'线程':>6} {'全局锁 ops/s':>14} {'分段锁 ops/s':>14} {'提升':>8}")
+    for threads in args.threads:
+        old = bench_registry(GlobalLockRegistry(), threads, args.groups, args.group_size, args.churn, args.duration)
+        new = bench_registry(Registry(), threads, args.groups, args.group_size, args.churn, args.duration)
+        print(f"{threads:>6} {old:>14,.0f} {new:>14,.0f} {new / old:>7.2f}x")
+
+
+def run_metrics(args):
+    """热点路径上每条消息的指标记录开销"""
+    metrics = Metrics()
+    cases = [
+        ('incr', lambda: metrics.incr('bytes_in', 100)),
+        ('add(2)', lambda: metrics.add((('messages_in', 'chat_message'), 1), ('bytes_in', 100))),
+        ('observe', lambda: metrics.observe(('handler_latency', 'chat_message'), 12345)),
+        ('perf_counter_ns', time.perf_counter_ns),
+    ]
+    print(f"指标记录开销（单线程，{args.count:,} 次）")
+    print(f"{'操作':>16} {'ns/次':>10}")
+    for name, run in cases:
+        start = time.perf_counter_ns()
+        for _ in range(args.count):
+            run()
+        print(f"{name:>16} {(time.perf_counter_ns() - start) / args.count:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天服务器热点路径基准测试")
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    fanout = subparsers.add_parser('fanout', help="广播扇出：逐个编码发送 vs 编码一次+分散写")
+    fanout.add_argument('--fanout', type=int, nargs='+', default=[10, 100, 1000], help="每条广播的接收者数")
+    fanout.add_argument('--duration', type=float, default=1.0, help="每种路径的计时秒数")
+    fanout.add_argument('--burst', type=int, default=8, help="每轮连续广播的消息数")
+    fanout.add_argument('--size', type=int, default=100, help="消息内容长度")
+    fanout.set_defaults(func=run_fanout)
+
+    codec = subparsers.add_parser('codec', help="消息编码：JSON vs 二进制")
+    codec.add_argument('--duration', type=float, default=1.0, help="每项的计时秒数")
+    codec.add_argument('--size', type=int, default=20, help="消息内容长度")
+    codec.set_defaults(func=run_codec)
+
+    registry = subparsers.add_parser('registry', help="注册表并发访问：全局锁 vs 分段锁+成员快照")
+    registry.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16], help="并发线程数")
+    registry.add_argument('--groups', type=int, default=1000, help="聊天组数")
+    registry.add_argument('--group-size', type=int, default=10, help="每组成员数")
+    registry.add_argument('--churn', type=float, default=0.05, help="加入/离开操作所占比例")
+    registry.add_argument('--duration', type=float, default=1.0, help="每项的计时秒数")
+    registry.set_defaults(func=run_registry)
+
+    metrics = subparsers.add_parser('metrics', help="指标记录的单次开销")
+    metrics.add_argument('--count', type=int, default=1_000_000, help="每项的调用次数")
+    metrics.set_defaults(func=run_metrics)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
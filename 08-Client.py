@@ -1,9 +1,25 @@
-import socket
+import argparse
+import queue
+import sys
 import threading
-import json
 import time
 import tkinter as tk
-from tkinter import ttk, scrolledtext, simpledialog, messagebox
+from tkinter import ttk, scrolledtext, simpledialog, messagebox, filedialog
+
+from chat.cache import MessageCache
+from chat.client import Client, RegistrationError
+
+# 首次进入聊天组和每次向前翻页时向服务器请求的聊天记录条数
+HISTORY_LIMIT = 50
+
+# 主线程处理收到的消息的间隔（毫秒），每次最多处理的消息数
+UI_POLL_INTERVAL = 50
+MAX_EVENTS_PER_POLL = 2000
+
+# 聊天窗口最多保留的行数，超出的旧行被删除
+MAX_SCROLLBACK_LINES = 5000
+
+UNREAD_MARK = " (有新消息)"
 
 
 class ChatClient:
@@ -14,12 +30,25 @@ class ChatClient:
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
         self.username = None
-        self.client_socket = None
+        self.client = None  # chat.client.Client，协议和聊天组成员由它维护，断线后用同一用户名重连时续传
         self.connected = False
-        self.chat_groups = {}  # {group_id: {"name": display_name, "users": [user1, user2]}}
+        self.closing = False
+        self.chat_groups = {}  # {group_id: {"name": display_name, "users": client.groups[group_id]}}
         self.current_group = None
 
+        # 接收线程只把消息放入队列，由主线程定时取出处理（Tk 控件只能在主线程中操作）
+        self.events = queue.SimpleQueue()
+        self.pending_text = []  # 待插入聊天窗口的 (文本, 标签) 片段，每次处理完一批消息后一次插入
+        self.unread = set()  # 有未读消息的聊天组
+        self.dirty_groups = set()  # 需要重新绘制的聊天组行
+
+        # 各聊天组最近的消息，切换聊天组时直接从缓存绘制
+        self.cache = MessageCache()
+        self.history_marks = {}  # {group_id: 请求最近聊天记录时的缓存标记}
+        self.loading_older = set()  # 正在向前翻页的聊天组
+
         self.setup_ui()
+        self.root.after(UI_POLL_INTERVAL, self.poll_events)
 
     def setup_ui(self):
         """初始化UI界面"""
@@ -63,6 +92,7 @@ class ChatClient:
         self.groups_tree.column("users", width=180)
         self.groups_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.groups_tree.bind("<<TreeviewSelect>>", self.on_group_selected)
+        # 每一行的 iid 就是 group_id，按 group_id 直接定位行，不需要遍历列表
 
         # 新建聊天按钮
         self.new_chat_button = ttk.Button(groups_frame, text="新建聊天", command=self.create_new_chat)
@@ -76,6 +106,7 @@ class ChatClient:
         # 聊天显示区域
         self.chat_display = scrolledtext.ScrolledText(right_frame, wrap=tk.WORD, state=tk.DISABLED)
         self.chat_display.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.chat_display.config(yscrollcommand=self.on_chat_scroll)
 
         # 消息输入区域
         input_frame = ttk.Frame(right_frame)
@@ -90,6 +121,15 @@ class ChatClient:
         self.send_button.pack(side=tk.RIGHT, padx=5)
         self.send_button.config(state=tk.DISABLED)
 
+        # 文件传输按钮
+        self.download_button = ttk.Button(input_frame, text="下载文件", command=self.download_file)
+        self.download_button.pack(side=tk.RIGHT, padx=5)
+        self.download_button.config(state=tk.DISABLED)
+
+        self.file_button = ttk.Button(input_frame, text="发送文件", command=self.send_file)
+        self.file_button.pack(side=tk.RIGHT, padx=5)
+        self.file_button.config(state=tk.DISABLED)
+
         # 状态栏
         self.status_var = tk.StringVar()
         self.status_var.set("未连接")
@@ -106,153 +146,86 @@ class ChatClient:
             messagebox.showerror("错误", "请填写服务器、端口和用户名")
             return
 
-        try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((server, port))
-
-            # 发送注册信息
-            register_info = {
-                'type': 'register',
-                'username': self.username
-            }
-            self.client_socket.send(json.dumps(register_info).encode('utf-8'))
-
-            # 接收服务器响应
-            response_data = self.client_socket.recv(1024).decode('utf-8')
-            response = json.loads(response_data)
-
-            if response.get('status') == 'success':
-                self.connected = True
-                self.status_var.set(f"已连接: {self.username}")
-
-                # 禁用连接相关控件
-                self.server_entry.config(state=tk.DISABLED)
-                self.port_entry.config(state=tk.DISABLED)
-                self.username_entry.config(state=tk.DISABLED)
-                self.connect_button.config(state=tk.DISABLED)
-
-                # 启用聊天相关控件
-                self.new_chat_button.config(state=tk.NORMAL)
-
-                # 启动接收消息的线程
-                receive_thread = threading.Thread(target=self.receive_messages)
-                receive_thread.daemon = True
-                receive_thread.start()
-
-                # 启动心跳线程
-                heartbeat_thread = threading.Thread(target=self.send_heartbeat)
-                heartbeat_thread.daemon = True
-                heartbeat_thread.start()
-
-                messagebox.showinfo("连接成功", f"欢迎, {self.username}!")
-            else:
-                messagebox.showerror("连接失败", response.get('message', '未知错误'))
-                self.client_socket.close()
-                self.client_socket = None
+        if self.client is None or self.client.username != self.username:
+            self.client = Client(self.username)
+            self.cache = MessageCache()
+            self.client.on_connect(self.on_connected)
+            self.client.on_message(self.events.put)
+            self.client.on_disconnect(lambda: self.events.put(None))
 
+        try:
+            self.client.connect(server, port)
+        except RegistrationError as e:
+            messagebox.showerror("连接失败", str(e))
+            return
         except Exception as e:
             messagebox.showerror("连接错误", f"无法连接到服务器: {e}")
-            if self.client_socket:
-                self.client_socket.close()
-                self.client_socket = None
-
-    def receive_messages(self):
-        """接收服务器消息的线程"""
-        while self.connected:
-            try:
-                data = self.client_socket.recv(4096).decode('utf-8')
-                if not data:
-                    # 连接已关闭
+            return
+        messagebox.showinfo("连接成功", f"欢迎, {self.username}!")
+
+    def on_connected(self, response):
+        """注册成功（在接收线程启动之前调用）"""
+        self.connected = True
+        self.status_var.set(f"已连接: {self.username}")
+
+        # 没能续传时缓存中可能缺了消息，重新从聊天记录加载
+        if not response.get('resumed') or response.get('gap'):
+            self.cache = MessageCache()
+        self.history_marks.clear()
+        self.loading_older.clear()
+
+        # 断线前加入的聊天组，离线期间的消息随后到达
+        self.chat_groups = {}
+        self.unread.clear()
+        self.dirty_groups.clear()
+        self.groups_tree.delete(*self.groups_tree.get_children())
+        for group_id, users in self.client.groups.items():
+            self.chat_groups[group_id] = {"name": f"聊天组 {group_id}", "users": users}
+            self.update_group(group_id)
+
+        # 禁用连接相关控件
+        self.server_entry.config(state=tk.DISABLED)
+        self.port_entry.config(state=tk.DISABLED)
+        self.username_entry.config(state=tk.DISABLED)
+        self.connect_button.config(state=tk.DISABLED)
+
+        # 启用聊天相关控件
+        self.new_chat_button.config(state=tk.NORMAL)
+
+    def poll_events(self):
+        """在主线程中处理接收线程送来的一批消息，然后一次性刷新界面
+
+        单条消息处理出错只跳过这一条；无论如何都会安排下一次轮询，否则界面看起来正常却不再显示消息。
+        """
+        try:
+            for _ in range(MAX_EVENTS_PER_POLL):
+                try:
+                    message = self.events.get_nowait()
+                except queue.Empty:
                     break
-
-                message = json.loads(data)
-                msg_type = message.get('type')
-
-                if msg_type == 'chat_message':
-                    # 聊天消息
-                    group_id = message.get('group_id')
-                    from_user = message.get('from_user')
-                    content = message.get('content')
-
-                    # 在聊天窗口显示消息
-                    if group_id in self.chat_groups:
-                        self.display_message(group_id, from_user, content)
-
-                elif msg_type == 'chat_invitation':
-                    # 收到聊天邀请
-                    group_id = message.get('group_id')
-                    from_user = message.get('from_user')
-
-                    # 添加到聊天组列表
-                    self.chat_groups[group_id] = {
-                        "name": f"与 {from_user} 的聊天",
-                        "users": [self.username, from_user]
-                    }
-
-                    # 更新UI
-                    self.update_chat_groups()
-
-                    # 提示用户
-                    self.root.bell()
-                    self.display_system_message(f"{from_user} 邀请您进行聊天")
-
-                elif msg_type == 'create_chat_response':
-                    # 创建聊天响应
-                    if message.get('status') == 'success':
-                        group_id = message.get('group_id')
-                        target_user = message.get('target_user')
-
-                        # 添加到聊天组列表
-                        self.chat_groups[group_id] = {
-                            "name": f"与 {target_user} 的聊天",
-                            "users": [self.username, target_user]
-                        }
-
-                        # 更新UI
-                        self.update_chat_groups()
-
-                        # 自动选择新创建的聊天
-                        for item_id in self.groups_tree.get_children():
-                            if self.groups_tree.item(item_id, "values")[0] == group_id:
-                                self.groups_tree.selection_set(item_id)
-                                self.on_group_selected(None)
-                                break
+                try:
+                    if message is None:
+                        self.on_disconnected()
                     else:
-                        messagebox.showerror("创建聊天失败", message.get('message', '未知错误'))
-
-                elif msg_type == 'user_left' or msg_type == 'user_offline':
-                    # 用户离开聊天或离线
-                    group_id = message.get('group_id')
-                    username = message.get('username')
-                    system_message = message.get('message')
-
-                    if group_id in self.chat_groups:
-                        if username in self.chat_groups[group_id]["users"]:
-                            self.chat_groups[group_id]["users"].remove(username)
-
-                        # 显示系统消息
-                        self.display_system_message(system_message, group_id)
-
-                        # 更新UI
-                        self.update_chat_groups()
-
-                elif msg_type == 'heartbeat_ack':
-                    # 心跳包确认，不做处理
-                    pass
-
-                elif msg_type == 'error':
-                    # 错误消息
-                    error_msg = message.get('message', '未知错误')
-                    self.display_system_message(f"错误: {error_msg}")
-
-            except json.JSONDecodeError:
-                print("接收到无效的JSON数据")
-                continue
-            except Exception as e:
-                print(f"接收消息时出错: {e}")
-                break
+                        self.handle_message(message)
+                except Exception as e:
+                    print(f"处理消息 {message!r:.200} 时出错: {e!r}")
+            for group_id in self.dirty_groups:
+                try:
+                    self.update_group(group_id)
+                except Exception as e:
+                    print(f"刷新聊天组 {group_id} 时出错: {e!r}")
+            self.dirty_groups.clear()
+            self.flush_display()
+        except Exception as e:
+            print(f"刷新界面时出错: {e!r}")
+        finally:
+            self.root.after(UI_POLL_INTERVAL, self.poll_events)
 
-        # 连接已断开
+    def on_disconnected(self):
+        """与服务器的连接断开"""
+        if self.closing:
+            return
         self.display_system_message("与服务器的连接已断开")
         self.connected = False
         self.status_var.set("未连接")
@@ -267,31 +240,152 @@ class ChatClient:
         self.new_chat_button.config(state=tk.DISABLED)
         self.message_entry.config(state=tk.DISABLED)
         self.send_button.config(state=tk.DISABLED)
+        self.file_button.config(state=tk.DISABLED)
+        self.download_button.config(state=tk.DISABLED)
+
+    def handle_message(self, message):
+        """处理服务器发来的一条消息（聊天组成员已由 self.client 更新）"""
+        msg_type = message.get('type')
+
+        if msg_type == 'chat_message':
+            # 聊天消息
+            group_id = message.get('group_id')
+            from_user = message.get('from_user')
+            content = message.get('content')
+
+            # 在聊天窗口显示消息
+            if group_id in self.chat_groups:
+                self.cache.add(group_id, message)
+                self.display_message(group_id, from_user, content, message.get('timestamp'))
+
+        elif msg_type == 'history_response':
+            group_id = message.get('group_id')
+            success = message.get('status') == 'success'
+            if 'before_seq' in message:
+                # 向前翻页得到的更早消息，插到聊天窗口顶部
+                self.loading_older.discard(group_id)
+                if success:
+                    older = self.cache.prepend(group_id, message.get('messages', []))
+                    if older and group_id == self.current_group:
+                        self.insert_older(older)
+            elif group_id in self.history_marks:
+                # 最近的聊天记录：与缓存对齐后重新绘制（已实时收到的消息也包含在记录中）
+                history = message.get('messages', []) if success else None
+                self.cache.load(group_id, history, self.history_marks.pop(group_id))
+                if history is not None and group_id == self.current_group:
+                    self.render_group(group_id)
+
+        elif msg_type == 'chat_invitation':
+            # 收到聊天邀请
+            group_id = message.get('group_id')
+            from_user = message.get('from_user')
+
+            # 添加到聊天组列表
+            self.chat_groups[group_id] = {
+                "name": f"与 {from_user} 的聊天",
+                "users": self.client.groups[group_id]
+            }
 
-    def send_heartbeat(self):
-        """定期发送心跳包以保持连接"""
-        while self.connected:
-            try:
-                if self.client_socket:
-                    heartbeat = {'type': 'heartbeat'}
-                    self.client_socket.send(json.dumps(heartbeat).encode('utf-8'))
-                time.sleep(30)  # 每30秒发送一次心跳
-            except:
-                break
+            # 更新UI
+            self.dirty_groups.add(group_id)
 
-    def update_chat_groups(self):
-        """更新聊天组列表"""
-        # 清空现有列表
-        for item in self.groups_tree.get_children():
-            self.groups_tree.delete(item)
+            # 提示用户
+            self.root.bell()
+            self.display_system_message(f"{from_user} 邀请您进行聊天")
 
-        # 添加聊天组
-        for group_id, group_info in self.chat_groups.items():
-            users_str = ", ".join(user for user in group_info["users"] if user != self.username)
-            if not users_str:
-                users_str = "只有您"
+        elif msg_type == 'create_chat_response':
+            # 创建聊天响应
+            if message.get('status') == 'success':
+                group_id = message.get('group_id')
+                target_user = message.get('target_user')
 
-            self.groups_tree.insert("", tk.END, text=group_info["name"], values=(users_str, group_id))
+                # 添加到聊天组列表
+                self.chat_groups[group_id] = {
+                    "name": f"与 {target_user} 的聊天",
+                    "users": self.client.groups[group_id]
+                }
+
+                # 更新UI
+                self.update_group(group_id)
+
+                # 自动选择新创建的聊天
+                self.groups_tree.selection_set(group_id)
+                self.on_group_selected(None)
+            else:
+                messagebox.showerror("创建聊天失败", message.get('message', '未知错误'))
+
+        elif msg_type == 'join_chat_response':
+            # 加入已有聊天组的响应
+            if message.get('status') == 'success':
+                group_id = message.get('group_id')
+                self.chat_groups[group_id] = {
+                    "name": f"聊天组 {group_id}",
+                    "users": self.client.groups[group_id]
+                }
+                self.dirty_groups.add(group_id)
+            else:
+                messagebox.showerror("加入聊天失败", message.get('message', '未知错误'))
+
+        elif msg_type == 'user_joined':
+            # 有新成员加入聊天组
+            group_id = message.get('group_id')
+            if group_id in self.chat_groups:
+                self.display_system_message(message.get('message'), group_id)
+                self.dirty_groups.add(group_id)
+
+        elif msg_type == 'user_left' or msg_type == 'user_offline':
+            # 用户离开聊天或离线（离线的用户仍是组成员）
+            group_id = message.get('group_id')
+            system_message = message.get('message')
+
+            if group_id in self.chat_groups:
+                # 显示系统消息
+                self.display_system_message(system_message, group_id)
+
+                # 更新UI
+                self.dirty_groups.add(group_id)
+
+        elif msg_type == 'file_shared':
+            # 组内成员上传了文件
+            group_id = message.get('group_id')
+            if group_id in self.chat_groups:
+                text = (f"{message.get('from_user')} 分享了文件 {message.get('name')}"
+                        f"（{message.get('size')} 字节），文件ID: {message.get('file_id')}")
+                if self.current_group != group_id:
+                    self.unread.add(group_id)
+                    self.dirty_groups.add(group_id)
+                self.display_system_message(text, group_id)
+
+        elif msg_type == 'file_notice':
+            # 本地产生的提示：后台文件传输的结果
+            self.display_system_message(message.get('message'), message.get('group_id'))
+
+        elif msg_type == 'heartbeat_ack':
+            # 心跳包确认，不做处理
+            pass
+
+        elif msg_type == 'error':
+            # 错误消息
+            error_msg = message.get('message', '未知错误')
+            self.display_system_message(f"错误: {error_msg}")
+
+    def update_group(self, group_id):
+        """添加、更新或删除聊天组列表中的一行"""
+        group_info = self.chat_groups.get(group_id)
+        if group_info is None:
+            if self.groups_tree.exists(group_id):
+                self.groups_tree.delete(group_id)
+            return
+
+        users_str = ", ".join(user for user in group_info["users"] if user != self.username)
+        if not users_str:
+            users_str = "只有您"
+        name = group_info["name"] + (UNREAD_MARK if group_id in self.unread else "")
+
+        if self.groups_tree.exists(group_id):
+            self.groups_tree.item(group_id, text=name, values=(users_str,))
+        else:
+            self.groups_tree.insert("", tk.END, iid=group_id, text=name, values=(users_str,))
 
     def create_new_chat(self):
         """创建新的聊天"""
@@ -306,13 +400,9 @@ class ChatClient:
             messagebox.showerror("错误", "不能与自己聊天")
             return
 
-        # 发送创建聊天请求
-        request = {
-            'type': 'create_chat',
-            'target_user': target_user
-        }
+        # 发送创建聊天请求，响应由 handle_message 处理
         try:
-            self.client_socket.send(json.dumps(request).encode('utf-8'))
+            self.client.create_chat(target_user)
         except Exception as e:
             messagebox.showerror("发送错误", f"无法发送请求: {e}")
 
@@ -322,24 +412,63 @@ class ChatClient:
         if not selected_items:
             return
 
-        item_id = selected_items[0]
-        group_id = self.groups_tree.item(item_id, "values")[1]
+        group_id = selected_items[0]
         if group_id in self.chat_groups:
             # 切换当前聊天组
             self.current_group = group_id
-
-            # 清空聊天显示区域
-            self.chat_display.config(state=tk.NORMAL)
-            self.chat_display.delete(1.0, tk.END)
-            self.chat_display.config(state=tk.DISABLED)
+            if group_id in self.unread:
+                self.unread.discard(group_id)
+                self.update_group(group_id)
 
             # 启用消息输入控件
             self.message_entry.config(state=tk.NORMAL)
             self.send_button.config(state=tk.NORMAL)
+            self.file_button.config(state=tk.NORMAL)
+            self.download_button.config(state=tk.NORMAL)
+
+            # 从缓存重新绘制聊天窗口
+            self.render_group(group_id)
+
+            # 第一次进入时向服务器请求该组最近的聊天记录
+            if not self.cache.is_loaded(group_id) and group_id not in self.history_marks:
+                try:
+                    self.client.history(group_id, HISTORY_LIMIT)
+                    self.history_marks[group_id] = self.cache.mark(group_id)
+                except Exception as e:
+                    self.display_system_message(f"获取聊天记录失败: {e}")
+                    self.flush_display()
+
+    def render_group(self, group_id):
+        """清空聊天窗口，把缓存中该组的消息一次插入"""
+        self.clear_display()
+        for record in self.cache.messages(group_id):
+            self.display_message(group_id, record.get('from_user'), record.get('content'), record.get('timestamp'))
+        self.display_system_message(f"已进入 {self.chat_groups[group_id]['name']}")
+        self.flush_display()
+
+    def on_chat_scroll(self, first, last):
+        """聊天窗口滚动：翻到顶部时请求更早的聊天记录"""
+        self.chat_display.vbar.set(first, last)
+        group_id = self.current_group
+        if (float(first) <= 0.0 and float(last) < 1.0 and group_id is not None
+                and group_id not in self.loading_older and self.cache.has_older(group_id)):
+            try:
+                self.client.history(group_id, HISTORY_LIMIT, before_seq=self.cache.oldest_seq(group_id))
+                self.loading_older.add(group_id)
+            except Exception:
+                pass
 
-            # 显示系统提示
-            chat_name = self.chat_groups[group_id]["name"]
-            self.display_system_message(f"已进入 {chat_name}")
+    def insert_older(self, messages):
+        """把更早的消息一次插到聊天窗口顶部，保持当前看到的内容不动"""
+        segments = []
+        for record in messages:
+            segments += self.format_message(record.get('from_user'), record.get('content'), record.get('timestamp'))
+        self.chat_display.config(state=tk.NORMAL)
+        lines = int(self.chat_display.index("end-1c").split(".")[0])
+        self.chat_display.insert("1.0", *segments)
+        inserted = int(self.chat_display.index("end-1c").split(".")[0]) - lines
+        self.chat_display.yview(f"{inserted + 1}.0")
+        self.chat_display.config(state=tk.DISABLED)
 
     def send_message(self, event=None):
         """发送消息"""
@@ -350,68 +479,111 @@ class ChatClient:
         if not message:
             return
 
-        # 构建消息
-        chat_message = {
-            'type': 'chat_message',
-            'group_id': self.current_group,
-            'content': message
-        }
-
         try:
             # 发送消息
-            self.client_socket.send(json.dumps(chat_message).encode('utf-8'))
+            self.client.send(self.current_group, message)
 
-            # 在本地显示消息
+            # 在本地显示消息（服务器不会把消息发回给发送者）
+            self.cache.add(self.current_group, {'from_user': self.username, 'content': message, 'timestamp': time.time()})
             self.display_message(self.current_group, self.username, message)
 
             # 清空输入框
             self.message_entry.delete(0, tk.END)
         except Exception as e:
             self.display_system_message(f"发送消息失败: {e}")
+        self.flush_display()
+
+    def send_file(self):
+        """选择一个文件上传到当前聊天组，在后台线程中发送"""
+        if not self.connected or not self.current_group:
+            return
+        path = filedialog.askopenfilename(title="选择要发送的文件")
+        if not path:
+            return
+
+        group_id = self.current_group
+        client = self.client
+
+        def upload():
+            try:
+                ack = client.upload(group_id, path)
+                text = f"文件已发送，文件ID: {ack.get('file_id')}"
+            except Exception as e:
+                text = f"发送文件失败: {e}"
+            self.events.put({'type': 'file_notice', 'group_id': group_id, 'message': text})
+
+        threading.Thread(target=upload, daemon=True).start()
+        self.display_system_message(f"正在发送文件 {path}")
+        self.flush_display()
+
+    def download_file(self):
+        """按文件ID下载文件"""
+        if not self.connected:
+            return
+        file_id = simpledialog.askstring("下载文件", "请输入文件ID:")
+        if not file_id:
+            return
+        path = filedialog.asksaveasfilename(title="保存文件")
+        if not path:
+            return
+
+        def finished(future):
+            error = future.exception()
+            text = f"文件已保存到 {path}" if error is None else f"下载文件失败: {error}"
+            self.events.put({'type': 'file_notice', 'message': text})
+
+        self.client.download(file_id.strip(), path).add_done_callback(finished)
 
-    def display_message(self, group_id, username, content):
-        """在聊天窗口显示消息"""
+    def display_message(self, group_id, username, content, timestamp=None):
+        """在聊天窗口显示消息（timestamp 为消息的发送时间，默认为当前时间）"""
         if self.current_group != group_id:
             # 如果不是当前聊天组，只在树状视图中标记有未读消息
-            for item_id in self.groups_tree.get_children():
-                item_group_id = self.groups_tree.item(item_id, "values")[1]
-                if item_group_id == group_id:
-                    current_text = self.groups_tree.item(item_id, "text")
-                    if not current_text.endswith(" (有新消息)"):
-                        self.groups_tree.item(item_id, text=current_text + " (有新消息)")
-                    break
+            if group_id not in self.unread:
+                self.unread.add(group_id)
+                self.dirty_groups.add(group_id)
             return
+        self.pending_text += self.format_message(username, content, timestamp)
 
-        self.chat_display.config(state=tk.NORMAL)
-
+    def format_message(self, username, content, timestamp=None):
+        """一条消息在聊天窗口中的 (文本, 标签) 片段"""
         # 添加时间戳
-        timestamp = time.strftime("%H:%M:%S", time.localtime())
+        timestamp = time.strftime("%H:%M:%S", time.localtime(timestamp))
 
         # 格式化显示
         if username == self.username:
-            self.chat_display.insert(tk.END, f"{timestamp} 我: ", "self")
-        else:
-            self.chat_display.insert(tk.END, f"{timestamp} {username}: ", "other")
-
-        self.chat_display.insert(tk.END, f"{content}\n")
-        self.chat_display.see(tk.END)
-
-        self.chat_display.config(state=tk.DISABLED)
+            return [f"{timestamp} 我: ", "self", f"{content}\n", ()]
+        return [f"{timestamp} {username}: ", "other", f"{content}\n", ()]
 
     def display_system_message(self, message, group_id=None):
         """显示系统消息"""
         if group_id and self.current_group != group_id:
             return
 
-        self.chat_display.config(state=tk.NORMAL)
-
         # 添加时间戳
         timestamp = time.strftime("%H:%M:%S", time.localtime())
 
         # 格式化显示
-        self.chat_display.insert(tk.END, f"{timestamp} 系统: {message}\n", "system")
+        self.pending_text += [f"{timestamp} 系统: {message}\n", "system"]
+
+    def flush_display(self):
+        """把积攒的消息一次插入聊天窗口，并删除超出 MAX_SCROLLBACK_LINES 的旧行"""
+        if not self.pending_text:
+            return
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, *self.pending_text)
+        self.pending_text = []
+        # 文本末尾总有一个空行，行数为 end 的行号减一
+        excess = int(self.chat_display.index("end-1c").split(".")[0]) - 1 - MAX_SCROLLBACK_LINES
+        if excess > 0:
+            self.chat_display.delete("1.0", f"{excess + 1}.0")
         self.chat_display.see(tk.END)
+        self.chat_display.config(state=tk.DISABLED)
 
+    def clear_display(self):
+        """清空聊天窗口（包括还没插入的消息）"""
+        self.pending_text = []
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.delete(1.0, tk.END)
         self.chat_display.config(state=tk.DISABLED)
 
     def on_closing(self):
@@ -420,15 +592,12 @@ class ChatClient:
             # 断开与服务器的连接
             try:
                 # 给每个聊天组发送离开消息
-                for group_id in self.chat_groups:
-                    leave_message = {
-                        'type': 'leave_chat',
-                        'group_id': group_id
-                    }
-                    self.client_socket.send(json.dumps(leave_message).encode('utf-8'))
-
-                # 关闭套接字
-                self.client_socket.close()
+                self.closing = True
+                for group_id in list(self.chat_groups):
+                    self.client.leave_chat(group_id)
+
+                # 关闭连接
+                self.client.close()
             except:
                 pass
 
@@ -437,7 +606,52 @@ class ChatClient:
         self.root.destroy()
 
 
+def run_headless(host, port, username):
+    """无界面模式：注册后把收到的消息打印到标准输出。返回退出状态，连接断开时为 1"""
+    client = Client(username)
+    disconnected = threading.Event()
+    client.on_disconnect(disconnected.set)
+
+    @client.on_message
+    def print_message(message):
+        msg_type = message.get('type')
+        if msg_type == 'chat_message':
+            print(f"[{message.get('group_id')}] {message.get('from_user')}: {message.get('content')}", flush=True)
+        elif msg_type != 'heartbeat_ack':
+            print(f"{msg_type}: {message.get('message', '')}", flush=True)
+
+    try:
+        client.connect(host, port)
+    except (OSError, RegistrationError) as e:
+        print(f"无法连接到服务器: {e}", file=sys.stderr)
+        return 1
+    print(f"已连接: {username}", flush=True)
+    try:
+        while not disconnected.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        client.close()
+        return 0
+    print("与服务器的连接已断开", file=sys.stderr)
+    return 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="聊天客户端")
+    parser.add_argument('--headless', action='store_true', help="不启动图形界面，把收到的消息打印到标准输出")
+    parser.add_argument('--host', default='localhost', help="服务器地址（无界面模式）")
+    parser.add_argument('--port', type=int, default=9999, help="服务器端口（无界面模式）")
+    parser.add_argument('--username', help="用户名（无界面模式，必填）")
+    args = parser.parse_args()
+    if args.headless and not args.username:
+        parser.error("无界面模式需要 --username")
+    return args
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.headless:
+        sys.exit(run_headless(args.host, args.port, args.username))
     root = tk.Tk()
     app = ChatClient(root)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from collections import Counter
+
+from chat.client import HEARTBEAT_INTERVAL
+from chat.codec import JSON, CODECS
+from chat.protocol import RECV_SIZE, FrameDecoder, FrameError, decode_message, encode_message
+
+
+class RunStats:
+    """一个进程内的统计数据"""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies = []  # 端到端延迟（纳秒）
+        self.errors = Counter()
+
+    def to_dict(self):
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'latencies': self.latencies,
+            'errors': dict(self.errors),
+        }
+
+
+class LoadClient:
+    """一个模拟的聊天客户端"""
+
+    def __init__(self, name, stats, codec):
+        self.name = name
+        self.stats = stats
+        self.codec = JSON
+        self.offer_codec = codec
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.group_id = None
+        self.group_ready = asyncio.Event()
+        self.measure_from = None  # 只统计这个时间（time_ns）之后发出的消息
+        self.read_task = None
+        self.heartbeat_task = None
+        self.last_send = 0.0  # 最近一次发送的时间（事件循环时间）
+
+    async def connect(self, host, port):
+        """连接并注册，成功返回 True"""
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.errors['connect'] += 1
+            return False
+        self.writer.write(encode_message({'type': 'register', 'username': self.name, 'codecs': [self.offer_codec]}))
+        frames = []
+        try:
+            while not frames:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    raise ConnectionError
+                frames = self.decoder.feed(data)
+            response = decode_message(frames[0])
+        except (OSError, FrameError, ValueError):
+            self.stats.errors['register'] += 1
+            return False
+        if response.get('status') != 'success':
+            self.stats.errors['register'] += 1
+            return False
+        self.codec = response.get('codec', JSON)
+        self.last_send = asyncio.get_running_loop().time()
+        self.read_task = asyncio.create_task(self.read_loop())
+        self.heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+        self.handle_frames(frames[1:])
+        return True
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    self.stats.errors['disconnect'] += 1
+                    return
+                self.handle_frames(self.decoder.feed(data))
+        except (OSError, FrameError):
+            self.stats.errors['disconnect'] += 1
+        except asyncio.CancelledError:
+            pass
+
+    async def heartbeat_loop(self):
+        """一段时间没有发送任何消息时发一次心跳，运行时间超过服务器的空闲超时也不会被断开"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(self.last_send + HEARTBEAT_INTERVAL - loop.time())
+                if loop.time() - self.last_send >= HEARTBEAT_INTERVAL:
+                    self.send({'type': 'heartbeat'})
+        except asyncio.CancelledError:
+            pass
+
+    def handle_frames(self, frames):
+        for payload in frames:
+            try:
+                self.handle(decode_message(payload))
+            except ValueError:
+                self.stats.errors['invalid_frame'] += 1
+
+    def handle(self, message):
+        msg_type = message.get('type')
+        if msg_type == 'chat_message':
+            now = time.time_ns()
+            self.stats.received += 1
+            sent_at = int(message.get('content', '').split(';', 1)[0])
+            if self.measure_from is not None and sent_at >= self.measure_from:
+                self.stats.latencies.append(now - sent_at)
+        elif msg_type in ('create_chat_response', 'chat_invitation'):
+            if message.get('status', 'success') == 'success':
+                self.group_id = message['group_id']
+                self.group_ready.set()
+            else:
+                self.stats.errors['create_chat'] += 1
+        elif msg_type == 'error' or message.get('status') == 'error':
+            self.stats.errors['server_error'] += 1
+
+    def send(self, message):
+        self.writer.write(encode_message(message, self.codec))
+        self.last_send = asyncio.get_running_loop().time()
+
+    async def send_loop(self, rate, size, deadline):
+        """以 rate 条/秒的速率发送 size 字节的消息直到 deadline（事件循环时间）"""
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / rate
+        next_send = loop.time()
+        padding = 'x' * size
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                return
+            if now < next_send:
+                await asyncio.sleep(next_send - now)
+                continue
+            next_send += interval
+            # 内容以发送时间开头，接收方据此计算端到端延迟
+            content = f"{time.time_ns()};{padding}"
+            self.send({'type': 'chat_message', 'group_id': self.group_id, 'content': content})
+            self.stats.sent += 1
+            if self.writer.transport.get_write_buffer_size() > 1 << 20:
+                await self.writer.drain()
+
+    async def close(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        if self.read_task is not None:
+            self.read_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+
+def worker_clients(total, processes, worker_index):
+    """第 worker_index 个进程负责的客户端数：除不尽的余数由前几个进程各多负责一个"""
+    base, extra = divmod(total, processes)
+    return base + (1 if worker_index < extra else 0)
+
+
+async def run_worker(options, worker_index):
+    """一个进程内：连接分给本进程的客户端，两两建立聊天并按速率发消息"""
+    stats = RunStats()
+    prefix = f"{options['name_prefix']}{worker_index}_"
+    count = worker_clients(options['clients'], options['processes'], worker_index)
+    clients = [LoadClient(f"{prefix}{i}", stats, options['codec']) for i in range(count)]
+
+    # 1. 连接并注册（限制同时进行的握手数）
+    limit = asyncio.Semaphore(options['connect_concurrency'])
+
+    async def connect(client):
+        async with limit:
+            return await client.connect(options['host'], options['port'])
+
+    connected = await asyncio.gather(*(connect(client) for client in clients))
+    clients = [client for client, ok in zip(clients, connected) if ok]
+
+    # 2. 相邻的两个客户端建立一个聊天
+    pairs = list(zip(clients[0::2], clients[1::2]))
+    for initiator, target in pairs:
+        initiator.send({'type': 'create_chat', 'target_user': target.name})
+    active = []
+    for initiator, target in pairs:
+        try:
+            await asyncio.wait_for(asyncio.gather(initiator.group_ready.wait(), target.group_ready.wait()),
+                                   options['setup_timeout'])
+            active += [initiator, target]
+        except asyncio.TimeoutError:
+            stats.errors['create_chat_timeout'] += 1
+
+    # 3. 预热后开始计量，按速率发送
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    measure_from = time.time_ns() + int(options['warmup'] * 1e9)
+    for client in active:
+        client.measure_from = measure_from
+    deadline = start + options['warmup'] + options['duration']
+    await asyncio.gather(*(client.send_loop(options['rate'], options['size'], deadline) for client in active))
+
+    # 4. 等待在途消息送达后断开
+    await asyncio.sleep(options['drain'])
+    await asyncio.gather(*(client.close() for client in clients))
+
+    result = stats.to_dict()
+    result['connected'] = len(clients)
+    result['active'] = len(active)
+    return result
+
+
+def worker_main(options, worker_index):
+    return asyncio.run(run_worker(options, worker_index))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(options, results, elapsed):
+    """合并各进程的结果，生成可比较的机器可读报告"""
+    latencies = sorted(value for result in results for value in result['latencies'])
+    errors = Counter()
+    for result in results:
+        errors.update(result['errors'])
+    received = sum(result['received'] for result in results)
+    measured = len(latencies)
+    ms = 1e-6
+    return {
+        'config': options,
+        'elapsed_s': round(elapsed, 3),
+        'clients_connected': sum(result['connected'] for result in results),
+        'clients_active': sum(result['active'] for result in results),
+        'sent': sum(result['sent'] for result in results),
+        'received': received,
+        'measured': measured,
+        'throughput_msgs_per_s': round(measured / options['duration'], 1) if options['duration'] else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / measured * ms, 3) if measured else None,
+            'p50': round(percentile(latencies, 0.50) * ms, 3) if measured else None,
+            'p90': round(percentile(latencies, 0.90) * ms, 3) if measured else None,
+            'p99': round(percentile(latencies, 0.99) * ms, 3) if measured else None,
+            'p999': round(percentile(latencies, 0.999) * ms, 3) if measured else None,
+            'max': round(latencies[-1] * ms, 3) if measured else None,
+        },
+        'errors': dict(errors),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="聊天服务器无界面压力测试工具")
+    parser.add_argument('--host', default='127.0.0.1', help="服务器地址")
+    parser.add_argument('--port', type=int, default=9999, help="服务器端口")
+    parser.add_argument('--clients', type=int, default=100, help="模拟客户端总数（两两组成一个聊天）")
+    parser.add_argument('--processes', type=int, default=1, help="发起负载的进程数")
+    parser.add_argument('--rate', type=float, default=1.0, help="每个客户端每秒发送的消息数")
+    parser.add_argument('--size', type=int, default=100, help="消息内容长度（字节）")
+    parser.add_argument('--duration', type=float, default=10.0, help="计量时长（秒）")
+    parser.add_argument('--warmup', type=float, default=1.0, help="预热时长（秒），期间的消息不计入统计")
+    parser.add_argument('--drain', type=float, default=1.0, help="停止发送后等待在途消息的时间（秒）")
+    parser.add_argument('--codec', choices=CODECS, default=JSON, help="向服务器申请的消息编码")
+    parser.add_argument('--connect-concurrency', type=int, default=200, help="同时进行的连接握手数")
+    parser.add_argument('--setup-timeout', type=float, default=10.0, help="建立聊天的超时时间（秒）")
+    parser.add_argument('--output', help="把 JSON 结果写入该文件（默认只打印）")
+    args = parser.parse_args()
+    if args.clients < 1 or args.processes < 1:
+        parser.error("客户端数和进程数至少为 1")
+    if args.rate <= 0:
+        parser.error("--rate 必须大于 0")
+    return args
+
+
+def main():
+    args = parse_args()
+    options = {
+        'host': args.host,
+        'port': args.port,
+        'clients': args.clients,
+        'processes': args.processes,
+        'rate': args.rate,
+        'size': args.size,
+        'duration': args.duration,
+        'warmup': args.warmup,
+        'drain': args.drain,
+        'codec': args.codec,
+        'connect_concurrency': args.connect_concurrency,
+        'setup_timeout': args.setup_timeout,
+        # 每次运行使用不同的用户名前缀，避免与上一次残留的连接冲突
+        'name_prefix': f"load{os.getpid()}_",
+    }
+
+    start = time.monotonic()
+    if args.processes == 1:
+        results = [worker_main(options, 0)]
+    else:
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(worker_main, [(options, index) for index in range(args.processes)])
+    report = summarize(options, results, time.monotonic() - start)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
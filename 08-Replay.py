@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter, defaultdict, deque
+
+from chat.capture import CLOSE, FRAME, GROUP, OPEN, read_capture
+from chat.codec import BINARY, JSON, encode_payload
+from chat.protocol import RECV_SIZE, FrameDecoder, FrameError, decode_message, encode_frame
+from chat.transfer import is_chunk
+
+
+def load_events(paths):
+    """合并若干抓包文件（多分片时每个分片一个），返回按时间排序的 [(纳秒, 类型, 连接键, 数据)]"""
+    captures = [read_capture(path) for path in paths]
+    base = min(start for start, _ in captures)
+    events = []
+    for index, (start, records) in enumerate(captures):
+        offset = start - base
+        for kind, conn_id, when, data in records:
+            events.append((when + offset, kind, (index, conn_id), data))
+    # 稳定排序：同一时间到达的帧保持原来的顺序
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def distribution_ms(values):
+    """纳秒数列表 -> 以毫秒表示的分布"""
+    values = sorted(values)
+    if not values:
+        return None
+    ms = 1e-6
+    return {
+        'mean': round(sum(values) / len(values) * ms, 3),
+        'p50': round(percentile(values, 0.50) * ms, 3),
+        'p90': round(percentile(values, 0.90) * ms, 3),
+        'p99': round(percentile(values, 0.99) * ms, 3),
+        'max': round(values[-1] * ms, 3),
+    }
+
+
+class ReplayConnection:
+    """抓包中的一个连接在重放时对应的客户端连接"""
+
+    def __init__(self, replay, key):
+        self.replay = replay
+        self.key = key
+        self.username = None
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.groups = set()  # 自己观察到的所在聊天组（重放时的组ID）
+        self.created = deque(replay.created.get(key, ()))  # 抓包时该连接创建的组ID，按创建顺序
+        self.registered = asyncio.Event()
+        self.awaiting = 0  # 应收到但还没收到的聊天消息数
+        self.settled = asyncio.Event()  # awaiting 为 0 时置位
+        self.settled.set()
+        self.read_task = None
+        self.closed = False
+
+    async def open(self, host, port):
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.closed = True
+            return False
+        self.read_task = asyncio.create_task(self.read_loop())
+        return True
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for payload in self.decoder.feed(data):
+                    if is_chunk(payload):
+                        continue
+                    try:
+                        self.handle(decode_message(payload))
+                    except ValueError:
+                        self.replay.errors['invalid_frame'] += 1
+        except (OSError, FrameError):
+            pass
+        except asyncio.CancelledError:
+            return
+        if not self.closed:
+            self.replay.errors['disconnect'] += 1
+            self.replay.abandon(self)
+            self.closed = True
+
+    def handle(self, message):
+        msg_type = message.get('type')
+        success = message.get('status', 'success') == 'success'
+        group_id = message.get('group_id')
+        if msg_type == 'chat_message':
+            self.replay.delivered(self, message)
+        elif msg_type == 'create_chat_response' and success:
+            self.groups.add(group_id)
+            if self.created:
+                self.replay.map_group(self.created.popleft(), group_id)
+        elif msg_type in ('chat_invitation', 'join_chat_response') and success:
+            self.groups.add(group_id)
+        elif msg_type == 'register_response':
+            self.registered.set()
+            if not success:
+                self.replay.errors['register'] += 1
+        elif msg_type == 'error' or not success:
+            self.replay.errors[message.get('code') or f"{msg_type}_error"] += 1
+
+    def send(self, frame):
+        self.writer.write(frame)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.replay.abandon(self, missed=True)
+        if self.read_task is not None:
+            self.read_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Replay:
+    """按抓包中的时间（除以 speed）把每个连接的帧重新发给服务器
+
+    speed 为 0 时不等待，按抓包顺序尽快发送，只在注册后等待注册响应。抓包时服务器分配的组ID与重放时不一定相同：
+    引用抓包组ID的帧先等到对应的 create_chat_response 到达，换成新的组ID后再发出。
+    每条聊天消息在发出时记下当时在组内的其他重放连接，收到时按 (组, 发送者, 内容) 对应，
+    关闭连接前先等它收完，仍没收到的计为 missing。
+    """
+
+    def __init__(self, events, host, port, speed, wait_timeout):
+        self.events = events
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.wait_timeout = wait_timeout
+        self.created = defaultdict(list)  # {连接键: [抓包中创建的组ID]}
+        for _, kind, key, data in events:
+            if kind == GROUP:
+                self.created[key].append(data.decode())
+        self.original_groups = {group_id for ids in self.created.values() for group_id in ids}
+        self.group_map = {}  # {抓包中的组ID: 重放时的组ID}
+        self.group_ready = defaultdict(asyncio.Event)
+        self.connections = {}  # {连接键: ReplayConnection}
+        self.expected = {}  # {(组ID, 发送者, 内容): deque([发送时间, 尚未收到的连接集合])}
+
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.drift = []  # 实际发出时间 - 计划发出时间（纳秒）
+        self.latencies = []  # 聊天消息从发出到各接收者收到的时间（纳秒）
+        self.deliveries = Counter()
+        self.errors = Counter()
+
+    def map_group(self, original, group_id):
+        self.group_map[original] = group_id
+        self.group_ready[original].set()
+
+    async def resolve_group(self, original):
+        """抓包中的组ID -> 重放时的组ID；等待超时（例如重放时创建失败）返回 None，之后不再等待这个组"""
+        if original not in self.group_map:
+            try:
+                await asyncio.wait_for(self.group_ready[original].wait(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.group_map[original] = None
+                self.errors['group_timeout'] += 1
+        return self.group_map[original]
+
+    def expect(self, conn, message):
+        group_id = message.get('group_id')
+        receivers = {other for other in self.connections.values()
+                     if other is not conn and not other.closed and group_id in other.groups}
+        if receivers:
+            key = (group_id, conn.username, message.get('content'))
+            self.expected.setdefault(key, deque()).append([time.perf_counter_ns(), receivers])
+            self.deliveries['expected'] += len(receivers)
+            for receiver in receivers:
+                receiver.awaiting += 1
+                receiver.settled.clear()
+
+    def delivered(self, conn, message):
+        key = (message.get('group_id'), message.get('from_user'), message.get('content'))
+        pending = self.expected.get(key)
+        if pending:
+            for sent_at, receivers in pending:
+                if conn in receivers:
+                    receivers.remove(conn)
+                    self.latencies.append(time.perf_counter_ns() - sent_at)
+                    self.deliveries['delivered'] += 1
+                    conn.awaiting -= 1
+                    if not conn.awaiting:
+                        conn.settled.set()
+                    while pending and not pending[0][1]:
+                        pending.popleft()
+                    if not pending:
+                        del self.expected[key]
+                    return
+        # 例如发出时本地还没看到邀请，或上线后补发的离线消息
+        self.deliveries['unexpected'] += 1
+
+    def abandon(self, conn, missed=False):
+        """连接关闭，它还没收到的消息不再等待：我们主动关闭的（已等过）计为 missing，
+        服务器断开的计为 abandoned"""
+        for pending in self.expected.values():
+            for entry in pending:
+                if conn in entry[1]:
+                    entry[1].remove(conn)
+                    self.deliveries['missing' if missed else 'abandoned'] += 1
+        conn.awaiting = 0
+        conn.settled.set()
+
+    async def settle(self, conn):
+        """等连接收完发给它的聊天消息（最多 wait_timeout 秒）"""
+        try:
+            await asyncio.wait_for(conn.settled.wait(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def send_frame(self, conn, payload):
+        """按需改写（注册时去掉旧会话、换成新的组ID）后发出一帧"""
+        if is_chunk(payload):
+            conn.send(encode_frame(payload))
+            return
+        try:
+            message = decode_message(payload)
+        except ValueError:
+            conn.send(encode_frame(payload))
+            return
+
+        changed = False
+        msg_type = message.get('type')
+        if msg_type == 'register':
+            conn.username = message.get('username')
+            # 抓包中的会话令牌在新服务器上无效
+            if 'session' in message:
+                message.pop('session')
+                message.pop('last_seq', None)
+                changed = True
+        group_id = message.get('group_id')
+        if group_id in self.original_groups:
+            mapped = await self.resolve_group(group_id)
+            if mapped is not None and mapped != group_id:
+                message['group_id'] = group_id = mapped
+                changed = True
+        if conn.closed:
+            return
+        if msg_type == 'chat_message':
+            self.expect(conn, message)
+        elif msg_type == 'leave_chat':
+            conn.groups.discard(group_id)
+
+        if changed:
+            payload = encode_payload(message, JSON if payload[:1] == b'{' else BINARY)
+        conn.send(encode_frame(payload))
+        self.frames_sent += 1
+        self.bytes_sent += len(payload)
+        if msg_type == 'register':
+            # 注册完成之前不发后面的帧：尽快重放时，别的连接可能紧接着就向这个用户发起聊天
+            try:
+                await asyncio.wait_for(conn.registered.wait(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.errors['register_timeout'] += 1
+        if conn.writer.transport.get_write_buffer_size() > 1 << 20:
+            await conn.writer.drain()
+
+    async def run(self, drain):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for when, kind, key, data in self.events:
+            if self.speed:
+                scheduled = start + when / 1e9 / self.speed
+                delay = scheduled - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            conn = self.connections.get(key)
+            if kind == OPEN:
+                conn = self.connections[key] = ReplayConnection(self, key)
+                if not await conn.open(self.host, self.port):
+                    self.errors['connect'] += 1
+            elif kind == FRAME:
+                if conn is None or conn.closed:
+                    self.errors['skipped_frame'] += 1
+                    continue
+                await self.send_frame(conn, data)
+                if self.speed:
+                    self.drift.append(int((loop.time() - scheduled) * 1e9))
+            elif kind == CLOSE and conn is not None:
+                # 尽快重放时连接的关闭紧跟在最后几条消息之后，先等它收完
+                await self.settle(conn)
+                conn.close()
+        sent_elapsed = loop.time() - start
+
+        # 等待在途消息送达
+        await asyncio.sleep(drain)
+        for conn in self.connections.values():
+            conn.close()
+        await asyncio.gather(*(conn.read_task for conn in self.connections.values() if conn.read_task),
+                             return_exceptions=True)
+        return sent_elapsed
+
+    def report(self, options, sent_elapsed):
+        captured = self.events[-1][0] / 1e9 if self.events else 0.0
+        return {
+            'config': options,
+            'captured_s': round(captured, 3),
+            'replay_s': round(sent_elapsed, 3),
+            'effective_speed': round(captured / sent_elapsed, 2) if sent_elapsed else None,
+            'connections': len(self.connections),
+            'frames_sent': self.frames_sent,
+            'bytes_sent': self.bytes_sent,
+            'throughput_frames_per_s': round(self.frames_sent / sent_elapsed, 1) if sent_elapsed else None,
+            'deliveries': {
+                'expected': self.deliveries['expected'],
+                'delivered': self.deliveries['delivered'],
+                'missing': self.deliveries['missing'],
+                'abandoned': self.deliveries['abandoned'],
+                'unexpected': self.deliveries['unexpected'],
+            },
+            'latency_ms': distribution_ms(self.latencies),
+            'drift_ms': distribution_ms(self.drift),
+            'errors': dict(self.errors),
+        }
+
+
+def compare(report, baseline):
+    """与之前的报告比较吞吐量和延迟，返回 {指标: (之前, 现在, 变化百分比)}"""
+    metrics = [('throughput_frames_per_s',), ('latency_ms', 'p50'), ('latency_ms', 'p99'), ('drift_ms', 'p99')]
+    result = {}
+    for path in metrics:
+        old, new = baseline, report
+        for part in path:
+            old = old.get(part) if isinstance(old, dict) else None
+            new = new.get(part) if isinstance(new, dict) else None
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+            change = round((new - old) / old * 100, 1) if old else None
+            result['.'.join(path)] = (old, new, change)
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="按原来的时间重放服务器抓包（08-Server.py --capture），检查送达并报告吞吐量和延迟")
+    parser.add_argument('captures', nargs='+', help="抓包文件（多分片时传入所有分片的文件）")
+    parser.add_argument('--host', default='127.0.0.1', help="服务器地址")
+    parser.add_argument('--port', type=int, default=9999, help="服务器端口")
+    parser.add_argument('--speed', type=float, default=1.0, help="重放倍速，0 表示不等待、尽快发送")
+    parser.add_argument('--drain', type=float, default=2.0, help="发完后等待在途消息的时间（秒）")
+    parser.add_argument('--wait-timeout', type=float, default=5.0, help="等待聊天组创建完成的最长时间（秒）")
+    parser.add_argument('--output', help="把 JSON 结果写入该文件（默认只打印）")
+    parser.add_argument('--baseline', help="之前的 JSON 结果，打印吞吐量和延迟的变化")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("倍速不能为负数")
+    return args
+
+
+def main():
+    args = parse_args()
+    events = load_events(args.captures)
+    options = {
+        'captures': args.captures,
+        'host': args.host,
+        'port': args.port,
+        'speed': args.speed,
+        'drain': args.drain,
+    }
+    replay = Replay(events, args.host, args.port, args.speed, args.wait_timeout)
+    sent_elapsed = asyncio.run(replay.run(args.drain))
+    report = replay.report(options, sent_elapsed)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        for name, (old, new, change) in compare(report, baseline).items():
+            print(f"{name}: {old} -> {new}" + (f" ({change:+.1f}%)" if change is not None else ""))
+
+    # 有消息没有送达时以非零状态退出，便于在发布前的检查中使用
+    if report['deliveries']['missing']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
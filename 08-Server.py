@@ -1,229 +1,1380 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import selectors
+import shutil
+import signal
 import socket
+import tempfile
 import threading
-import json
 import time
 from collections import defaultdict
 
+from chat.bus import Broker, BusClient
+from chat.capture import CaptureWriter
+from chat.codec import CODECS, JSON, choose_codec, group_number
+from chat.history import MessageLog
+from chat.metrics import Metrics, dump_periodically, serve_stats
+from chat.outbound import (
+    BLOCK, DISCONNECT, IOV_MAX, POLICIES, FileRegion, OutboundQueue, advance, send_frames, sendall_frames,
+    set_cork,
+)
+from chat.transfer import (
+    CHUNK_SIZE, MAX_FILE_SIZE, WINDOW_CHUNKS, Download, FileStore, Upload, chunk_header, is_chunk, parse_chunk,
+)
+from chat.ratelimit import DEFAULT_LIMITS, TokenBucket, allow, make_buckets, parse_limit
+from chat.registry import Registry
+from chat.wheel import TimingWheel
+from chat.protocol import (
+    RECV_SIZE, FrameDecoder, FrameError, decode_message, encode_message,
+)
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+
+# 单次聊天记录查询最多返回的条数
+MAX_HISTORY = 500
+
+# 一个聊天组最多的成员数
+MAX_GROUP_SIZE = 10000
+
+# 成员数不超过这个值时，邀请和加入响应中附带完整的成员列表
+MEMBER_LIST_LIMIT = 100
+
+# 被限流的连接每隔这么多秒最多收到一次拒绝响应
+THROTTLE_NOTICE_INTERVAL = 1.0
+
+# 拒绝响应预先编码好，限流和拒绝连接本身不产生序列化开销
+RATE_LIMITED = {'type': 'error', 'code': 'rate_limited', 'message': '请求过于频繁，请稍后再试'}
+SERVER_BUSY = {'type': 'register_response', 'status': 'error', 'code': 'server_busy', 'message': '服务器繁忙，请稍后再试'}
+
+
+def user_list_text(users, limit=3):
+    """用于提示消息的用户列表，人多时只列出前几个"""
+    text = ", ".join(users[:limit])
+    return f"{text} 等 {len(users)} 人" if len(users) > limit else text
+
+
+class ClientConnection:
+    """单个客户端连接的状态"""
+    __slots__ = ('sock', 'address', 'username', 'codec', 'decoder', 'queue', 'out_frames', 'closed',
+                 'last_seen', 'wheel_slot', 'buckets', 'throttle_notice', 'streams', 'stream_ids',
+                 'capture_id')
+
+    def __init__(self, sock, address, queue):
+        self.sock = sock
+        self.address = address
+        self.username = None
+        self.codec = JSON  # 注册时协商的消息编码
+        self.decoder = FrameDecoder()
+        self.queue = queue  # 有界发送队列
+        self.out_frames = []  # 事件循环模式下已从队列取出但未发完的帧
+        self.closed = False
+        self.last_seen = 0.0  # 最近一次收到数据的时间（time.monotonic）
+        self.wheel_slot = None  # 在空闲检测时间轮中的槽位
+        self.buckets = None  # 注册后按消息类型的限流令牌桶
+        self.throttle_notice = 0.0  # 最近一次发送限流拒绝响应的时间
+        self.streams = {}  # 正在进行的文件传输 {流ID: Upload 或 Download}
+        self.stream_ids = itertools.count(1)
+        self.capture_id = None  # 在抓包文件中的连接号
+
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=9999):
+    def __init__(self, host='0.0.0.0', port=9999, mode='thread', backlog=100,
+                 queue_size=1000, queue_policy=DISCONNECT,
+                 shard_index=0, shards=1, bus_path=None, history_dir=None, files_dir=None,
+                 max_file_size=MAX_FILE_SIZE, capture_path=None, idle_timeout=90.0,
+                 coalesce_window=0.0, coalesce_bytes=16384, tcp_nodelay=True, mailbox_size=1000,
+                 rate_limits=None, max_connections=0, accept_rate=0.0,
+                 stats_host='127.0.0.1', stats_port=0, stats_interval=0.0):
+        if mode == 'eventloop' and queue_policy == BLOCK:
+            raise ValueError("事件循环模式不能使用 block 队列策略")
         self.host = host
         self.port = port
+        self.mode = mode  # 'thread': 每个连接一个线程; 'eventloop': 单线程事件循环
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        # 写合并：发往同一连接的帧最多等待 coalesce_window 秒或攒够 coalesce_bytes 字节再一次写出
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = coalesce_bytes if coalesce_window else 0
+        self.tcp_nodelay = tcp_nodelay
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if shards > 1:
+            # 多个分片进程监听同一端口，由内核分配新连接
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(100)  # 支持多个客户端同时连接
+        self.server_socket.listen(backlog)  # 支持多个客户端同时连接
+
+        # 在线用户、聊天组成员、离线信箱和组ID计数器（分段加锁，线程模式下可并发访问）；
+        # 会话和重放环不经总线同步，多分片时重连到其他分片的客户端无法续传
+        self.registry = Registry(mailbox_size=mailbox_size)
+
+        # 分片模式：本进程是 shards 个分片中的第 shard_index 个，
+        # 其他分片上的在线用户通过总线同步到 remote_users
+        self.shard_index = shard_index
+        self.shards = shards
+        self.remote_users = {}  # {username: shard_index}
+        # 经扇出路径投递的每条消息带一个全局唯一的 event_seq，客户端断线重连时据此续传
+        self.event_counter = itertools.count(1)
+        self.bus = BusClient(bus_path, shard_index) if shards > 1 else None
+
+        # 持久化聊天记录（可选）
+        self.history = MessageLog(history_dir) if history_dir else None
+        if self.history is not None:
+            # 重启后继续编号，新组不会复用旧组的ID和聊天记录
+            numbers = [group_number(group_id) for group_id in self.history.group_ids()]
+            self.registry.reserve_group_numbers(max([n for n in numbers if n is not None], default=0))
 
-        # 客户端连接信息
-        self.clients = {}  # {username: (client_socket, client_address)}
+        # 文件传输（可选）：上传的文件保存在 files_dir 中，各分片共用同一目录
+        self.files = FileStore(files_dir, max_file_size) if files_dir else None
 
-        # 聊天组信息
-        self.chat_groups = defaultdict(set)  # {group_id: {username1, username2}}
-        self.user_groups = defaultdict(set)  # {username: {group_id1, group_id2}}
+        # 抓包（可选）：记录每个连接收到的每一帧，用 08-Replay.py 重放
+        self.capture = CaptureWriter(capture_path) if capture_path else None
 
-        # 生成组ID的计数器
-        self.group_counter = 0
+        # 空闲连接检测：超过 idle_timeout 秒没有收到任何数据（包括心跳）的连接被断开
+        self.idle_timeout = idle_timeout
+        self.idle_wheel = None
+        if idle_timeout:
+            self.idle_wheel = TimingWheel(idle_timeout, min(1.0, idle_timeout / 10), time.monotonic())
 
-        print(f"聊天服务器已启动，监听地址：{self.host}:{self.port}")
+        # 限流：每个用户按消息类型的令牌桶，以及全局的接受连接速率和连接数上限
+        self.rate_limits = dict(rate_limits or {})
+        self.max_connections = max_connections
+        self.accept_bucket = TokenBucket(accept_rate, max(1, int(accept_rate)), time.monotonic()) if accept_rate else None
+        self.open_connections = 0
+        self.admission_lock = threading.Lock()
+        self.rate_limited_frames = {codec: encode_message(RATE_LIMITED, codec) for codec in CODECS}
+        self.server_busy_frame = encode_message(SERVER_BUSY)
+
+        # 运行指标，可通过本地统计端点读取或定期打印
+        self.metrics = Metrics()
+        self.stats_server = serve_stats(stats_host, stats_port, self.stats) if stats_port else None
+        if stats_interval:
+            dump_periodically(stats_interval, self.stats)
+
+        # 事件循环模式使用的选择器和待关闭连接
+        self.selector = None
+        self.pending_close = []
+        self.coalescing = set()  # 有帧在合并窗口中等待写出的连接
+
+        # 消息类型 -> 处理函数
+        self.handlers = {
+            'create_chat': self.handle_create_chat,
+            'invite': self.handle_invite,
+            'join_chat': self.handle_join_chat,
+            'chat_message': self.handle_chat_message,
+            'leave_chat': self.handle_leave_chat,
+            'heartbeat': self.handle_heartbeat,
+            'history': self.handle_history,
+            'file_offer': self.handle_file_offer,
+            'file_ack': self.handle_file_ack,
+            'file_get': self.handle_file_get,
+        }
+
+        shard_info = f"，分片 {shard_index + 1}/{shards}" if shards > 1 else ""
+        print(f"聊天服务器已启动（{self.mode} 模式{shard_info}），监听地址：{self.host}:{self.port}")
 
     def generate_group_id(self):
-        """生成唯一的聊天组ID"""
-        self.group_counter += 1
-        return f"group_{self.group_counter}"
-
-    def broadcast_to_group(self, group_id, message, sender=None):
-        """向组内所有用户广播消息"""
-        for username in self.chat_groups[group_id]:
-            if username != sender:  # 不需要给发送者自己发送消息
-                try:
-                    client_socket = self.clients[username][0]
-                    client_socket.send(message.encode('utf-8'))
-                except Exception as e:
-                    print(f"向{username}发送消息失败: {e}")
+        """生成唯一的聊天组ID（各分片的编号互不重叠）"""
+        number = self.registry.next_group_number()
+        return f"group_{(number - 1) * self.shards + self.shard_index + 1}"
 
-    def handle_client(self, client_socket, client_address):
-        """处理客户端连接"""
+    def stamp(self, message):
+        """给一条待扇出的消息分配 event_seq（各分片的编号互不重叠）；已分配过的不变"""
+        if 'event_seq' not in message:
+            message['event_seq'] = (next(self.event_counter) - 1) * self.shards + self.shard_index + 1
+        return message
+
+    def is_online(self, username):
+        """用户是否在本分片或其他分片在线"""
+        return username in self.registry or username in self.remote_users
+
+    def add_group_members(self, group_id, usernames, publish=True):
+        """把用户加入聊天组，并同步给其他分片"""
+        self.registry.add_members(group_id, usernames)
+        if publish and self.bus is not None:
+            self.bus.publish({'op': 'group_add', 'group_id': group_id, 'users': list(usernames)})
+
+    def remove_group_member(self, group_id, username, publish=True):
+        """把用户移出聊天组并同步给其他分片；组内没有用户时删除该组。返回该组是否仍存在"""
+        # 组内没有用户时由注册表删除该组
+        removed, remaining = self.registry.remove_member(group_id, username)
+        if removed and publish and self.bus is not None:
+            self.bus.publish({'op': 'group_remove', 'group_id': group_id, 'username': username})
+        return removed and remaining
+
+    def send_to(self, conn, message):
+        """向单个连接发送一条消息字典"""
+        frame = encode_message(message, conn.codec)
+        self.metrics.add((('messages_out', message.get('type')), 1), ('bytes_out', len(frame)))
+        self.send_frame(conn, frame)
+
+    def reply(self, conn, request, response):
+        """回复一条请求；请求带 req_id 时原样带回，流水线客户端据此把响应对应到请求"""
+        req_id = request.get('req_id')
+        if req_id is not None:
+            response['req_id'] = req_id
+        self.send_to(conn, response)
+
+    def new_connection(self, sock, address):
+        """为新接受的套接字创建连接状态"""
+        queue = OutboundQueue(self.queue_size, self.queue_policy,
+                              linger=self.coalesce_window, min_bytes=self.coalesce_bytes)
+        if self.tcp_nodelay:
+            # 何时写出由发送队列（和写合并窗口）决定，不再让 Nagle 算法额外等待 ACK
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        conn = ClientConnection(sock, address, queue)
+        if self.capture is not None:
+            conn.capture_id = self.capture.open(address)
+        if self.idle_wheel is not None:
+            self.idle_wheel.add(conn, time.monotonic())
+        return conn
+
+    def admit(self, sock):
+        """接受连接前的准入检查：超过接受速率或连接数上限时发送预先编码的拒绝响应并关闭"""
+        reason = None
+        with self.admission_lock:
+            if self.accept_bucket is not None and not self.accept_bucket.take(time.monotonic()):
+                reason = 'accept_rate'
+            elif self.max_connections and self.open_connections >= self.max_connections:
+                reason = 'max_connections'
+            else:
+                self.open_connections += 1
+                self.metrics.incr('connections_accepted')
+                return True
+        self.metrics.incr(('connections_rejected', reason))
         try:
-            # 1. 接收客户端注册信息
-            register_data = client_socket.recv(1024).decode('utf-8')
-            register_info = json.loads(register_data)
-            username = register_info.get('username')
-
-            if not username or username in self.clients:
-                # 用户名为空或已存在
-                response = {
-                    'type': 'register_response',
-                    'status': 'error',
-                    'message': '用户名为空或已被使用'
-                }
-                client_socket.send(json.dumps(response).encode('utf-8'))
-                client_socket.close()
-                return
+            sock.setblocking(False)
+            sock.send(self.server_busy_frame)
+        except OSError:
+            pass
+        sock.close()
+        return False
+
+    def release_connection(self):
+        """一个已接受的连接关闭"""
+        with self.admission_lock:
+            self.open_connections -= 1
+        self.metrics.incr('connections_closed')
+
+    def message_label(self, msg_type):
+        """客户端发来的消息类型作为指标标签和限流键：只有已知类型原样使用，其余都归为 'other'，
+        客户端不能随意增加指标的键（也不会因为类型不可哈希而出错）"""
+        if isinstance(msg_type, str) and (msg_type in self.handlers or msg_type == 'register'):
+            return msg_type
+        return 'other'
+
+    def throttle(self, conn, message, now):
+        """记录一次限流；距上次拒绝响应超过 THROTTLE_NOTICE_INTERVAL 秒时才回复，避免拒绝响应本身被刷屏。
+        带 req_id 的请求总会收到拒绝响应，否则流水线客户端会一直等它的结果"""
+        self.metrics.incr(('throttled', self.message_label(message.get('type'))))
+        if message.get('req_id') is not None:
+            self.reply(conn, message, dict(RATE_LIMITED))
+        elif now - conn.throttle_notice >= THROTTLE_NOTICE_INTERVAL:
+            conn.throttle_notice = now
+            self.send_frame(conn, self.rate_limited_frames[conn.codec])
+
+    def throttle_stats(self):
+        """被限流的消息数（按类型）和被拒绝的连接数（按原因）"""
+        counters = self.metrics.snapshot()['counters']
+        return {'throttled': counters.get('throttled', {}), 'connections_rejected': counters.get('connections_rejected', {})}
+
+    def stats(self):
+        """当前的全部运行指标：计数器、直方图和即时状态"""
+        stats = self.metrics.snapshot()
+        depths = [(len(conn.queue), conn.queue.dropped) for _, conn in self.registry.connections()]
+        stats['gauges'] = {
+            'open_connections': self.open_connections,
+            'online_users': len(depths),
+            'remote_users': len(self.remote_users),
+            'groups': len(self.registry.groups),
+            'sessions': len(self.registry.sessions),
+            'queue_depth_total': sum(depth for depth, _ in depths),
+            'queue_depth_max': max((depth for depth, _ in depths), default=0),
+            'queue_dropped_total': sum(dropped for _, dropped in depths),
+            'coalescing_connections': len(self.coalescing),
+        }
+        if self.shards > 1:
+            stats['gauges']['shard'] = self.shard_index
+        return stats
+
+    def reap_idle(self):
+        """断开空闲超时的连接（包括半开连接），离线清理由连接的关闭流程完成"""
+        for conn in self.idle_wheel.advance(time.monotonic()):
+            if not conn.closed:
+                print(f"客户端 {conn.username or conn.address} 超过 {self.idle_timeout:g} 秒没有活动，断开连接")
+                self.metrics.incr('idle_disconnects')
+                self.disconnect(conn)
+
+    def reap_loop(self):
+        """线程模式下定期推进空闲检测时间轮的线程"""
+        while True:
+            time.sleep(self.idle_wheel.tick)
+            self.reap_idle()
+
+    def send_frame(self, conn, frame, entry=None):
+        """把已分帧的数据放入连接的发送队列；entry 为对应的消息时同时记入会话的重放环"""
+        if not conn.queue.put(frame, entry):
+            if not conn.closed and not conn.queue.closed:
+                print(f"客户端 {conn.username or conn.address} 发送队列已满（{len(conn.queue)} 帧），断开连接")
+                self.metrics.incr('queue_full_disconnects')
+            self.disconnect(conn)
+            return
+        if self.mode == 'eventloop':
+            if not self.coalesce_window or conn.queue.due(time.monotonic()):
+                self.flush_connection(conn)
+            else:
+                self.coalescing.add(conn)
+
+    def flush_coalesced(self):
+        """事件循环模式下写出合并窗口已到期（或已攒够字节）的连接"""
+        now = time.monotonic()
+        for conn in list(self.coalescing):
+            if conn.closed or conn.queue.due(now):
+                self.coalescing.discard(conn)
+                self.flush_connection(conn)
 
-            # 注册成功
-            self.clients[username] = (client_socket, client_address)
+    def disconnect(self, conn):
+        """主动断开一个连接，用户资源由该连接的读取方清理"""
+        if self.mode == 'eventloop':
+            self.schedule_close(conn)
+            return
+        conn.closed = True
+        conn.queue.close(discard=True)
+        try:
+            # 让该连接的读取线程从 recv 返回并完成清理
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def queue_stats(self):
+        """各在线用户发送队列的当前深度和丢弃帧数"""
+        return {
+            username: {'depth': len(conn.queue), 'dropped': conn.queue.dropped}
+            for username, conn in self.registry.connections()
+        }
+
+    def broadcast_to_group(self, group_id, message, sender=None, queue_offline=True):
+        """向组内所有用户广播消息；queue_offline 为 False 时不给离线成员留存"""
+        # 遍历预先算好的扇出快照：在线成员的连接直接入队，不需要逐个查在线用户表，
+        # 也不需要加锁；发送失败引起的清理只会作废快照，不会改变正在遍历的元组
+        start = time.perf_counter_ns()
+        self.stamp(message)
+        conns, absent = self.registry.fanout(group_id)
+        # 不需要给发送者自己发送消息
+        self.send_to_connections(conns, message, skip=sender)
+        if absent:
+            # 其他分片上的成员和离线成员
+            self.deliver([username for username in absent if username != sender], message, queue_offline)
+        self.metrics.observe('broadcast_fanout', time.perf_counter_ns() - start)
+
+    def deliver(self, usernames, message, queue_offline=True):
+        """把一条消息投递给若干用户：本分片的直接入队，其他分片的按分片汇总后经总线转发，
+        离线用户的放入离线信箱"""
+        self.stamp(message)
+        remote = defaultdict(list)
+        local = []
+        for username in usernames:
+            if username in self.registry:
+                local.append(username)
+            elif username in self.remote_users:
+                remote[self.remote_users[username]].append(username)
+            elif queue_offline:
+                conn = self.registry.stash(username, message)
+                if conn is not None:
+                    # 刚刚上线
+                    local.append(username)
+        self.deliver_local(local, message)
+        for shard, users in remote.items():
+            self.bus.publish({'op': 'deliver', 'to_shard': shard, 'users': users, 'message': message})
+
+    def deliver_local(self, usernames, message):
+        """把消息放入本分片用户的发送队列"""
+        conns = [self.registry.get(username) for username in usernames]
+        self.send_to_connections([conn for conn in conns if conn is not None], message)
+
+    def send_to_connections(self, conns, message, skip=None):
+        """把一条消息放入若干连接的发送队列，跳过用户名为 skip 的连接"""
+        # 每种编码只序列化、分帧一次，同编码的接收者共享同一个不可变 bytes 对象
+        frames = {}
+        sent = 0
+        sent_bytes = 0
+        for conn in conns:
+            if conn.username == skip:
+                continue
+            try:
+                frame = frames.get(conn.codec)
+                if frame is None:
+                    frame = frames[conn.codec] = encode_message(message, conn.codec)
+                self.send_frame(conn, frame, message)
+                sent += 1
+                sent_bytes += len(frame)
+            except Exception as e:
+                print(f"向{conn.username}发送消息失败: {e}")
+        if sent:
+            self.metrics.add((('messages_out', message.get('type')), sent), ('bytes_out', sent_bytes))
+
+    def register_client(self, conn, register_info):
+        """处理注册请求，成功返回 True"""
+        username = register_info.get('username')
+
+        codec = choose_codec(register_info.get('codecs'))
+        # 断线前加入的聊天组仍然有效
+        groups = [dict(self.member_info(group_id), group_id=group_id)
+                  for group_id in self.registry.groups_of(username)] if username else []
+        queued = []
+
+        def prologue(registration):
+            # 在注册表的锁内、连接对其他线程可见之前执行：注册响应和补发的消息先入队，
+            # 之后的广播都排在它们后面，客户端收到的第一帧一定是注册响应
+            messages = registration.messages
             response = {
                 'type': 'register_response',
                 'status': 'success',
-                'message': f'欢迎 {username}!'
+                'message': f'欢迎 {username}!',
+                'codec': codec,
+                # 断线重连时凭令牌和最后收到的 event_seq 续传
+                'session': registration.token,
+                'resumed': registration.resumed,
+                'groups': groups,
+                'queued': len(messages),
+                # 有一部分要补发的消息已经被挤出重放环
+                'gap': registration.gap
+            }
+            # 注册响应总是用 JSON 发送，之后才切换到协商的编码；
+            # 漏掉的消息按新编码分帧后和注册响应拼成一块，一次放入发送队列、一次写出
+            frame = encode_message(response, conn.codec)
+            self.metrics.add((('messages_out', 'register_response'), 1), ('bytes_out', len(frame)))
+            if messages:
+                self.metrics.incr('replayed_messages', len(messages))
+                frame += b''.join(encode_message(message, codec) for message in messages)
+            conn.username = username
+            conn.codec = codec
+            if self.rate_limits:
+                conn.buckets = make_buckets(self.rate_limits, time.monotonic())
+            # 这里不能调用 send_frame：队列满时它会断开连接，而断开连接要获取注册表的同一把锁
+            queued.append(conn.queue.put(frame))
+
+        # 检查和登记在注册表的同一把锁内完成，两个连接同时注册同名用户时只有一个成功；
+        # 带有效会话令牌的重连会顶替服务器还没发现已断开的旧连接
+        registration = None
+        if username and username not in self.remote_users:
+            registration = self.registry.register(username, conn, register_info.get('session'),
+                                                  register_info.get('last_seq'), prologue)
+        if registration is None:
+            # 用户名为空或已存在
+            response = {
+                'type': 'register_response',
+                'status': 'error',
+                'message': '用户名为空或已被使用'
+            }
+            self.send_to(conn, response)
+            return False
+
+        # 注册成功
+        if registration.replaced is not None:
+            print(f"用户 {username} 凭会话令牌重新连接，关闭旧连接 {registration.replaced.address}")
+            self.disconnect(registration.replaced)
+        if not queued[0]:
+            self.disconnect(conn)
+            return False
+        if self.mode == 'eventloop':
+            self.flush_connection(conn)
+        if self.bus is not None:
+            self.bus.publish({'op': 'user_online', 'username': username})
+
+        print(f"用户 {username} ({conn.address}) 已连接")
+        return True
+
+    def process_message(self, conn, message):
+        """分发已注册用户发来的一条消息"""
+        msg_type = self.message_label(message.get('type'))
+        if conn.buckets is not None:
+            now = time.monotonic()
+            if not allow(conn.buckets, msg_type, now):
+                self.throttle(conn, message, now)
+                return
+        handler = self.handlers.get(msg_type)
+        if handler is not None:
+            start = time.perf_counter_ns()
+            handler(conn, message)
+            self.metrics.observe(('handler_latency', msg_type), time.perf_counter_ns() - start)
+        else:
+            self.metrics.incr(('unknown_messages', msg_type))
+
+    def check_targets(self, targets, username):
+        """校验被邀请的用户列表，返回 (去重后的用户名列表, 错误信息)"""
+        if not isinstance(targets, list) or not targets:
+            return None, '请指定要邀请的用户'
+        users = []
+        seen = {username}
+        for target in targets:
+            if not isinstance(target, str) or not self.is_online(target):
+                return None, f'用户 {target} 不存在或不在线'
+            if target not in seen:
+                seen.add(target)
+                users.append(target)
+        return users, None
+
+    def member_info(self, group_id):
+        """邀请、加入响应中的成员信息（大组只给出人数）"""
+        members = self.registry.members(group_id)
+        info = {'member_count': len(members)}
+        if len(members) <= MEMBER_LIST_LIMIT:
+            info['members'] = list(members)
+        return info
+
+    def invite_members(self, group_id, inviter, users):
+        """把 users 加入聊天组，向他们发送邀请，并通知组内原有成员"""
+        self.add_group_members(group_id, users)
+        invitation = {
+            'type': 'chat_invitation',
+            'group_id': group_id,
+            'from_user': inviter,
+            'message': f'{inviter} 想与您聊天'
+        }
+        invitation.update(self.member_info(group_id))
+        self.deliver(users, invitation)
+        return invitation
+
+    def handle_create_chat(self, conn, message):
+        """创建新的聊天：target_user 为单个用户，target_users 为多人聊天室"""
+        username = conn.username
+        targets = message.get('target_users')
+        if targets is None:
+            targets = [message.get('target_user')]
+        users, error = self.check_targets(targets, username)
+        if error is None and not users:
+            error = '不能与自己聊天'
+        elif error is None and len(users) + 1 > MAX_GROUP_SIZE:
+            error = f'聊天组最多 {MAX_GROUP_SIZE} 人'
+        if error:
+            response = {
+                'type': 'create_chat_response',
+                'status': 'error',
+                'message': error
             }
-            client_socket.send(json.dumps(response).encode('utf-8'))
+            self.reply(conn, message, response)
+            return
+
+        # 创建新的聊天组
+        group_id = self.generate_group_id()
+        self.add_group_members(group_id, [username])
+        if self.capture is not None:
+            self.capture.group(conn.capture_id, group_id)
+
+        # 通知发起者
+        initiator_response = {
+            'type': 'create_chat_response',
+            'status': 'success',
+            'group_id': group_id,
+            'target_user': users[0],
+            'message': f'与 {user_list_text(users)} 的聊天已创建'
+        }
+        # 通知目标用户
+        self.invite_members(group_id, username, users)
+        initiator_response.update(self.member_info(group_id))
+        self.reply(conn, message, initiator_response)
+
+    def handle_invite(self, conn, message):
+        """邀请更多用户加入自己所在的聊天组"""
+        username = conn.username
+        group_id = message.get('group_id')
+        targets = message.get('target_users')
+        if targets is None:
+            targets = [message.get('target_user')]
+
+        users, error = None, None
+        if not self.registry.is_member(group_id, username):
+            error = '您不在该聊天组中'
+        else:
+            users, error = self.check_targets(targets, username)
+        if error is None:
+            users = [user for user in users if not self.registry.is_member(group_id, user)]
+            if self.registry.group_size(group_id) + len(users) > MAX_GROUP_SIZE:
+                error = f'聊天组最多 {MAX_GROUP_SIZE} 人'
+        if error:
+            self.reply(conn, message, {'type': 'invite_response', 'status': 'error', 'group_id': group_id, 'message': error})
+            return
+
+        if users:
+            self.invite_members(group_id, username, users)
+            self.notify_joined(group_id, users, username)
+        self.reply(conn, message, {'type': 'invite_response', 'status': 'success', 'group_id': group_id, 'users': users})
+
+    def handle_join_chat(self, conn, message):
+        """加入一个已存在的聊天组"""
+        username = conn.username
+        group_id = message.get('group_id')
+
+        error = None
+        if not self.registry.group_exists(group_id):
+            error = '聊天组不存在'
+        elif self.registry.is_member(group_id, username):
+            error = '您已在该聊天组中'
+        elif self.registry.group_size(group_id) >= MAX_GROUP_SIZE:
+            error = f'聊天组最多 {MAX_GROUP_SIZE} 人'
+        if error:
+            self.reply(conn, message, {'type': 'join_chat_response', 'status': 'error', 'group_id': group_id, 'message': error})
+            return
+
+        self.add_group_members(group_id, [username])
+        response = {
+            'type': 'join_chat_response',
+            'status': 'success',
+            'group_id': group_id
+        }
+        response.update(self.member_info(group_id))
+        self.reply(conn, message, response)
+        self.notify_joined(group_id, [username], username)
+
+    def notify_joined(self, group_id, users, sender):
+        """通知组内其他成员有新成员加入"""
+        notify_message = {
+            'type': 'user_joined',
+            'group_id': group_id,
+            'users': users,
+            'message': f'{user_list_text(users)} 加入了聊天'
+        }
+        joined = set(users)
+        conns, absent = self.registry.fanout(group_id)
+        self.send_to_connections([c for c in conns if c.username not in joined], notify_message, skip=sender)
+        remote = [u for u in absent if u not in joined and u != sender]
+        if remote:
+            self.deliver(remote, notify_message)
+
+    def handle_chat_message(self, conn, message):
+        """发送聊天消息"""
+        group_id = message.get('group_id')
+        content = message.get('content')
+
+        if not self.registry.group_exists(group_id):
+            response = {
+                'type': 'error',
+                'message': '聊天组不存在'
+            }
+            self.reply(conn, message, response)
+            return
+
+        # 构建消息并广播
+        broadcast_message = {
+            'type': 'chat_message',
+            'group_id': group_id,
+            'from_user': conn.username,
+            'content': content,
+            'timestamp': time.time()
+        }
+        if self.history is not None:
+            try:
+                broadcast_message['seq'] = self.history.append(group_id, broadcast_message)
+            except ValueError as e:
+                self.reply(conn, message, {'type': 'error', 'message': f'消息未发送: {e}'})
+                return
+        self.broadcast_to_group(group_id, broadcast_message, conn.username)
+
+    def handle_leave_chat(self, conn, message):
+        """离开聊天组"""
+        username = conn.username
+        group_id = message.get('group_id')
+        if self.registry.is_member(group_id, username):
+            if self.remove_group_member(group_id, username):
+                # 通知组内其他用户
+                notify_message = {
+                    'type': 'user_left',
+                    'group_id': group_id,
+                    'username': username,
+                    'message': f'{username} 已离开聊天'
+                }
+                self.broadcast_to_group(group_id, notify_message)
 
-            print(f"用户 {username} ({client_address}) 已连接")
+    def handle_history(self, conn, message):
+        """查询聊天记录：最近 limit 条，since_seq 之后的 limit 条，或 before_seq 之前的 limit 条（向前翻页）"""
+        group_id = message.get('group_id')
+        limit = message.get('limit', 50)
+        since_seq = message.get('since_seq')
+        before_seq = message.get('before_seq')
 
-            # 2. 处理客户端消息
+        error = None
+        if self.history is None:
+            error = '服务器未启用聊天记录'
+        elif not self.registry.is_member(group_id, conn.username):
+            error = '您不在该聊天组中'
+        elif (not isinstance(limit, int) or not (since_seq is None or isinstance(since_seq, int))
+              or not (before_seq is None or isinstance(before_seq, int))
+              or (since_seq or 0) < 0 or (before_seq or 0) < 0):
+            error = '无效的聊天记录请求'
+        if error:
+            self.reply(conn, message, {'type': 'history_response', 'status': 'error', 'group_id': group_id, 'message': error})
+            return
+
+        limit = max(0, min(limit, MAX_HISTORY))
+        if since_seq is not None:
+            messages = self.history.read_since(group_id, since_seq, limit)
+        elif before_seq is not None:
+            messages = self.history.read_before(group_id, before_seq, limit)
+        else:
+            messages = self.history.read_last(group_id, limit)
+        response = {
+            'type': 'history_response',
+            'status': 'success',
+            'group_id': group_id,
+            'messages': messages
+        }
+        if before_seq is not None:
+            response['before_seq'] = before_seq
+        self.reply(conn, message, response)
+
+    def handle_file_offer(self, conn, message):
+        """开始向聊天组上传文件：分配流ID，客户端随后按窗口发送数据块帧（空文件发送一个空数据块）"""
+        group_id = message.get('group_id')
+        name = message.get('name')
+        size = message.get('size')
+
+        error = None
+        if self.files is None:
+            error = '服务器未启用文件传输'
+        elif not self.registry.is_member(group_id, conn.username):
+            error = '您不在该聊天组中'
+        elif not isinstance(name, str) or not os.path.basename(name) or not isinstance(size, int) or size < 0:
+            error = '无效的文件信息'
+        elif size > self.files.max_size:
+            error = f'文件不能超过 {self.files.max_size} 字节'
+        if error:
+            self.reply(conn, message, {'type': 'file_offer_response', 'status': 'error', 'message': error})
+            return
+
+        upload = self.files.create(os.path.basename(name), size, group_id, conn.username)
+        stream = next(conn.stream_ids)
+        conn.streams[stream] = upload
+        self.reply(conn, message, {
+            'type': 'file_offer_response',
+            'status': 'success',
+            'stream': stream,
+            'file_id': upload.file_id,
+            'chunk_size': CHUNK_SIZE,
+            'window': WINDOW_CHUNKS
+        })
+
+    def handle_chunk(self, conn, payload):
+        """收到一个上传数据块帧"""
+        try:
+            stream, offset, data = parse_chunk(payload)
+        except ValueError as e:
+            print(f"从客户端 {conn.username} 接收到无效数据块: {e}")
+            self.metrics.incr('decode_errors')
+            return
+        upload = conn.streams.get(stream)
+        if not isinstance(upload, Upload):
+            # 已因出错而取消的上传，发送方在途的数据块直接丢弃
+            return
+        self.receive_chunk(conn, stream, upload, offset, data)
+
+    def receive_chunk(self, conn, stream, upload, offset, data):
+        """写入数据块，每收到半个窗口确认一次，收完后通知组内成员"""
+        try:
+            done = upload.write(offset, data)
+        except (ValueError, OSError) as e:
+            upload.abort()
+            del conn.streams[stream]
+            self.send_to(conn, {'type': 'file_ack', 'stream': stream, 'status': 'error', 'message': str(e)})
+            return
+        self.metrics.incr('file_bytes_in', len(data))
+        if not done:
+            if upload.received - upload.acked >= CHUNK_SIZE * WINDOW_CHUNKS // 2:
+                upload.acked = upload.received
+                self.send_to(conn, {'type': 'file_ack', 'stream': stream, 'received': upload.received})
+            return
+
+        del conn.streams[stream]
+        self.send_to(conn, {
+            'type': 'file_ack',
+            'stream': stream,
+            'status': 'success',
+            'received': upload.received,
+            'file_id': upload.file_id
+        })
+        print(f"用户 {conn.username} 向聊天组 {upload.meta['group_id']} 上传了文件 {upload.meta['name']}（{upload.size} 字节）")
+        notice = dict(upload.meta, type='file_shared', timestamp=time.time())
+        self.broadcast_to_group(upload.meta['group_id'], notice, conn.username)
+
+    def handle_file_get(self, conn, message):
+        """下载文件：回复文件信息和流ID，随后按窗口发送数据块帧"""
+        file_id = message.get('file_id')
+        opened = self.files.open(file_id) if self.files is not None else None
+
+        error = None
+        if self.files is None:
+            error = '服务器未启用文件传输'
+        elif opened is None:
+            error = '文件不存在'
+        elif not self.registry.is_member(opened[0].get('group_id'), conn.username):
+            opened[1].close()
+            error = '您不在该文件所在的聊天组中'
+        if error:
+            self.reply(conn, message, {'type': 'file_get_response', 'status': 'error', 'file_id': file_id, 'message': error})
+            return
+
+        meta, file = opened
+        download = Download(file, os.fstat(file.fileno()).st_size)
+        stream = next(conn.stream_ids)
+        conn.streams[stream] = download
+        self.reply(conn, message, {
+            'type': 'file_get_response',
+            'status': 'success',
+            'stream': stream,
+            'file_id': file_id,
+            'name': meta['name'],
+            'size': download.size,
+            'group_id': meta['group_id'],
+            'chunk_size': CHUNK_SIZE,
+            'window': WINDOW_CHUNKS
+        })
+        if download.done:
+            # 空文件没有数据块，接收方也不会确认
+            del conn.streams[stream]
+            download.close()
+        else:
+            self.send_chunks(conn, stream, download)
+
+    def handle_file_ack(self, conn, message):
+        """下载方确认收到的字节数，窗口腾出空间后继续发送；确认收完时关闭文件"""
+        stream = message.get('stream')
+        download = conn.streams.get(stream)
+        received = message.get('received')
+        if isinstance(download, Download) and isinstance(received, int):
+            download.acked = max(download.acked, min(received, download.sent))
+            if download.done:
+                # 接收方已收到全部数据，所有 FileRegion 都已发送完毕
+                del conn.streams[stream]
+                download.close()
+            else:
+                self.send_chunks(conn, stream, download)
+
+    def send_chunks(self, conn, stream, download):
+        """把窗口内的数据块作为 FileRegion 放入发送队列，内容由发送方用 sendfile 直接写出"""
+        window = CHUNK_SIZE * WINDOW_CHUNKS
+        while download.sent < download.size and download.sent - download.acked < window and not conn.closed:
+            count = min(CHUNK_SIZE, download.size - download.sent)
+            region = FileRegion(chunk_header(stream, download.sent, count), download.file, download.sent, count)
+            download.sent += count
+            self.metrics.incr('file_bytes_out', count)
+            self.send_frame(conn, region)
+
+    def close_streams(self, conn):
+        """连接关闭、发送方不再使用队列中的 FileRegion 之后调用：丢弃没收完的上传，关闭没发完的下载的文件"""
+        streams, conn.streams = conn.streams, {}
+        for transfer in streams.values():
+            if isinstance(transfer, Upload):
+                transfer.abort()
+            else:
+                transfer.close()
+
+    def handle_heartbeat(self, conn, message):
+        """心跳包，保持连接"""
+        response = {'type': 'heartbeat_ack'}
+        self.reply(conn, message, response)
+
+    def remove_client(self, conn):
+        """清理已注册用户的资源"""
+        if self.capture is not None:
+            self.capture.disconnect(conn.capture_id)
+        username = conn.username
+        # 注销后发给该用户的消息进入离线信箱，他仍是原来各组的成员
+        if username is None or not self.registry.unregister(username, conn):
+            return
+
+        # 通知所有聊天组该用户已离线（上下线通知不放入其他离线成员的信箱）
+        for group_id in self.registry.groups_of(username):
+            notify_message = {
+                'type': 'user_offline',
+                'group_id': group_id,
+                'username': username,
+                'message': f'{username} 已离线'
+            }
+            self.broadcast_to_group(group_id, notify_message, username, queue_offline=False)
+
+        if self.bus is not None:
+            self.bus.publish({'op': 'user_offline', 'username': username})
+
+        print(f"用户 {username} 已断开连接")
+
+    def handle_bus_event(self, event):
+        """应用其他分片经总线发来的事件"""
+        op = event.get('op')
+        if op == 'deliver':
+            self.deliver_local([u for u in event['users'] if u in self.registry], event['message'])
+        elif op == 'user_online':
+            self.remote_users[event['username']] = event['shard']
+        elif op == 'user_offline':
+            self.remote_users.pop(event['username'], None)
+        elif op == 'group_add':
+            self.add_group_members(event['group_id'], event['users'], publish=False)
+        elif op == 'group_remove':
+            self.remove_group_member(event['group_id'], event['username'], publish=False)
+        elif op == 'kick':
+            # 同名用户已在其他分片注册
+            conn = self.registry.get(event['username'])
+            if conn is not None:
+                self.send_to(conn, {'type': 'error', 'message': '用户名已被使用'})
+                self.disconnect(conn)
+
+    def bus_loop(self):
+        """线程模式下读取总线事件的线程"""
+        try:
             while True:
-                try:
-                    data = client_socket.recv(4096).decode('utf-8')
-                    if not data:
-                        break
+                events = self.bus.read()
+                if events is None:
+                    break
+                for event in events:
+                    self.handle_bus_event(event)
+        except OSError:
+            pass
+        # 各分片不能脱离总线独立运行（聊天组和用户名不再同步），让主线程从 accept 中断出来并退出
+        print("分片总线已断开，本分片退出")
+        signal.pthread_kill(threading.main_thread().ident, signal.SIGTERM)
+
+    def read_bus(self):
+        """事件循环模式下读取总线事件"""
+        try:
+            events = self.bus.read()
+        except OSError:
+            events = None
+        if events is None:
+            print("分片总线已断开，本分片退出")
+            raise KeyboardInterrupt
+        for event in events:
+            self.handle_bus_event(event)
+
+    def handle_frames(self, conn, frames):
+        """处理一次读取得到的所有帧，连接需要关闭时返回 False"""
+        if self.capture is not None:
+            self.capture.frames(conn.capture_id, frames)
+        for payload in frames:
+            if is_chunk(payload) and conn.username is not None:
+                self.handle_chunk(conn, payload)
+                if conn.closed:
+                    return False
+                continue
+            try:
+                message = decode_message(payload)
+            except ValueError:
+                print(f"从客户端 {conn.username or conn.address} 接收到无效JSON数据")
+                self.metrics.incr('decode_errors')
+                continue
+            self.metrics.add((('messages_in', self.message_label(message.get('type'))), 1), ('bytes_in', len(payload)))
+
+            if conn.username is None:
+                # 第一条消息必须是注册信息
+                if not self.register_client(conn, message):
+                    return False
+            else:
+                self.process_message(conn, message)
+
+            if conn.closed:
+                return False
+        return True
 
-                    message = json.loads(data)
-                    msg_type = message.get('type')
-
-                    if msg_type == 'create_chat':
-                        # 创建新的聊天请求
-                        target_user = message.get('target_user')
-                        if target_user not in self.clients:
-                            response = {
-                                'type': 'create_chat_response',
-                                'status': 'error',
-                                'message': f'用户 {target_user} 不存在或不在线'
-                            }
-                            client_socket.send(json.dumps(response).encode('utf-8'))
-                        else:
-                            # 创建新的聊天组
-                            group_id = self.generate_group_id()
-                            self.chat_groups[group_id] = {username, target_user}
-                            self.user_groups[username].add(group_id)
-                            self.user_groups[target_user].add(group_id)
-
-                            # 通知发起者
-                            initiator_response = {
-                                'type': 'create_chat_response',
-                                'status': 'success',
-                                'group_id': group_id,
-                                'target_user': target_user,
-                                'message': f'与 {target_user} 的聊天已创建'
-                            }
-                            client_socket.send(json.dumps(initiator_response).encode('utf-8'))
-
-                            # 通知目标用户
-                            target_response = {
-                                'type': 'chat_invitation',
-                                'group_id': group_id,
-                                'from_user': username,
-                                'message': f'{username} 想与您聊天'
-                            }
-                            target_socket = self.clients[target_user][0]
-                            target_socket.send(json.dumps(target_response).encode('utf-8'))
-
-                    elif msg_type == 'chat_message':
-                        # 发送聊天消息
-                        group_id = message.get('group_id')
-                        content = message.get('content')
-
-                        if group_id not in self.chat_groups:
-                            response = {
-                                'type': 'error',
-                                'message': '聊天组不存在'
-                            }
-                            client_socket.send(json.dumps(response).encode('utf-8'))
-                        else:
-                            # 构建消息并广播
-                            broadcast_message = {
-                                'type': 'chat_message',
-                                'group_id': group_id,
-                                'from_user': username,
-                                'content': content,
-                                'timestamp': time.time()
-                            }
-                            self.broadcast_to_group(group_id, json.dumps(broadcast_message), username)
-
-                    elif msg_type == 'leave_chat':
-                        # 离开聊天组
-                        group_id = message.get('group_id')
-                        if group_id in self.chat_groups and username in self.chat_groups[group_id]:
-                            self.chat_groups[group_id].remove(username)
-                            self.user_groups[username].remove(group_id)
-
-                            # 如果组内没有用户了，删除该组
-                            if not self.chat_groups[group_id]:
-                                del self.chat_groups[group_id]
-                            else:
-                                # 通知组内其他用户
-                                notify_message = {
-                                    'type': 'user_left',
-                                    'group_id': group_id,
-                                    'username': username,
-                                    'message': f'{username} 已离开聊天'
-                                }
-                                self.broadcast_to_group(group_id, json.dumps(notify_message))
-
-                    elif msg_type == 'heartbeat':
-                        # 心跳包，保持连接
-                        response = {'type': 'heartbeat_ack'}
-                        client_socket.send(json.dumps(response).encode('utf-8'))
-
-                except json.JSONDecodeError:
-                    print(f"从客户端 {username} 接收到无效JSON数据")
-                    continue
-                except Exception as e:
-                    print(f"处理客户端 {username} 消息时出错: {e}")
+    def write_loop(self, conn):
+        """线程模式下的发送线程：批量取出发送队列中的帧写入套接字"""
+        try:
+            while True:
+                frames = conn.queue.get_batch()
+                if not frames:
+                    break
+                sendall_frames(conn.sock, frames)
+        except OSError as e:
+            if not conn.closed:
+                print(f"向 {conn.username or conn.address} 发送数据失败: {e}")
+                self.disconnect(conn)
+
+    def handle_client(self, client_socket, client_address):
+        """处理客户端连接（线程模式）"""
+        conn = self.new_connection(client_socket, client_address)
+        writer_thread = threading.Thread(target=self.write_loop, args=(conn,))
+        writer_thread.daemon = True
+        writer_thread.start()
+        try:
+            while True:
+                data = client_socket.recv(RECV_SIZE)
+                if not data:
+                    break
+                conn.last_seen = time.monotonic()
+                if not self.handle_frames(conn, conn.decoder.feed(data)):
                     break
 
+        except FrameError as e:
+            print(f"客户端 {conn.username or client_address} 发送了无法解析的数据: {e}")
+            self.metrics.incr('frame_errors')
         except Exception as e:
             print(f"处理客户端连接时出错: {e}")
         finally:
             # 清理用户资源
-            if username in self.clients:
-                # 通知所有聊天组该用户已离线
-                for group_id in list(self.user_groups[username]):
-                    if group_id in self.chat_groups:
-                        self.chat_groups[group_id].remove(username)
-
-                        # 如果组内没有用户了，删除该组
-                        if not self.chat_groups[group_id]:
-                            del self.chat_groups[group_id]
-                        else:
-                            # 通知组内其他用户
-                            notify_message = {
-                                'type': 'user_offline',
-                                'group_id': group_id,
-                                'username': username,
-                                'message': f'{username} 已离线'
-                            }
-                            self.broadcast_to_group(group_id, json.dumps(notify_message))
-
-                # 移除用户信息
-                del self.clients[username]
-                del self.user_groups[username]
-
-                print(f"用户 {username} 已断开连接")
+            if self.idle_wheel is not None:
+                self.idle_wheel.remove(conn)
+            self.remove_client(conn)
 
+            # 等发送线程把队列中剩余的帧（例如注册失败的响应）发完
+            conn.queue.close()
+            writer_thread.join(timeout=1.0)
             try:
                 client_socket.close()
             except:
                 pass
+            # 套接字关闭后发送线程不会再用 sendfile 读下载的文件，才能关闭它们
+            self.close_streams(conn)
+            self.release_connection()
 
-    def run(self):
-        """运行服务器"""
+    def flush_connection(self, conn):
+        """事件循环模式下尽量发送连接的待发数据，发不完时关注可写事件"""
+        if conn.closed:
+            return
+        corked = False
         try:
             while True:
+                if not conn.out_frames:
+                    conn.out_frames = conn.queue.pop_batch()
+                    if not conn.out_frames:
+                        break
+                if not corked and len(conn.out_frames) > IOV_MAX:
+                    # 一次 sendmsg 写不完，塞住套接字直到这一批都交给内核
+                    set_cork(conn.sock, True)
+                    corked = True
+                sent = send_frames(conn.sock, conn.out_frames)
+                conn.out_frames = advance(conn.out_frames, sent)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f"向 {conn.username or conn.address} 发送数据失败: {e}")
+            self.schedule_close(conn)
+            return
+        finally:
+            if corked:
+                set_cork(conn.sock, False)
+
+        events = selectors.EVENT_READ
+        if conn.out_frames or conn.queue:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(conn.sock).events != events:
+            self.selector.modify(conn.sock, events, conn)
+
+    def schedule_close(self, conn):
+        """延迟到本轮事件处理结束后再关闭连接，避免在广播过程中修改组成员"""
+        if not conn.closed:
+            conn.closed = True
+            conn.queue.close(discard=True)
+            self.pending_close.append(conn)
+
+    def close_pending(self):
+        """关闭本轮被标记的连接"""
+        while self.pending_close:
+            conn = self.pending_close.pop()
+            try:
+                self.selector.unregister(conn.sock)
+            except (KeyError, ValueError):
+                pass
+            if self.idle_wheel is not None:
+                self.idle_wheel.remove(conn)
+            self.remove_client(conn)
+            try:
+                conn.sock.close()
+            except OSError:
+                pass
+            self.close_streams(conn)
+            self.release_connection()
+
+    def accept_ready(self):
+        """接受所有已就绪的新连接"""
+        while True:
+            try:
                 client_socket, client_address = self.server_socket.accept()
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, client_address)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # 例如文件描述符耗尽，等下一轮再试
+                print(f"接受连接失败: {e}")
+                return
+            if not self.admit(client_socket):
+                continue
+            client_socket.setblocking(False)
+            conn = self.new_connection(client_socket, client_address)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def read_ready(self, conn):
+        """读取一个连接上到达的数据，并处理其中所有完整的帧"""
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.schedule_close(conn)
+            return
+        if not data:
+            self.schedule_close(conn)
+            return
+        conn.last_seen = time.monotonic()
+
+        try:
+            if not self.handle_frames(conn, conn.decoder.feed(data)):
+                self.schedule_close(conn)
+        except FrameError as e:
+            print(f"客户端 {conn.username or conn.address} 发送了无法解析的数据: {e}")
+            self.metrics.incr('frame_errors')
+            self.schedule_close(conn)
+        except Exception as e:
+            print(f"处理客户端 {conn.username} 消息时出错: {e}")
+            self.schedule_close(conn)
+
+    def run_event_loop(self):
+        """单线程事件循环：所有连接由一个 selectors 选择器驱动"""
+        raise_open_file_limit()
+        self.server_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        if self.bus is not None:
+            self.selector.register(self.bus.sock, selectors.EVENT_READ, self.bus)
+        idle_timeout = self.idle_wheel.tick if self.idle_wheel is not None else None
+        try:
+            while True:
+                select_timeout = idle_timeout
+                if self.coalescing:
+                    select_timeout = min(select_timeout or self.coalesce_window, self.coalesce_window)
+                for key, mask in self.selector.select(select_timeout):
+                    conn = key.data
+                    if conn is None:
+                        self.accept_ready()
+                        continue
+                    if conn is self.bus:
+                        self.read_bus()
+                        continue
+                    if conn.closed:
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.read_ready(conn)
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush_connection(conn)
+                if self.coalescing:
+                    self.flush_coalesced()
+                if self.idle_wheel is not None:
+                    self.reap_idle()
+                self.close_pending()
+        finally:
+            for key in list(self.selector.get_map().values()):
+                if isinstance(key.data, ClientConnection):
+                    self.schedule_close(key.data)
+            self.close_pending()
+            self.selector.close()
+
+    def run_threaded(self):
+        """每个连接一个线程"""
+        if self.bus is not None:
+            bus_thread = threading.Thread(target=self.bus_loop)
+            bus_thread.daemon = True
+            bus_thread.start()
+        if self.idle_wheel is not None:
+            reap_thread = threading.Thread(target=self.reap_loop)
+            reap_thread.daemon = True
+            reap_thread.start()
+        while True:
+            client_socket, client_address = self.server_socket.accept()
+            if not self.admit(client_socket):
+                continue
+            client_thread = threading.Thread(
+                target=self.handle_client,
+                args=(client_socket, client_address)
+            )
+            client_thread.daemon = True
+            client_thread.start()
+
+    def run(self):
+        """运行服务器"""
+        try:
+            if self.mode == 'eventloop':
+                self.run_event_loop()
+            else:
+                self.run_threaded()
         except KeyboardInterrupt:
             print("服务器正在关闭...")
         finally:
             self.server_socket.close()
+            if self.bus is not None:
+                self.bus.close()
+            if self.history is not None:
+                self.history.close()
+            if self.capture is not None:
+                self.capture.close()
+            if self.stats_server is not None:
+                self.stats_server.shutdown()
+                self.stats_server.server_close()
             print("服务器已关闭")
 
 
+def raise_open_file_limit():
+    """把可打开文件数的软限制提高到硬限制，以便容纳上万个连接"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def server_options(args):
+    """命令行参数 -> ChatServer 构造参数"""
+    return {
+        'host': args.host,
+        'port': args.port,
+        'mode': args.mode,
+        'backlog': socket.SOMAXCONN if args.mode == 'eventloop' else 100,
+        'queue_size': args.queue_size,
+        'queue_policy': args.queue_policy,
+        'history_dir': args.history_dir,
+        'files_dir': args.files_dir,
+        'max_file_size': args.max_file_size,
+        'capture_path': args.capture,
+        'idle_timeout': args.idle_timeout,
+        'coalesce_window': args.coalesce_ms / 1000,
+        'coalesce_bytes': args.coalesce_bytes,
+        'tcp_nodelay': args.tcp_nodelay,
+        'mailbox_size': args.mailbox_size,
+        'rate_limits': args.rate_limits,
+        'max_connections': args.max_connections,
+        'accept_rate': args.accept_rate,
+        'stats_host': args.stats_host,
+        'stats_port': args.stats_port,
+        'stats_interval': args.stats_interval,
+    }
+
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_shard(options, shard_index, shards, bus_path):
+    """分片工作进程入口"""
+    # 收到 SIGTERM（主进程关闭或总线断开）时与 Ctrl+C 一样正常关闭，写完聊天记录和抓包文件
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    if options['stats_port']:
+        options = dict(options, stats_port=options['stats_port'] + shard_index)
+    if options['capture_path']:
+        # 每个分片写自己的抓包文件，重放时一起传给 08-Replay.py
+        options = dict(options, capture_path=f"{options['capture_path']}.{shard_index}")
+    server = ChatServer(shard_index=shard_index, shards=shards, bus_path=bus_path, **options)
+    server.run()
+
+
+def run_sharded(options, shards):
+    """主进程运行总线代理，并启动 shards 个监听同一端口的分片进程"""
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    broker = Broker(bus_path)
+    workers = [
+        multiprocessing.Process(target=run_shard, args=(options, index, shards, bus_path), daemon=True)
+        for index in range(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    # 分片进程启动后再安装：主进程收到 SIGTERM 时也要结束所有分片并删除总线目录
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    print(f"已启动 {shards} 个分片进程")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        print("服务器正在关闭...")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(timeout=2.0)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="聊天服务器")
+    parser.add_argument('--host', default='0.0.0.0', help="监听地址")
+    parser.add_argument('--port', type=int, default=9999, help="监听端口")
+    parser.add_argument('--mode', choices=['thread', 'eventloop'], default='thread',
+                        help="thread: 每个连接一个线程; eventloop: 单线程事件循环，适合大量并发连接")
+    parser.add_argument('--queue-size', type=int, default=1000, help="每个连接发送队列的最大帧数")
+    parser.add_argument('--queue-policy', choices=POLICIES, default=DISCONNECT,
+                        help="发送队列满时的策略（block 仅用于 thread 模式）")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="分片进程数，大于 1 时多个进程通过 SO_REUSEPORT 共享端口。会话和重放环只保存在"
+                             "各分片的内存中，而重连会被内核分到任意一个分片，因此断线续传和离线消息只在"
+                             "重连恰好落到原分片时有效，否则按新会话注册")
+    parser.add_argument('--history-dir', help="聊天记录日志目录，不指定则不保存聊天记录")
+    parser.add_argument('--files-dir', help="上传文件的保存目录，不指定则不支持文件传输（多分片时共用）")
+    parser.add_argument('--max-file-size', type=int, default=MAX_FILE_SIZE, help="允许上传的最大文件（字节）")
+    parser.add_argument('--capture', metavar='FILE',
+                        help="把收到的每一帧连同到达时间记录到该文件，供 08-Replay.py 重放（多分片时为 FILE.<分片号>）")
+    parser.add_argument('--idle-timeout', type=float, default=90.0,
+                        help="连接超过该秒数没有任何数据（客户端每 30 秒发一次心跳）即断开，0 表示不检测")
+    parser.add_argument('--mailbox-size', type=int, default=1000,
+                        help="每个用户的重放环（兼离线信箱）保留的消息数，超出时丢弃最旧的，0 表示不保留"
+                             "（多分片时各分片分别保存，见 --shards）")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='TYPE=RATE/BURST',
+                        help="按消息类型限流（每秒令牌数/桶容量），可多次指定，'*' 限制所有类型的总速率，"
+                             "速率为 0 取消该类型的限流；不指定时不限流。'default' 启用推荐规则 " +
+                             ", ".join(f"{t}={r:g}/{b}" for t, (r, b) in DEFAULT_LIMITS.items()))
+    parser.add_argument('--max-connections', type=int, default=0, help="同时打开的连接数上限（每个分片），0 表示不限")
+    parser.add_argument('--accept-rate', type=float, default=0.0, help="每秒最多接受的新连接数（每个分片），0 表示不限")
+    parser.add_argument('--stats-port', type=int, default=0,
+                        help="统计端点端口（/stats 返回 JSON，/metrics 返回文本），多分片时第 i 个分片使用该端口 + i，0 表示不开启")
+    parser.add_argument('--stats-host', default='127.0.0.1', help="统计端点监听地址")
+    parser.add_argument('--stats-interval', type=float, default=0.0, help="每隔这么多秒把统计数据打印为一行 JSON，0 表示不打印")
+    parser.add_argument('--coalesce-ms', type=float, default=0.0,
+                        help="写合并窗口（毫秒）：发往同一连接的消息最多等待这么久后一次写出，0 表示不合并")
+    parser.add_argument('--coalesce-bytes', type=int, default=16384,
+                        help="写合并时攒够这么多字节立即写出，不再等待窗口结束")
+    parser.add_argument('--tcp-nodelay', action=argparse.BooleanOptionalAction, default=True,
+                        help="为客户端连接设置 TCP_NODELAY（关闭 Nagle 算法）")
+    args = parser.parse_args()
+    if args.mode == 'eventloop' and args.queue_policy == BLOCK:
+        parser.error("eventloop 模式不能使用 block 队列策略")
+    if args.shards > 1 and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')):
+        parser.error("当前平台不支持 SO_REUSEPORT 或 Unix 域套接字，无法使用多分片模式")
+    args.rate_limits = {}
+    for spec in args.rate_limit:
+        if spec == 'default':
+            args.rate_limits.update(DEFAULT_LIMITS)
+            continue
+        try:
+            msg_type, rate, burst = parse_limit(spec)
+        except ValueError as e:
+            parser.error(str(e))
+        if rate:
+            args.rate_limits[msg_type] = (rate, burst)
+        else:
+            args.rate_limits.pop(msg_type, None)
+    if args.max_connections < 0 or args.accept_rate < 0:
+        parser.error("连接数上限和接受速率不能为负数")
+    if args.mailbox_size < 0:
+        parser.error("离线信箱大小不能为负数")
+    if args.coalesce_ms < 0 or args.coalesce_bytes < 1:
+        parser.error("写合并窗口不能为负数，字节阈值必须为正数")
+    if args.shards > 1 and args.history_dir:
+        parser.error("聊天记录日志只能由单个服务器进程写入，不能与多分片模式同时使用")
+    return args
+
+
 if __name__ == "__main__":
-    server = ChatServer()
-    server.run()
\ No newline at end of file
+    args = parse_args()
+    if args.shards > 1:
+        run_sharded(server_options(args), args.shards)
+    else:
+        # 08-run.py 等进程管理器用 SIGTERM 停止服务器，与 Ctrl+C 一样正常关闭，写完聊天记录和抓包文件
+        signal.signal(signal.SIGTERM, raise_interrupt)
+        server = ChatServer(**server_options(args))
+        server.run()
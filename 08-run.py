@@ -1,125 +1,232 @@
-import subprocess
-import time
+import argparse
 import os
-import sys
+import select
 import signal
-import atexit
+import socket
+import subprocess
+import sys
+import time
 
 SERVER_FILE = "08-Server.py"  # 服务器脚本文件名
 CLIENT_FILE = "08-Client.py"  # 客户端脚本文件名
 
-# 存储所有进程
-processes = []
-
-
-def cleanup():
-    """清理所有子进程"""
-    print("正在关闭所有进程...")
-    for process in processes:
-        if process.poll() is None:  # 检查进程是否还在运行
-            try:
-                if sys.platform == "win32":
-                    process.terminate()  # Windows 平台使用 terminate
+# 探测服务器端口的间隔（秒）
+PROBE_INTERVAL = 0.05
+
+# 异常退出的进程第一次重启前等待的时间（秒），之后每次翻倍，不超过 MAX_BACKOFF
+RESTART_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+# 进程连续运行超过这么多秒后，重启等待时间恢复为初始值
+STABLE_AFTER = 10.0
+
+# 关闭时等待子进程退出的时间（秒），超时后强制结束
+SHUTDOWN_GRACE = 3.0
+
+IS_WINDOWS = sys.platform == "win32"
+
+
+class Worker:
+    """一个受监管的子进程"""
+
+    def __init__(self, name, argv, restart=True):
+        self.name = name
+        self.argv = argv
+        self.restart = restart  # 异常退出后是否重启
+        self.process = None
+        self.started = 0.0
+        self.backoff = RESTART_BACKOFF
+        self.restart_at = None  # 计划重启的时间（monotonic），None 表示没有计划
+
+    def start(self):
+        if IS_WINDOWS:
+            # Windows平台 - 创建新的控制台窗口
+            self.process = subprocess.Popen(self.argv, creationflags=subprocess.CREATE_NEW_CONSOLE)
+        else:
+            # Unix平台 - 放入独立的进程组，关闭时连同它的子进程一起结束
+            self.process = subprocess.Popen(self.argv, start_new_session=True)
+        self.started = time.monotonic()
+        self.restart_at = None
+        print(f"{self.name} 已启动，PID: {self.process.pid}")
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def signal(self, sig):
+        """向进程（Unix 上是整个进程组）发送信号"""
+        if not self.running:
+            return
+        try:
+            if IS_WINDOWS:
+                if sig == signal.SIGTERM:
+                    self.process.terminate()
                 else:
-                    os.killpg(os.getpgid(process.pid), signal.SIGTERM)  # Unix 平台
-            except:
+                    self.process.kill()
+            else:
+                os.killpg(self.process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def exited(self, now):
+        """进程已退出：需要重启时安排重启时间，返回是否会重启"""
+        code = self.process.returncode
+        if code == 0 or not self.restart:
+            print(f"{self.name} 已退出（退出码 {code}）")
+            return False
+        if now - self.started >= STABLE_AFTER:
+            self.backoff = RESTART_BACKOFF
+        self.restart_at = now + self.backoff
+        print(f"{self.name} 异常退出（退出码 {code}），{self.backoff:.1f} 秒后重启")
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        return True
+
+
+class Supervisor:
+    """启动服务器和客户端，异常退出的进程按退避时间重启
+
+    Unix 上子进程退出时 SIGCHLD 经 set_wakeup_fd 写入一个套接字对，主循环阻塞在
+    select 上，只在有进程退出或到了计划的重启时间时才醒来，不需要定时轮询。
+    """
+
+    def __init__(self, server, clients):
+        self.server = server
+        self.clients = clients
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+
+    @property
+    def workers(self):
+        return [self.server] + self.clients
+
+    def install_signals(self):
+        if IS_WINDOWS:
+            return
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        signal.set_wakeup_fd(self.wakeup_writer.fileno())
+        # 需要安装处理函数（哪怕什么都不做），信号才会写入唤醒套接字
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, self.on_sigterm)
+
+    def on_sigterm(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def wait(self, timeout):
+        """阻塞到有子进程退出或超时"""
+        if self.wakeup_reader is None:
+            # Windows 上没有 SIGCHLD，只能按较短的间隔检查
+            time.sleep(min(timeout, 0.2) if timeout is not None else 0.2)
+            return
+        select.select([self.wakeup_reader], [], [], timeout)
+        try:
+            while self.wakeup_reader.recv(4096):
                 pass
-    print("所有进程已关闭")
-
-
-# 注册退出处理函数
-atexit.register(cleanup)
-
-
-def start_server():
-    """启动服务器进程"""
-    print("正在启动服务器...")
-
-    if sys.platform == "win32":
-        # Windows平台
-        server_process = subprocess.Popen(
-            ["python", SERVER_FILE],
-            creationflags=subprocess.CREATE_NEW_CONSOLE
-        )
-    else:
-        # Unix平台
-        server_process = subprocess.Popen(
-            ["python3", SERVER_FILE],
-            preexec_fn=os.setsid
-        )
-
-    processes.append(server_process)
-    print(f"服务器已启动，PID: {server_process.pid}")
-
-    # 等待服务器启动
-    time.sleep(2)
-    return server_process
-
-
-def start_client(client_number):
-    """启动客户端进程"""
-    print(f"正在启动客户端 {client_number}...")
-
-    if sys.platform == "win32":
-        # Windows平台 - 创建新的控制台窗口
-        client_process = subprocess.Popen(
-            ["python", CLIENT_FILE],
-            creationflags=subprocess.CREATE_NEW_CONSOLE
-        )
-    else:
-        # Unix平台
-        client_process = subprocess.Popen(
-            ["python3", CLIENT_FILE],
-            preexec_fn=os.setsid
-        )
-
-    processes.append(client_process)
-    print(f"客户端 {client_number} 已启动，PID: {client_process.pid}")
-
-    return client_process
-
-
-def main():
-    """主函数"""
-    try:
-        # 首先启动服务器
-        server_process = start_server()
-
-        # 然后启动4个客户端
-        client_processes = []
-        for i in range(1, 5):
-            client_process = start_client(i)
-            client_processes.append(client_process)
-            # 稍微延迟，避免同时启动造成问题
-            time.sleep(1)
-
+        except BlockingIOError:
+            pass
+
+    def wait_until_ready(self, host, port, timeout):
+        """反复连接服务器端口直到成功；服务器先退出或超时时返回 False"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.server.process.poll() is not None:
+                return False
+            try:
+                with socket.create_connection((host, port), timeout=PROBE_INTERVAL * 4):
+                    return True
+            except OSError:
+                time.sleep(PROBE_INTERVAL)
+        return False
+
+    def run(self, host, port, ready_timeout):
+        """启动所有进程并监管，直到服务器正常退出、所有客户端都已关闭或收到中断"""
+        self.install_signals()
+        start = time.monotonic()
+        print("正在启动服务器...")
+        self.server.start()
+        if not self.wait_until_ready(host, port, ready_timeout):
+            print(f"服务器在 {ready_timeout:.0f} 秒内没有开始监听 {host}:{port}")
+            return
+        print(f"服务器已就绪（{time.monotonic() - start:.2f} 秒）")
+
+        # 客户端同时启动，不逐个等待
+        for client in self.clients:
+            client.start()
         print("聊天系统已全部启动！")
         print("按 Ctrl+C 停止所有进程")
 
-        # 保持脚本运行，直到用户中断
         while True:
-            time.sleep(1)
-
-            # 检查服务器是否还在运行
-            if server_process.poll() is not None:
-                print("服务器已停止运行，正在关闭所有客户端...")
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.restart_at is not None and worker.restart_at <= now:
+                    worker.start()
+            pending = [worker.restart_at for worker in self.workers if worker.restart_at is not None]
+            self.wait(max(0.0, min(pending) - time.monotonic()) if pending else None)
+
+            # 被唤醒后逐个 poll（内部是 waitpid(pid, WNOHANG)），收集已退出的进程
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.running and worker.process.poll() is not None:
+                    restarting = worker.exited(now)
+                    if worker is self.server and not restarting:
+                        print("服务器已停止运行，正在关闭所有客户端...")
+                        return
+            if self.clients and not any(client.running or client.restart_at is not None for client in self.clients):
+                print("所有客户端已关闭，正在停止服务器...")
+                return
+
+    def shutdown(self):
+        """先发送 SIGTERM，宽限期内没有退出的进程再强制结束"""
+        print("正在关闭所有进程...")
+        for worker in self.workers:
+            worker.restart_at = None
+            worker.signal(signal.SIGTERM)
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        while True:
+            running = [worker for worker in self.workers if worker.running and worker.process.poll() is None]
+            remaining = deadline - time.monotonic()
+            if not running or remaining <= 0:
                 break
+            self.wait(remaining)
+        for worker in running:
+            worker.signal(signal.SIGKILL if not IS_WINDOWS else signal.SIGTERM)
+            worker.process.wait()
+        print("所有进程已关闭")
 
-            # 检查客户端是否还在运行
-            clients_running = 0
-            for i, process in enumerate(client_processes):
-                if process.poll() is None:
-                    clients_running += 1
 
-            if clients_running == 0:
-                print("所有客户端已关闭，正在停止服务器...")
-                break
+def parse_args():
+    parser = argparse.ArgumentParser(description="启动并监管聊天服务器和客户端，未识别的参数原样传给服务器")
+    parser.add_argument('--clients', type=int, default=4, help="启动的客户端数")
+    parser.add_argument('--headless', action='store_true', help="启动无界面客户端（用户名 user1、user2...）")
+    parser.add_argument('--host', default='127.0.0.1', help="探测和连接服务器的地址")
+    parser.add_argument('--port', type=int, default=9999, help="服务器端口（同时传给服务器）")
+    parser.add_argument('--ready-timeout', type=float, default=10.0, help="等待服务器开始监听的最长时间（秒）")
+    parser.add_argument('--no-restart', action='store_true', help="进程异常退出后不重启")
+    return parser.parse_known_args()
 
+
+def main():
+    """主函数"""
+    args, server_args = parse_args()
+    restart = not args.no_restart
+    server = Worker("服务器", [sys.executable, SERVER_FILE, '--port', str(args.port)] + server_args, restart)
+    clients = []
+    for i in range(1, args.clients + 1):
+        argv = [sys.executable, CLIENT_FILE]
+        if args.headless:
+            argv += ['--headless', '--host', args.host, '--port', str(args.port), '--username', f'user{i}']
+        # 图形客户端由用户关闭窗口退出，只有无界面客户端在断线后重启
+        clients.append(Worker(f"客户端 {i}", argv, restart and args.headless))
+
+    supervisor = Supervisor(server, clients)
+    try:
+        supervisor.run(args.host, args.port, args.ready_timeout)
     except KeyboardInterrupt:
-        print("\n检测到键盘中断，正在关闭所有进程...")
+        print("\n检测到中断，正在关闭所有进程...")
     finally:
-        cleanup()
+        supervisor.shutdown()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
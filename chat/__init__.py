@@ -0,0 +1 @@
+"""08 聊天系统中服务器与客户端共用的模块"""
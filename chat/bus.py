@@ -0,0 +1,191 @@
+"""多进程分片模式下的进程间消息总线
+
+每个分片（工作进程）通过 Unix 域套接字连接到主进程中的 Broker。
+分片发布的事件默认转发给所有其他分片；带 'to_shard' 的事件只转发给指定分片。
+Broker 同时维护全局的 用户名 -> 分片 目录，用来裁决不同分片上的同名注册。
+"""
+import selectors
+import socket
+import threading
+import time
+
+from chat.outbound import OutboundQueue, advance, send_frames
+from chat.protocol import RECV_SIZE, FrameDecoder, decode_message, encode_message, recv_frames
+
+
+class BusClient:
+    """分片一侧的总线连接"""
+
+    def __init__(self, path, shard, connect_timeout=5.0):
+        self.shard = shard
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.decoder = FrameDecoder()
+        self.lock = threading.Lock()  # 线程模式下多个处理线程会同时发布
+        self.publish({'op': 'hello'})
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def publish(self, event):
+        """发布一个事件（广播给其他分片，或用 'to_shard' 指定目标分片）"""
+        event['shard'] = self.shard
+        frame = encode_message(event)
+        with self.lock:
+            self.sock.sendall(frame)
+
+    def read(self):
+        """读取一批事件；总线断开时返回 None"""
+        frames = recv_frames(self.sock, self.decoder)
+        if frames is None:
+            return None
+        return [decode_message(payload) for payload in frames]
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class _ShardLink:
+    """Broker 中一个分片连接的状态"""
+    __slots__ = ('sock', 'shard', 'decoder', 'queue', 'out_frames')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.shard = None
+        self.decoder = FrameDecoder()
+        # Broker 从不阻塞在某个分片上，慢的分片只会在自己的队列里积压
+        self.queue = OutboundQueue(max_frames=1 << 20)
+        self.out_frames = []
+
+
+class Broker:
+    """在分片之间转发事件的轻量消息代理（单线程事件循环）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.links = {}  # {shard: _ShardLink}
+        self.directory = {}  # {username: shard}
+
+    def serve_forever(self):
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        try:
+            while True:
+                for key, mask in self.selector.select():
+                    link = key.data
+                    if link is None:
+                        self._accept()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._read(link)
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(link)
+        finally:
+            self.selector.close()
+            self.sock.close()
+
+    def _accept(self):
+        sock, _ = self.sock.accept()
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, _ShardLink(sock))
+
+    def _read(self, link):
+        try:
+            data = link.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(link)
+            return
+        for payload in link.decoder.feed(data):
+            self._route(link, decode_message(payload))
+
+    def _route(self, link, event):
+        op = event.get('op')
+        shard = event.get('shard')
+        if op == 'hello':
+            link.shard = shard
+            self.links[shard] = link
+            return
+
+        if op == 'user_online':
+            owner = self.directory.setdefault(event['username'], shard)
+            if owner != shard:
+                # 同名用户已在其他分片注册，后到者被踢下线
+                self._send(link, {'op': 'kick', 'username': event['username'], 'shard': None})
+                return
+        elif op == 'user_offline':
+            if self.directory.get(event['username']) != shard:
+                return
+            del self.directory[event['username']]
+
+        target = event.get('to_shard')
+        if target is not None:
+            if target in self.links:
+                self._send(self.links[target], event)
+            return
+        frame = encode_message(event)
+        for other, other_link in list(self.links.items()):
+            if other != shard:
+                self._send_frame(other_link, frame)
+
+    def _send(self, link, event):
+        self._send_frame(link, encode_message(event))
+
+    def _send_frame(self, link, frame):
+        if link.sock.fileno() == -1:
+            return
+        link.queue.put(frame)
+        self._flush(link)
+
+    def _flush(self, link):
+        try:
+            while True:
+                if not link.out_frames:
+                    link.out_frames = link.queue.pop_batch()
+                    if not link.out_frames:
+                        break
+                link.out_frames = advance(link.out_frames, send_frames(link.sock, link.out_frames))
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(link)
+            return
+        events = selectors.EVENT_READ
+        if link.out_frames or link.queue:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(link.sock).events != events:
+            self.selector.modify(link.sock, events, link)
+
+    def _drop(self, link):
+        """分片进程退出：注销它的连接和它名下的用户"""
+        try:
+            self.selector.unregister(link.sock)
+        except (KeyError, ValueError):
+            pass
+        link.sock.close()
+        if self.links.get(link.shard) is link:
+            del self.links[link.shard]
+        for username, owner in list(self.directory.items()):
+            if owner == link.shard:
+                del self.directory[username]
+                frame = encode_message({'op': 'user_offline', 'username': username, 'shard': owner})
+                for other_link in list(self.links.values()):
+                    self._send_frame(other_link, frame)
@@ -0,0 +1,150 @@
+"""客户端的聊天消息缓存
+
+按聊天组缓存最近的消息，组之间按最近使用的顺序（LRU）淘汰，所有组合计的大小
+不超过 max_bytes（按内容长度估算），单个组最多保留 max_per_group 条。
+切换聊天组时直接从缓存重新绘制；只有翻到缓存中最早的消息之前时，
+才用 before_seq 向服务器请求更早的聊天记录。
+
+服务器启用聊天记录时，广播的消息和聊天记录都带组内序号 seq，缓存按 seq 去重；
+自己发出的消息只在本地回显，没有 seq，由下一次加载的聊天记录替换。
+"""
+from collections import OrderedDict, deque
+
+# 每条缓存消息在内容之外的估算开销（字节）
+ENTRY_OVERHEAD = 100
+
+
+def entry_size(message):
+    return len(str(message.get('content', ''))) + ENTRY_OVERHEAD
+
+
+class _GroupCache:
+    __slots__ = ('messages', 'size', 'loaded', 'added')
+
+    def __init__(self):
+        self.messages = deque()  # 按时间顺序的 (本地序号, 消息字典)
+        self.size = 0
+        self.loaded = False  # 是否已用服务器的聊天记录对齐过
+        self.added = 0  # 累计加入的消息数，用作本地序号
+
+
+class MessageCache:
+    """按聊天组缓存最近消息的 LRU 缓存（只在 UI 主线程中使用，不加锁）"""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_per_group=2000):
+        self.max_bytes = max_bytes
+        self.max_per_group = max_per_group
+        self.groups = OrderedDict()  # {group_id: _GroupCache}，最近使用的在末尾
+        self.size = 0
+
+    def _group(self, group_id):
+        group = self.groups.get(group_id)
+        if group is None:
+            group = self.groups[group_id] = _GroupCache()
+        self.groups.move_to_end(group_id)
+        return group
+
+    def messages(self, group_id):
+        """组内缓存的消息（按时间顺序），同时把该组标记为最近使用"""
+        return [message for _, message in self._group(group_id).messages]
+
+    def is_loaded(self, group_id):
+        group = self.groups.get(group_id)
+        return group is not None and group.loaded
+
+    def oldest_seq(self, group_id):
+        """缓存中最早一条带 seq 的消息的 seq，没有时为 None"""
+        group = self.groups.get(group_id)
+        if group is not None:
+            for _, message in group.messages:
+                if 'seq' in message:
+                    return message['seq']
+        return None
+
+    def has_older(self, group_id):
+        """服务器上是否还有比缓存更早的聊天记录"""
+        oldest = self.oldest_seq(group_id)
+        return self.is_loaded(group_id) and oldest is not None and oldest > 1
+
+    def add(self, group_id, message):
+        """追加一条新消息"""
+        group = self._group(group_id)
+        seq = message.get('seq')
+        if seq is not None and group.messages and group.messages[-1][1].get('seq', 0) >= seq:
+            return  # 已经由聊天记录加载过
+        self._append(group, message)
+        self._trim(group_id)
+
+    def _append(self, group, message):
+        group.messages.append((group.added, message))
+        group.added += 1
+        size = entry_size(message)
+        group.size += size
+        self.size += size
+
+    def mark(self, group_id):
+        """请求聊天记录之前调用，返回值传给 load()"""
+        return self._group(group_id).added
+
+    def load(self, group_id, history, mark):
+        """用服务器返回的最近聊天记录替换缓存
+
+        mark 之后才加入的消息（请求发出后收到或发出的）不一定包含在聊天记录里，予以保留；
+        history 为 None 表示服务器没有聊天记录，只标记为已加载。
+        """
+        group = self._group(group_id)
+        group.loaded = True
+        if history is None:
+            return
+        last = history[-1].get('seq', 0) if history else 0
+        newer = [message for n, message in group.messages
+                 if n >= mark and ('seq' not in message or message['seq'] > last)]
+        self.size -= group.size
+        group.messages.clear()
+        group.size = 0
+        for message in history:
+            self._append(group, message)
+        for message in newer:
+            self._append(group, message)
+        self._trim(group_id)
+
+    def prepend(self, group_id, older):
+        """把更早的一页聊天记录放到缓存开头，返回实际加入的消息"""
+        group = self._group(group_id)
+        oldest = self.oldest_seq(group_id)
+        if oldest is not None:
+            older = [message for message in older if message.get('seq', 0) < oldest]
+        # 向前翻页时单组上限放宽到当前条数加上这一页，较新的消息不会被挤掉
+        for message in reversed(older):
+            group.messages.appendleft((-1, message))
+            size = entry_size(message)
+            group.size += size
+            self.size += size
+        self._trim(group_id, len(group.messages))
+        return older
+
+    def discard(self, group_id):
+        group = self.groups.pop(group_id, None)
+        if group is not None:
+            self.size -= group.size
+
+    def _trim(self, group_id, per_group=None):
+        """先淘汰最久未使用的其他组，仍超出时从 group_id 组的最早消息开始删除"""
+        group = self.groups[group_id]
+        per_group = max(per_group or 0, self.max_per_group)
+        while len(group.messages) > per_group:
+            self.size -= self._pop_oldest(group)
+        while self.size > self.max_bytes and len(self.groups) > 1:
+            oldest_id = next(iter(self.groups))
+            if oldest_id == group_id:
+                break
+            self.discard(oldest_id)
+        while self.size > self.max_bytes and len(group.messages) > 1:
+            self.size -= self._pop_oldest(group)
+
+    @staticmethod
+    def _pop_oldest(group):
+        _, message = group.messages.popleft()
+        size = entry_size(message)
+        group.size -= size
+        return size
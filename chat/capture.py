@@ -0,0 +1,114 @@
+"""服务器入站流量的抓包文件
+
+记录每个连接收到的每一帧及其到达时间，供 08-Replay.py 按原来的节奏重放，
+在不同版本的服务器上得到可重复的负载。文件格式：
+
+    文件头：b'CHATCAP1' [u64 开始时的墙上时间（纳秒）]
+    记录：  [u8 类型][u32 连接号][u64 距开始的纳秒数][u32 长度][数据]
+
+记录类型：OPEN（数据为客户端地址）、FRAME（一帧负载，原样保存，不重新编码）、
+GROUP（数据为服务器为该连接创建的聊天组ID，重放时据此把抓包中的组ID对应到新分配的组ID）、
+CLOSE（连接关闭）。连接号在一个文件内唯一；多分片时每个分片写自己的文件，
+用文件头中的墙上时间对齐。
+"""
+import struct
+import threading
+import time
+
+MAGIC = b'CHATCAP1'
+FILE_HEADER = struct.Struct('!8sQ')
+RECORD = struct.Struct('!BIQI')  # 类型, 连接号, 时间, 数据长度
+
+OPEN = 0
+FRAME = 1
+GROUP = 2
+CLOSE = 3
+
+# 后台线程把缓冲的记录写入文件的间隔（秒）；进程被直接结束时最多丢失这么久的记录
+FLUSH_INTERVAL = 1.0
+
+
+class CaptureWriter:
+    """追加写抓包文件（线程安全）"""
+
+    def __init__(self, path, buffer_size=1024 * 1024, flush_interval=FLUSH_INTERVAL):
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.start = time.monotonic_ns()
+        self.file.write(FILE_HEADER.pack(MAGIC, time.time_ns()))
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.closed = False
+        self.flush_interval = flush_interval
+        flusher = threading.Thread(target=self._flush_loop, name='capture-flush')
+        flusher.daemon = True
+        flusher.start()
+
+    def _write(self, kind, conn_id, data, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        self.file.write(RECORD.pack(kind, conn_id, now - self.start, len(data)))
+        self.file.write(data)
+
+    def open(self, address):
+        """新连接，返回它的连接号"""
+        with self.lock:
+            conn_id = self.next_id
+            self.next_id += 1
+            if not self.closed:
+                self._write(OPEN, conn_id, f"{address[0]}:{address[1]}".encode())
+        return conn_id
+
+    def frames(self, conn_id, frames):
+        """一次读取得到的若干帧，共用同一个到达时间"""
+        now = time.monotonic_ns()
+        with self.lock:
+            if self.closed:
+                return
+            for payload in frames:
+                self._write(FRAME, conn_id, payload, now)
+
+    def group(self, conn_id, group_id):
+        with self.lock:
+            if not self.closed:
+                self._write(GROUP, conn_id, group_id.encode())
+
+    def disconnect(self, conn_id):
+        with self.lock:
+            if not self.closed:
+                self._write(CLOSE, conn_id, b'')
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if self.closed:
+                    return
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.file.close()
+
+
+def read_capture(path):
+    """读取抓包文件，返回 (开始时的墙上时间, [(类型, 连接号, 时间, 数据)])；文件末尾不完整的记录被忽略"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < FILE_HEADER.size:
+        raise ValueError(f"{path} 不是抓包文件")
+    magic, start = FILE_HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} 不是抓包文件")
+    view = memoryview(data)
+    records = []
+    offset = FILE_HEADER.size
+    while offset + RECORD.size <= len(data):
+        kind, conn_id, when, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        records.append((kind, conn_id, when, bytes(view[offset:offset + length])))
+        offset += length
+    return start, records
@@ -0,0 +1,708 @@
+"""无界面的聊天客户端库
+
+协议逻辑（注册、会话续传、聊天组成员、请求与响应的对应）放在与传输方式无关的
+ClientState 中；Client 使用阻塞套接字和一个接收线程，AsyncClient 使用 asyncio。
+两者都可以注册回调接收服务器发来的每一条消息，AsyncClient 还可以用 async for 逐条取出。
+
+请求支持流水线：需要响应的请求带一个递增的 req_id，服务器在响应中原样带回，
+因此可以连续发出许多请求而不必等前一个的响应。请求方法立即返回一个 future，
+结果为响应消息字典，错误响应则以 RequestError 结束。聊天消息和离开聊天没有响应，
+发出即返回。同一用户名断线后再次 connect() 时凭会话令牌续传，只补发漏掉的消息。
+服务器多分片运行时会话只在原分片有效，重连落到其他分片时按新会话注册（resumed 为 False）。
+
+文件以数据块帧（见 chat.transfer）与消息复用同一连接：upload() 按服务器给出的窗口发送，
+download() 把收到的数据块直接写入文件，每收到半个窗口回复一次 file_ack。
+"""
+import asyncio
+import itertools
+import os
+import socket
+import threading
+from concurrent.futures import Future
+
+from chat.codec import CODECS, JSON
+from chat.outbound import MSG_MORE
+from chat.protocol import RECV_SIZE, FrameDecoder, FrameError, decode_message, encode_message, recv_frames
+from chat.transfer import chunk_header, is_chunk, parse_chunk
+
+# 心跳包的发送间隔（秒），应小于服务器的空闲超时
+HEARTBEAT_INTERVAL = 30.0
+
+
+class RegistrationError(Exception):
+    """注册被服务器拒绝"""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code  # 例如 'server_busy'
+
+
+class RequestError(Exception):
+    """请求得到了错误响应"""
+
+    def __init__(self, response):
+        super().__init__(response.get('message', '未知错误'))
+        self.response = response
+
+
+class _Transfer:
+    """一个正在进行的文件上传或下载"""
+    __slots__ = ('response', 'file', 'size', 'window', 'position', 'acked', 'future', 'wakeup')
+
+    def __init__(self, response, file, future, wakeup=None):
+        self.response = response  # file_offer_response 或 file_get_response
+        self.file = file  # 下载时写入的文件
+        self.size = response.get('size', 0)
+        self.window = response['chunk_size'] * response['window']
+        self.position = 0  # 已收到的字节数（下载）
+        self.acked = 0  # 已确认的字节数
+        self.future = future
+        self.wakeup = wakeup  # 上传方等待窗口腾出空间的事件
+
+
+class ClientState:
+    """与传输方式无关的客户端状态"""
+
+    def __init__(self, username, codecs=CODECS):
+        self.username = username
+        self.codecs = list(codecs)
+        self.codec = JSON  # 与服务器协商的消息编码
+        self.session = None  # 服务器签发的会话令牌
+        self.last_seq = None  # 最后收到的 event_seq
+        self.groups = {}  # {group_id: 成员用户名列表}，大组的成员列表可能不完整
+        self.req_ids = itertools.count(1)
+        self.pending = {}  # {req_id: 等待响应的 future}
+        self.uploads = {}  # {流ID: _Transfer}
+        self.downloads = {}  # {流ID: _Transfer}
+        self.download_requests = {}  # {req_id: (保存路径, future)}
+
+    def register_message(self):
+        message = {'type': 'register', 'username': self.username, 'codecs': self.codecs}
+        if self.session is not None:
+            # 断线重连：只补发漏掉的消息
+            message['session'] = self.session
+            message['last_seq'] = self.last_seq
+        return message
+
+    def registered(self, response):
+        """处理注册响应，注册失败时抛出 RegistrationError"""
+        if response.get('status') != 'success':
+            raise RegistrationError(response.get('message', '未知错误'), response.get('code'))
+        self.codec = response.get('codec', JSON)
+        if not response.get('resumed'):
+            self.last_seq = None
+        self.session = response.get('session')
+        # 断线前加入的聊天组仍然有效
+        self.groups = {group['group_id']: list(group.get('members') or [self.username])
+                       for group in response.get('groups', [])}
+
+    def track(self, message, future):
+        """给请求分配 req_id，响应到达时结束 future"""
+        req_id = next(self.req_ids)
+        message['req_id'] = req_id
+        self.pending[req_id] = future
+        return message
+
+    def untrack(self, message):
+        self.pending.pop(message.get('req_id'), None)
+        self.download_requests.pop(message.get('req_id'), None)
+
+    def track_download(self, message, path, future):
+        """下载请求：响应到达后开始把数据块写入 path，收完时结束 future"""
+        req_id = next(self.req_ids)
+        message['req_id'] = req_id
+        self.download_requests[req_id] = (path, future)
+        return message
+
+    def start_upload(self, response, future, wakeup):
+        transfer = _Transfer(response, None, future, wakeup)
+        self.uploads[response['stream']] = transfer
+        return transfer
+
+    def start_download(self, response, path, future):
+        if response.get('status') != 'success':
+            resolve(future, response)
+            return
+        try:
+            file = open(path, 'wb')
+        except OSError as e:
+            future.set_exception(e)
+            return
+        transfer = _Transfer(response, file, future)
+        if transfer.size == 0:
+            file.close()
+            future.set_result(response)
+        else:
+            self.downloads[response['stream']] = transfer
+
+    def receive_chunk(self, payload):
+        """写入下载的数据块，返回需要回复的 file_ack（不需要时为 None）"""
+        stream, offset, data = parse_chunk(payload)
+        transfer = self.downloads.get(stream)
+        if transfer is None:
+            return None
+        if offset != transfer.position:
+            self.end_download(stream, RequestError({'message': f'数据块偏移 {offset} 与已收到的 {transfer.position} 字节不符'}))
+            return None
+        transfer.file.write(data)
+        transfer.position += len(data)
+        if transfer.position >= transfer.size:
+            self.end_download(stream)
+        elif transfer.position - transfer.acked < transfer.window // 2:
+            return None
+        transfer.acked = transfer.position
+        return {'type': 'file_ack', 'stream': stream, 'received': transfer.position}
+
+    def end_download(self, stream, error=None):
+        transfer = self.downloads.pop(stream)
+        transfer.file.close()
+        if transfer.future.done():
+            return
+        if error is None:
+            transfer.future.set_result(transfer.response)
+        else:
+            transfer.future.set_exception(error)
+
+    def receive(self, message):
+        """根据收到的消息更新状态，返回它所响应的请求的 future（不是响应时为 None）"""
+        msg_type = message.get('type')
+        if 'event_seq' in message:
+            self.last_seq = message['event_seq']
+        success = message.get('status', 'success') == 'success'
+        group_id = message.get('group_id')
+
+        if msg_type == 'create_chat_response' and success:
+            self.groups[group_id] = message.get('members') or [self.username, message.get('target_user')]
+        elif msg_type == 'chat_invitation':
+            self.groups[group_id] = message.get('members') or [self.username, message.get('from_user')]
+        elif msg_type == 'join_chat_response' and success:
+            self.groups[group_id] = message.get('members') or [self.username]
+        elif msg_type == 'user_joined' and group_id in self.groups:
+            users = self.groups[group_id]
+            users.extend(user for user in message.get('users', []) if user not in users)
+        elif msg_type == 'user_left' and group_id in self.groups:
+            # 离线的用户仍是组成员，只有离开才移除
+            users = self.groups[group_id]
+            if message.get('username') in users:
+                users.remove(message.get('username'))
+
+        elif msg_type == 'file_ack' and message.get('stream') in self.uploads:
+            transfer = self.uploads[message['stream']]
+            transfer.acked = max(transfer.acked, message.get('received', 0))
+            if not success or 'file_id' in message:
+                del self.uploads[message['stream']]
+                resolve(transfer.future, message)
+            transfer.wakeup.set()
+
+        req_id = message.get('req_id')
+        if msg_type == 'file_get_response' and req_id in self.download_requests:
+            self.start_download(message, *self.download_requests.pop(req_id))
+            return None
+        return self.pending.pop(req_id, None) if req_id is not None else None
+
+    def fail_pending(self, error):
+        """连接断开：所有还在等待的请求以 error 结束"""
+        pending, self.pending = self.pending, {}
+        futures = list(pending.values()) + [future for _, future in self.download_requests.values()]
+        self.download_requests = {}
+        for stream in list(self.downloads):
+            self.end_download(stream, error)
+        uploads, self.uploads = self.uploads, {}
+        for transfer in uploads.values():
+            futures.append(transfer.future)
+            transfer.wakeup.set()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+
+def resolve(future, response):
+    """用响应结束请求的 future（调用方已取消的忽略）"""
+    if future.done():
+        return
+    if response.get('type') == 'error' or response.get('status') == 'error':
+        future.set_exception(RequestError(response))
+    else:
+        future.set_result(response)
+
+
+def create_chat_message(target_users):
+    if len(target_users) == 1:
+        return {'type': 'create_chat', 'target_user': target_users[0]}
+    return {'type': 'create_chat', 'target_users': list(target_users)}
+
+
+def history_message(group_id, limit, since_seq, before_seq):
+    message = {'type': 'history', 'group_id': group_id, 'limit': limit}
+    if since_seq is not None:
+        message['since_seq'] = since_seq
+    if before_seq is not None:
+        message['before_seq'] = before_seq
+    return message
+
+
+def file_offer_message(group_id, path, size):
+    return {'type': 'file_offer', 'group_id': group_id, 'name': os.path.basename(path), 'size': size}
+
+
+class Client:
+    """阻塞套接字客户端
+
+    消息回调在接收线程中调用，每条消息先结束对应请求的 future，再依次调用回调。
+    """
+
+    def __init__(self, username, codecs=CODECS, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.state = ClientState(username, codecs)
+        self.heartbeat_interval = heartbeat_interval
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.connected = False
+        self.connect_callbacks = []
+        self.message_callbacks = []
+        self.disconnect_callbacks = []
+
+    @property
+    def username(self):
+        return self.state.username
+
+    @property
+    def groups(self):
+        return self.state.groups
+
+    def on_connect(self, callback):
+        """注册 callback(注册响应)，在 connect() 中、接收线程启动之前调用"""
+        self.connect_callbacks.append(callback)
+        return callback
+
+    def on_message(self, callback):
+        """注册 callback(message)，可用作装饰器"""
+        self.message_callbacks.append(callback)
+        return callback
+
+    def on_disconnect(self, callback):
+        """注册 callback()，连接断开（包括主动关闭）后调用"""
+        self.disconnect_callbacks.append(callback)
+        return callback
+
+    def connect(self, host, port, timeout=None):
+        """连接并注册，返回注册响应；注册被拒绝时抛出 RegistrationError"""
+        sock = socket.create_connection((host, port), timeout)
+        try:
+            sock.sendall(encode_message(self.state.register_message()))
+            decoder = FrameDecoder()
+            frames = []
+            while not frames:
+                frames = recv_frames(sock, decoder)
+                if frames is None:
+                    raise ConnectionError("服务器关闭了连接")
+            response = decode_message(frames[0])
+            self.state.registered(response)
+        except BaseException:
+            sock.close()
+            raise
+        sock.settimeout(None)
+
+        self.sock = sock
+        self.connected = True
+        self.stopped.clear()
+        for callback in self.connect_callbacks:
+            callback(response)
+        # 注册响应之后同一批收到的帧（例如补发的消息）交给接收线程处理
+        receive_thread = threading.Thread(target=self.receive_loop, args=(sock, decoder, frames[1:]))
+        receive_thread.daemon = True
+        receive_thread.start()
+        if self.heartbeat_interval:
+            heartbeat_thread = threading.Thread(target=self.heartbeat_loop)
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+        return response
+
+    def receive_loop(self, sock, decoder, frames):
+        try:
+            while True:
+                for payload in frames:
+                    if is_chunk(payload):
+                        self.receive_chunk(payload)
+                        continue
+                    try:
+                        message = decode_message(payload)
+                    except ValueError:
+                        print("接收到无效的消息数据")
+                        continue
+                    self.dispatch(message)
+                frames = recv_frames(sock, decoder)
+                if frames is None:
+                    break
+        except (OSError, FrameError) as e:
+            if self.connected:
+                print(f"接收消息时出错: {e}")
+        self.closed(sock)
+
+    def receive_chunk(self, payload):
+        try:
+            ack = self.state.receive_chunk(payload)
+        except (ValueError, OSError) as e:
+            print(f"处理文件数据时出错: {e}")
+            return
+        if ack is not None:
+            self.post(ack)
+
+    def dispatch(self, message):
+        future = self.state.receive(message)
+        if future is not None:
+            resolve(future, message)
+        for callback in self.message_callbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"处理消息 {message.get('type')} 时出错: {e}")
+
+    def closed(self, sock):
+        """接收线程退出时清理连接"""
+        if sock is not self.sock:
+            return
+        self.connected = False
+        self.stopped.set()
+        sock.close()
+        self.state.fail_pending(ConnectionError("与服务器的连接已断开"))
+        for callback in self.disconnect_callbacks:
+            callback()
+
+    def heartbeat_loop(self):
+        """定期发送心跳包以保持连接"""
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                self.post({'type': 'heartbeat'})
+            except OSError:
+                break
+
+    def write(self, frame):
+        sock = self.sock
+        if not self.connected or sock is None:
+            raise ConnectionError("未连接到服务器")
+        with self.send_lock:
+            sock.sendall(frame)
+
+    def post(self, message):
+        """发出一条不需要响应的消息"""
+        self.write(encode_message(message, self.state.codec))
+
+    def request(self, message):
+        """发出一个需要响应的请求，立即返回 concurrent.futures.Future"""
+        future = Future()
+        self.state.track(message, future)
+        try:
+            self.post(message)
+        except OSError as e:
+            self.state.untrack(message)
+            future.set_exception(e)
+        return future
+
+    def create_chat(self, *target_users):
+        """与一个用户聊天，或与多个用户创建聊天室"""
+        return self.request(create_chat_message(target_users))
+
+    def invite(self, group_id, *users):
+        return self.request({'type': 'invite', 'group_id': group_id, 'target_users': list(users)})
+
+    def join_chat(self, group_id):
+        return self.request({'type': 'join_chat', 'group_id': group_id})
+
+    def history(self, group_id, limit=50, since_seq=None, before_seq=None):
+        """最近 limit 条，since_seq 之后的 limit 条，或 before_seq 之前的 limit 条聊天记录"""
+        return self.request(history_message(group_id, limit, since_seq, before_seq))
+
+    def heartbeat(self):
+        return self.request({'type': 'heartbeat'})
+
+    def send(self, group_id, content):
+        """发送一条聊天消息"""
+        self.post({'type': 'chat_message', 'group_id': group_id, 'content': content})
+
+    def leave_chat(self, group_id):
+        self.post({'type': 'leave_chat', 'group_id': group_id})
+        self.state.groups.pop(group_id, None)
+
+    def upload(self, group_id, path, timeout=None):
+        """把文件上传到聊天组，阻塞到服务器收完，返回最后的 file_ack（含 file_id）
+
+        文件内容用 socket.sendfile 直接从文件写入套接字；发送数据块时持有发送锁，
+        其他线程的消息在两个数据块之间发出。
+        """
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            response = self.request(file_offer_message(group_id, path, size)).result(timeout)
+            transfer = self.state.start_upload(response, Future(), threading.Event())
+            stream, chunk_size = response['stream'], response['chunk_size']
+            offset = 0
+            # 空文件也发送一个空的数据块，服务器收到后才完成上传
+            while offset < size or offset == size == 0:
+                # 窗口已满时等待服务器确认
+                while True:
+                    transfer.wakeup.clear()
+                    if offset - transfer.acked < transfer.window or transfer.future.done():
+                        break
+                    if not transfer.wakeup.wait(timeout):
+                        raise TimeoutError("等待服务器确认超时")
+                if transfer.future.done():
+                    break
+                count = min(chunk_size, size - offset)
+                sock = self.sock
+                if not self.connected or sock is None:
+                    raise ConnectionError("未连接到服务器")
+                with self.send_lock:
+                    sock.sendall(chunk_header(stream, offset, count), MSG_MORE)
+                    if count and sock.sendfile(f, offset, count) != count:
+                        raise OSError("文件在上传过程中被截断")
+                if not size:
+                    break
+                offset += count
+        return transfer.future.result(timeout)
+
+    def download(self, file_id, path):
+        """下载文件保存到 path，立即返回 future，收完时结果为 file_get_response"""
+        future = Future()
+        message = self.state.track_download({'type': 'file_get', 'file_id': file_id}, path, future)
+        try:
+            self.post(message)
+        except OSError as e:
+            self.state.untrack(message)
+            future.set_exception(e)
+        return future
+
+    def close(self):
+        """断开连接；会话令牌保留，之后可以再次 connect() 续传"""
+        sock = self.sock
+        if sock is None:
+            return
+        self.connected = False
+        self.stopped.set()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AsyncClient:
+    """asyncio 客户端
+
+    回调在事件循环中调用；buffer_events 为真时收到的每条消息还会放入队列，
+    用 async for message in client 逐条取出，连接断开后迭代结束。
+    """
+
+    def __init__(self, username, codecs=CODECS, heartbeat_interval=HEARTBEAT_INTERVAL, buffer_events=True):
+        self.state = ClientState(username, codecs)
+        self.heartbeat_interval = heartbeat_interval
+        self.events = asyncio.Queue() if buffer_events else None
+        self.reader = None
+        self.writer = None
+        self.tasks = []
+        self.connected = False
+        self.message_callbacks = []
+
+    @property
+    def username(self):
+        return self.state.username
+
+    @property
+    def groups(self):
+        return self.state.groups
+
+    def on_message(self, callback):
+        """注册 callback(message)，可用作装饰器"""
+        self.message_callbacks.append(callback)
+        return callback
+
+    async def connect(self, host, port):
+        """连接并注册，返回注册响应；注册被拒绝时抛出 RegistrationError"""
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(encode_message(self.state.register_message()))
+            decoder = FrameDecoder()
+            frames = []
+            while not frames:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    raise ConnectionError("服务器关闭了连接")
+                frames = decoder.feed(data)
+            response = decode_message(frames[0])
+            self.state.registered(response)
+        except BaseException:
+            writer.close()
+            raise
+
+        self.reader, self.writer = reader, writer
+        self.connected = True
+        self.tasks = [asyncio.create_task(self.receive_loop(reader, writer, decoder, frames[1:]))]
+        if self.heartbeat_interval:
+            self.tasks.append(asyncio.create_task(self.heartbeat_loop()))
+        return response
+
+    async def receive_loop(self, reader, writer, decoder, frames):
+        try:
+            while True:
+                for payload in frames:
+                    if is_chunk(payload):
+                        self.receive_chunk(payload)
+                        continue
+                    try:
+                        message = decode_message(payload)
+                    except ValueError:
+                        print("接收到无效的消息数据")
+                        continue
+                    self.dispatch(message)
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                frames = decoder.feed(data)
+        except (OSError, FrameError) as e:
+            if self.connected:
+                print(f"接收消息时出错: {e}")
+        finally:
+            if writer is self.writer:
+                self.connected = False
+                writer.close()
+                self.state.fail_pending(ConnectionError("与服务器的连接已断开"))
+                if self.events is not None:
+                    self.events.put_nowait(None)
+
+    def receive_chunk(self, payload):
+        try:
+            ack = self.state.receive_chunk(payload)
+        except (ValueError, OSError) as e:
+            print(f"处理文件数据时出错: {e}")
+            return
+        if ack is not None:
+            self.post(ack)
+
+    def dispatch(self, message):
+        future = self.state.receive(message)
+        if future is not None:
+            resolve(future, message)
+        for callback in self.message_callbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"处理消息 {message.get('type')} 时出错: {e}")
+        if self.events is not None:
+            self.events.put_nowait(message)
+
+    async def heartbeat_loop(self):
+        while self.connected:
+            await asyncio.sleep(self.heartbeat_interval)
+            if self.connected:
+                self.post({'type': 'heartbeat'})
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.events.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def post(self, message):
+        """发出一条不需要响应的消息（写入缓冲区，大量发送时用 drain() 等待写出）"""
+        if not self.connected:
+            raise ConnectionError("未连接到服务器")
+        self.writer.write(encode_message(message, self.state.codec))
+
+    def request(self, message):
+        """发出一个需要响应的请求，立即返回 asyncio.Future"""
+        future = asyncio.get_running_loop().create_future()
+        self.state.track(message, future)
+        try:
+            self.post(message)
+        except OSError as e:
+            self.state.untrack(message)
+            future.set_exception(e)
+        return future
+
+    async def drain(self):
+        """等待发送缓冲区降到水位线以下"""
+        await self.writer.drain()
+
+    def create_chat(self, *target_users):
+        """与一个用户聊天，或与多个用户创建聊天室"""
+        return self.request(create_chat_message(target_users))
+
+    def invite(self, group_id, *users):
+        return self.request({'type': 'invite', 'group_id': group_id, 'target_users': list(users)})
+
+    def join_chat(self, group_id):
+        return self.request({'type': 'join_chat', 'group_id': group_id})
+
+    def history(self, group_id, limit=50, since_seq=None, before_seq=None):
+        """最近 limit 条，since_seq 之后的 limit 条，或 before_seq 之前的 limit 条聊天记录"""
+        return self.request(history_message(group_id, limit, since_seq, before_seq))
+
+    def heartbeat(self):
+        return self.request({'type': 'heartbeat'})
+
+    def send(self, group_id, content):
+        """发送一条聊天消息"""
+        self.post({'type': 'chat_message', 'group_id': group_id, 'content': content})
+
+    def leave_chat(self, group_id):
+        self.post({'type': 'leave_chat', 'group_id': group_id})
+        self.state.groups.pop(group_id, None)
+
+    async def upload(self, group_id, path):
+        """把文件上传到聊天组，等到服务器收完，返回最后的 file_ack（含 file_id）
+
+        asyncio 的 loop.sendfile 进行期间不允许其他写入，为了不阻塞同一连接上的消息，
+        这里按块读出后写入，每块不超过 chunk_size。
+        """
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            response = await self.request(file_offer_message(group_id, path, size))
+            transfer = self.state.start_upload(response, asyncio.get_running_loop().create_future(), asyncio.Event())
+            stream, chunk_size = response['stream'], response['chunk_size']
+            offset = 0
+            # 空文件也发送一个空的数据块，服务器收到后才完成上传
+            while (offset < size or offset == size == 0) and not transfer.future.done():
+                if offset - transfer.acked >= transfer.window:
+                    transfer.wakeup.clear()
+                    await transfer.wakeup.wait()
+                    continue
+                if not self.connected:
+                    raise ConnectionError("未连接到服务器")
+                count = min(chunk_size, size - offset)
+                data = f.read(count)
+                if len(data) != count:
+                    raise OSError("文件在上传过程中被截断")
+                self.writer.write(chunk_header(stream, offset, count))
+                self.writer.write(data)
+                await self.writer.drain()
+                if not size:
+                    break
+                offset += count
+        return await transfer.future
+
+    def download(self, file_id, path):
+        """下载文件保存到 path，立即返回 asyncio.Future，收完时结果为 file_get_response"""
+        future = asyncio.get_running_loop().create_future()
+        message = self.state.track_download({'type': 'file_get', 'file_id': file_id}, path, future)
+        try:
+            self.post(message)
+        except OSError as e:
+            self.state.untrack(message)
+            future.set_exception(e)
+        return future
+
+    async def close(self):
+        """断开连接；会话令牌保留，之后可以再次 connect() 续传"""
+        writer = self.writer
+        if writer is None:
+            return
+        self.connected = False
+        for task in self.tasks[1:]:
+            task.cancel()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,179 @@
+"""紧凑二进制消息编码
+
+注册时客户端在 register 消息里列出支持的编码（'codecs'），服务器在
+register_response 中用 'codec' 告知选定的编码，此后双方发送的帧都使用它；
+不支持二进制编码的一方继续使用 JSON。
+
+二进制负载布局（大端）：
+    类型码 u8 | 标志 u8 | [组号 u32] | [时间戳 f64] | [from_user: u8 长度 + UTF-8]
+    | [content: u32 长度 + UTF-8] | [其余字段的紧凑 JSON]
+方括号中的字段由标志位决定是否存在。类型名被替换为单字节类型码，
+'group_N' 形式的组ID被替换为数字 N。JSON 负载总以 '{' 开头，
+而类型码都小于 0x7B，因此解码时看首字节即可区分两种编码。
+"""
+import json
+import struct
+
+JSON = 'json'
+BINARY = 'binary'
+CODECS = (BINARY, JSON)  # 按优先顺序排列
+
+# 类型名 <-> 单字节类型码
+TYPE_CODES = {
+    'register': 1,
+    'register_response': 2,
+    'create_chat': 3,
+    'create_chat_response': 4,
+    'chat_invitation': 5,
+    'chat_message': 6,
+    'leave_chat': 7,
+    'user_left': 8,
+    'user_offline': 9,
+    'heartbeat': 10,
+    'heartbeat_ack': 11,
+    'error': 12,
+    'invite': 13,
+    'invite_response': 14,
+    'join_chat': 15,
+    'join_chat_response': 16,
+    'user_joined': 17,
+    'file_offer': 18,
+    'file_offer_response': 19,
+    'file_ack': 20,
+    'file_get': 21,
+    'file_get_response': 22,
+    'file_shared': 23,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+HAS_GROUP = 0x01
+HAS_TIMESTAMP = 0x02
+HAS_FROM_USER = 0x04
+HAS_CONTENT = 0x08
+HAS_EXTRA = 0x10
+
+HEAD = struct.Struct('!BB')
+GROUP = struct.Struct('!I')
+TIMESTAMP = struct.Struct('!d')
+SHORT_LEN = struct.Struct('!B')
+LONG_LEN = struct.Struct('!I')
+
+GROUP_PREFIX = 'group_'
+
+
+def choose_codec(offered):
+    """从客户端提供的编码列表中选出双方都支持的第一个，默认 JSON"""
+    for codec in offered or ():
+        if codec in CODECS:
+            return codec
+    return JSON
+
+
+def group_number(group_id):
+    """'group_N' -> N；无法无损转换时返回 None"""
+    if not isinstance(group_id, str) or not group_id.startswith(GROUP_PREFIX):
+        return None
+    digits = group_id[len(GROUP_PREFIX):]
+    if not digits.isdigit() or str(int(digits)) != digits or int(digits) > 0xFFFFFFFF:
+        return None
+    return int(digits)
+
+
+def encode_json(message):
+    return json.dumps(message).encode('utf-8')
+
+
+def encode_binary(message):
+    """把消息字典编码为二进制负载；类型未登记时退回 JSON"""
+    code = TYPE_CODES.get(message.get('type'))
+    if code is None:
+        return encode_json(message)
+
+    flags = 0
+    parts = []
+    extra = {}
+    for key, value in message.items():
+        if key == 'type':
+            continue
+        if key == 'group_id':
+            number = group_number(value)
+            if number is not None:
+                flags |= HAS_GROUP
+                group = GROUP.pack(number)
+                continue
+        elif key == 'timestamp' and isinstance(value, float):
+            flags |= HAS_TIMESTAMP
+            timestamp = TIMESTAMP.pack(value)
+            continue
+        elif key == 'from_user' and isinstance(value, str):
+            data = value.encode('utf-8')
+            if len(data) <= 0xFF:
+                flags |= HAS_FROM_USER
+                from_user = SHORT_LEN.pack(len(data)) + data
+                continue
+        elif key == 'content' and isinstance(value, str):
+            flags |= HAS_CONTENT
+            data = value.encode('utf-8')
+            content = LONG_LEN.pack(len(data)) + data
+            continue
+        extra[key] = value
+
+    parts.append(HEAD.pack(code, flags | (HAS_EXTRA if extra else 0)))
+    if flags & HAS_GROUP:
+        parts.append(group)
+    if flags & HAS_TIMESTAMP:
+        parts.append(timestamp)
+    if flags & HAS_FROM_USER:
+        parts.append(from_user)
+    if flags & HAS_CONTENT:
+        parts.append(content)
+    if extra:
+        parts.append(json.dumps(extra, separators=(',', ':')).encode('utf-8'))
+    return b''.join(parts)
+
+
+def decode_binary(payload):
+    """解码二进制负载，格式错误时抛出 ValueError"""
+    try:
+        code, flags = HEAD.unpack_from(payload, 0)
+        name = TYPE_NAMES[code]
+        message = {'type': name}
+        offset = HEAD.size
+        if flags & HAS_GROUP:
+            (number,) = GROUP.unpack_from(payload, offset)
+            message['group_id'] = f"{GROUP_PREFIX}{number}"
+            offset += GROUP.size
+        if flags & HAS_TIMESTAMP:
+            (message['timestamp'],) = TIMESTAMP.unpack_from(payload, offset)
+            offset += TIMESTAMP.size
+        if flags & HAS_FROM_USER:
+            (length,) = SHORT_LEN.unpack_from(payload, offset)
+            offset += SHORT_LEN.size
+            message['from_user'] = str(payload[offset:offset + length], 'utf-8')
+            offset += length
+        if flags & HAS_CONTENT:
+            (length,) = LONG_LEN.unpack_from(payload, offset)
+            offset += LONG_LEN.size
+            if offset + length > len(payload):
+                raise ValueError("content 长度超出负载")
+            message['content'] = str(payload[offset:offset + length], 'utf-8')
+            offset += length
+        if flags & HAS_EXTRA:
+            message.update(json.loads(payload[offset:]))
+        return message
+    except (struct.error, KeyError) as e:
+        raise ValueError(f"无效的二进制消息: {e}") from None
+
+
+def encode_payload(message, codec=JSON):
+    """按指定编码把消息字典编码为帧负载"""
+    if codec == BINARY:
+        return encode_binary(message)
+    return encode_json(message)
+
+
+def decode_payload(payload):
+    """根据首字节自动识别编码并解码"""
+    if payload[:1] == b'{':
+        return json.loads(payload)
+    return decode_binary(payload)
@@ -0,0 +1,365 @@
+"""追加写、分段存储的聊天记录日志
+
+目录结构：
+    segments/00000000.log   记录段：[u32 长度][JSON 负载]...，写满 segment_size 后换新段
+    index/<group_id>.idx    每个聊天组一个定长索引：第 i 项 (u32 段号, u64 段内偏移) 对应 seq = i + 1
+    checkpoint              检查点 (u32 段号, u64 段内偏移)：此前所有记录的索引项都已落盘
+
+每个组的消息序号从 1 开始连续递增，因此“最近 N 条”和“seq S 之前/之后的消息”都能直接
+算出索引项位置，通过内存映射读取，不需要扫描日志。append() 只在内存中分配序号并排队，
+由后台写线程把一段时间内积攒的记录一次写入并统一 fsync（组提交），不拖慢广播。
+
+每批记录只 fsync 记录段；索引项写入保持打开的索引文件，每隔 CHECKPOINT_INTERVAL 秒
+或换段时才统一 fsync 并推进检查点。记录中带有组ID和序号，启动时从检查点开始扫描记录段，
+重建检查点之后的索引项，并截掉崩溃时写了一半的记录。
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+RECORD_HEADER = struct.Struct('!I')
+INDEX_ENTRY = struct.Struct('!IQ')  # (段号, 段内偏移)
+GROUP_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+CHECKPOINT = struct.Struct('!IQ')  # (段号, 段内偏移)
+
+# 同时保持映射的索引文件数上限
+MAX_INDEX_MAPS = 256
+
+# 同时保持打开（用于追加）的索引文件数上限
+MAX_INDEX_FILES = 256
+
+# 索引文件统一 fsync 并推进检查点的间隔（秒）；崩溃后最多需要从记录段重建这么久的索引
+CHECKPOINT_INTERVAL = 5.0
+
+
+class MessageLog:
+    """按组建立索引的持久化消息日志（线程安全）"""
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, commit_interval=0.005):
+        self.segment_dir = os.path.join(directory, 'segments')
+        self.index_dir = os.path.join(directory, 'index')
+        self.checkpoint_path = os.path.join(directory, 'checkpoint')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval  # 组提交前积攒记录的时间窗口
+
+        self.cond = threading.Condition()
+        self.pending = []  # [(group_id, seq, payload)]，等待写盘
+        self.unflushed = defaultdict(dict)  # {group_id: {seq: message}}，写盘前供读取
+        self.next_seq = {}  # {group_id: 下一个序号}
+        self.committed = {}  # {group_id: 已写盘的最大序号}
+        self.closed = False
+        self.error = None  # 写盘失败时的异常，之后拒绝追加
+
+        self.read_lock = threading.Lock()
+        self.segment_maps = {}  # {段号: mmap}
+        self.index_maps = OrderedDict()  # {group_id: mmap}，LRU
+
+        self.index_files = OrderedDict()  # {group_id: 以追加方式打开的索引文件}，LRU，只由写线程访问
+        self.dirty_indexes = set()  # 上次检查点之后写过的组
+        self.checkpoint_time = time.monotonic()
+
+        self.segment_no = self._recover()
+        self.segment_file = open(self._segment_path(self.segment_no), 'ab')
+        self.segment_offset = self.segment_file.tell()
+        self._checkpoint()
+
+        self.writer = threading.Thread(target=self._write_loop, name='history-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _segment_path(self, segment_no):
+        return os.path.join(self.segment_dir, f'{segment_no:08d}.log')
+
+    def _index_path(self, group_id):
+        return os.path.join(self.index_dir, f'{group_id}.idx')
+
+    def _recover(self):
+        """从检查点开始扫描记录段，重建之后的索引项，返回最后一段的段号
+
+        没有检查点文件的旧日志每批都 fsync 了索引，直接从最后一段的末尾开始。
+        """
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.segment_dir) if name.endswith('.log'))
+        if not segments:
+            return 0
+        try:
+            with open(self.checkpoint_path, 'rb') as f:
+                segment_no, offset = CHECKPOINT.unpack(f.read(CHECKPOINT.size))
+        except FileNotFoundError:
+            return segments[-1]
+
+        entries = defaultdict(list)  # {group_id: [(seq, 段号, 偏移)]}
+        for no in segments:
+            if no < segment_no:
+                continue
+            path = self._segment_path(no)
+            with open(path, 'rb') as f:
+                data = f.read()
+            position = offset if no == segment_no else 0
+            while position + RECORD_HEADER.size <= len(data):
+                (length,) = RECORD_HEADER.unpack_from(data, position)
+                end = position + RECORD_HEADER.size + length
+                try:
+                    if end > len(data):
+                        raise ValueError
+                    record = json.loads(data[position + RECORD_HEADER.size:end])
+                    group_id, seq = record['group_id'], record['seq']
+                    if not GROUP_ID_PATTERN.match(group_id):
+                        raise ValueError
+                except (ValueError, KeyError, TypeError):
+                    break
+                entries[group_id].append((seq, no, position))
+                position = end
+            if position < len(data):
+                if no == segments[-1]:
+                    # 崩溃时写了一半的记录
+                    os.truncate(path, position)
+                else:
+                    print(f"聊天记录段 {path} 在偏移 {position} 处损坏，忽略之后的记录")
+
+        for group_id, group_entries in entries.items():
+            path = self._index_path(group_id)
+            try:
+                count = os.path.getsize(path) // INDEX_ENTRY.size
+            except FileNotFoundError:
+                count = 0
+            first = group_entries[0][0]
+            if count < first - 1:
+                print(f"聊天组 {group_id} 的索引缺少检查点之前的项，无法恢复之后的 {len(group_entries)} 条记录")
+                continue
+            with open(path, 'ab') as f:
+                f.truncate((first - 1) * INDEX_ENTRY.size)
+                f.write(b''.join(INDEX_ENTRY.pack(no, position) for _, no, position in group_entries))
+            self.dirty_indexes.add(group_id)
+        return segments[-1]
+
+    def _load_group(self, group_id):
+        """首次访问某组时根据索引文件长度恢复它的序号（调用方持有 cond）"""
+        if group_id not in self.next_seq:
+            path = self._index_path(group_id)
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                size = 0
+            count, partial = divmod(size, INDEX_ENTRY.size)
+            if partial:
+                # 上次写索引时崩溃留下的半条索引项
+                os.truncate(path, count * INDEX_ENTRY.size)
+            self.committed[group_id] = count
+            self.next_seq[group_id] = count + 1
+
+    def append(self, group_id, message):
+        """追加一条消息，返回它在组内的序号；写盘在后台异步完成"""
+        if not GROUP_ID_PATTERN.match(group_id):
+            raise ValueError(f"非法的聊天组ID: {group_id}")
+        with self.cond:
+            if self.closed:
+                raise ValueError("聊天记录日志已关闭")
+            if self.error is not None:
+                raise ValueError(f"聊天记录日志写入失败: {self.error}")
+            self._load_group(group_id)
+            seq = self.next_seq[group_id]
+            self.next_seq[group_id] = seq + 1
+            record = dict(message, group_id=group_id, seq=seq)
+            self.pending.append((group_id, seq, json.dumps(record, separators=(',', ':')).encode('utf-8')))
+            self.unflushed[group_id][seq] = record
+            self.cond.notify()
+        return seq
+
+    def group_ids(self):
+        """日志中出现过的所有聊天组ID"""
+        return [name[:-4] for name in os.listdir(self.index_dir) if name.endswith('.idx')]
+
+    def last_seq(self, group_id):
+        """组内最新消息的序号，没有消息时为 0"""
+        with self.cond:
+            self._load_group(group_id)
+            return self.next_seq[group_id] - 1
+
+    def read_last(self, group_id, count):
+        """读取组内最近 count 条消息（按序号升序）"""
+        last = self.last_seq(group_id)
+        return self.read_range(group_id, max(1, last - count + 1), last)
+
+    def read_since(self, group_id, seq, limit):
+        """读取组内序号大于 seq 的消息，最多 limit 条"""
+        last = self.last_seq(group_id)
+        return self.read_range(group_id, seq + 1, min(last, seq + limit))
+
+    def read_before(self, group_id, seq, limit):
+        """读取组内序号小于 seq 的最后 limit 条消息（按序号升序），用于向前翻页"""
+        last = min(seq - 1, self.last_seq(group_id))
+        return self.read_range(group_id, max(1, last - limit + 1), last)
+
+    def read_range(self, group_id, first, last):
+        """读取序号在 [first, last] 内的消息（first 小于 1 时从 1 开始）"""
+        first = max(1, first)
+        if not GROUP_ID_PATTERN.match(group_id) or first > last:
+            return []
+        with self.cond:
+            self._load_group(group_id)
+            committed = self.committed[group_id]
+            pending = self.unflushed.get(group_id, {})
+            tail = [pending[seq] for seq in range(max(first, committed + 1), last + 1) if seq in pending]
+        messages = []
+        if first <= committed:
+            with self.read_lock:
+                messages = [self._read_record(*entry) for entry in self._index_entries(group_id, first, min(last, committed))]
+        return messages + tail
+
+    def _index_entries(self, group_id, first, last):
+        """返回 seq 在 [first, last] 内的 (段号, 偏移) 列表（调用方持有 read_lock）"""
+        end = last * INDEX_ENTRY.size
+        index = self.index_maps.get(group_id)
+        if index is None or len(index) < end:
+            if index is not None:
+                index.close()
+            with open(self._index_path(group_id), 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.index_maps[group_id] = index
+            if len(self.index_maps) > MAX_INDEX_MAPS:
+                self.index_maps.popitem(last=False)[1].close()
+        self.index_maps.move_to_end(group_id)
+        return [INDEX_ENTRY.unpack_from(index, (seq - 1) * INDEX_ENTRY.size) for seq in range(first, last + 1)]
+
+    def _read_record(self, segment_no, offset):
+        """从内存映射的段文件中读出一条记录（调用方持有 read_lock）"""
+        segment = self.segment_maps.get(segment_no)
+        if segment is None or len(segment) < offset + RECORD_HEADER.size:
+            segment = self._map_segment(segment_no)
+        (length,) = RECORD_HEADER.unpack_from(segment, offset)
+        start = offset + RECORD_HEADER.size
+        if len(segment) < start + length:
+            segment = self._map_segment(segment_no)
+        return json.loads(segment[start:start + length])
+
+    def _map_segment(self, segment_no):
+        old = self.segment_maps.pop(segment_no, None)
+        if old is not None:
+            old.close()
+        with open(self._segment_path(segment_no), 'rb') as f:
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.segment_maps[segment_no] = segment
+        return segment
+
+    def _write_loop(self):
+        """后台写线程：积攒一批记录后一次写入并 fsync"""
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+            if not self.closed:
+                time.sleep(self.commit_interval)
+            with self.cond:
+                batch = self.pending
+                self.pending = []
+            try:
+                self._commit(batch)
+            except OSError as e:
+                # 这一批可能已部分写入，重试会让索引和段文件错位；之后的序号也无法再连续，
+                # 因此停止写盘并拒绝追加。未写盘的记录留在 unflushed 中，本次运行期间仍可读取
+                print(f"写入聊天记录失败，停止记录: {e}")
+                with self.cond:
+                    self.error = e
+                    self.pending = []
+                return
+            with self.cond:
+                for group_id, seq, _ in batch:
+                    self.committed[group_id] = seq
+                    self.unflushed[group_id].pop(seq, None)
+                    if not self.unflushed[group_id]:
+                        del self.unflushed[group_id]
+
+    def _commit(self, batch):
+        """把一批记录写入段文件和各组索引，然后统一 fsync"""
+        chunks = []
+        entries = defaultdict(list)
+        for group_id, seq, payload in batch:
+            if self.segment_offset >= self.segment_size:
+                self._roll_segment(chunks)
+                chunks = []
+            entries[group_id].append(INDEX_ENTRY.pack(self.segment_no, self.segment_offset))
+            chunks.append(RECORD_HEADER.pack(len(payload)))
+            chunks.append(payload)
+            self.segment_offset += RECORD_HEADER.size + len(payload)
+        self._write_segment(chunks)
+
+        # 先保证记录落盘，再写索引，索引不会指向不存在的记录；索引只写入操作系统缓存，
+        # 到检查点才 fsync，崩溃时丢失的索引项在下次启动时从记录段重建
+        for group_id, group_entries in entries.items():
+            self._index_file(group_id).write(b''.join(group_entries))
+            self.dirty_indexes.add(group_id)
+        if self.segment_no != self.checkpoint_segment or time.monotonic() - self.checkpoint_time >= CHECKPOINT_INTERVAL:
+            self._checkpoint()
+
+    def _index_file(self, group_id):
+        """组的索引文件（无缓冲追加），打开的文件数超过上限时关闭最久未用的"""
+        f = self.index_files.get(group_id)
+        if f is None:
+            f = self.index_files[group_id] = open(self._index_path(group_id), 'ab', buffering=0)
+            if len(self.index_files) > MAX_INDEX_FILES:
+                self.index_files.popitem(last=False)[1].close()
+        self.index_files.move_to_end(group_id)
+        return f
+
+    def _checkpoint(self):
+        """统一 fsync 上次检查点之后写过的索引文件，然后把检查点推进到当前写位置"""
+        for group_id in self.dirty_indexes:
+            f = self.index_files.get(group_id)
+            if f is not None:
+                os.fsync(f.fileno())
+            else:
+                fd = os.open(self._index_path(group_id), os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        self.dirty_indexes.clear()
+        temp = self.checkpoint_path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(CHECKPOINT.pack(self.segment_no, self.segment_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        # 检查点文件整体替换，崩溃后要么是旧的要么是新的
+        os.replace(temp, self.checkpoint_path)
+        self.checkpoint_segment = self.segment_no
+        self.checkpoint_time = time.monotonic()
+
+    def _write_segment(self, chunks):
+        self.segment_file.write(b''.join(chunks))
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+
+    def _roll_segment(self, chunks):
+        self._write_segment(chunks)
+        self.segment_file.close()
+        self.segment_no += 1
+        self.segment_file = open(self._segment_path(self.segment_no), 'ab')
+        self.segment_offset = 0
+
+    def close(self):
+        """写完所有排队的记录后关闭"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+        if self.error is None:
+            self._checkpoint()
+        for f in self.index_files.values():
+            f.close()
+        self.index_files.clear()
+        self.segment_file.close()
+        with self.read_lock:
+            for m in list(self.segment_maps.values()) + list(self.index_maps.values()):
+                m.close()
+            self.segment_maps.clear()
+            self.index_maps.clear()
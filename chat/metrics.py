@@ -0,0 +1,166 @@
+"""服务器运行指标：计数器、延迟直方图和本地统计端点
+
+热点路径上每次记录只做一次加锁和几次整数加法；直方图按 2 的幂分桶
+（第 i 个桶记录 [2^(i-1), 2^i) 纳秒），记录时不排序、不分配内存，
+读取时再从桶估算分位数。统计数据可以通过本地 HTTP 端点读取
+（/stats 返回 JSON，/metrics 返回文本格式），也可以定期打印。
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HISTOGRAM_BUCKETS = 64
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """按 2 的幂分桶的纳秒直方图（调用方负责加锁）"""
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+
+    def observe(self, ns):
+        self.buckets[min(ns.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += ns
+
+    def quantile(self, q):
+        """估算分位数（纳秒），取所在桶的上界"""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return 1 << index
+        return 0
+
+    def summary(self):
+        """{count, mean_us, p50_us, p90_us, p99_us}"""
+        result = {'count': self.count, 'mean_us': round(self.total / self.count / 1000, 3) if self.count else None}
+        for q in QUANTILES:
+            result[f'p{q * 100:g}_us'] = round(self.quantile(q) / 1000, 3) if self.count else None
+        return result
+
+
+class Metrics:
+    """线程安全的计数器和直方图集合
+
+    指标名为字符串，或 (名称, 标签) 二元组，例如 ('messages_in', 'chat_message')。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+        self.started = time.time()
+
+    def incr(self, key, n=1):
+        with self.lock:
+            self.counters[key] += n
+
+    def add(self, *items):
+        """一次加锁累加多个计数器，items 为 (指标名, 增量)"""
+        with self.lock:
+            counters = self.counters
+            for key, n in items:
+                counters[key] += n
+
+    def observe(self, key, ns):
+        """记录一次耗时（纳秒）"""
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(ns)
+
+    def snapshot(self):
+        """{'counters': {...}, 'histograms': {...}}，带标签的指标按名称分组"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: histogram.summary() for key, histogram in self.histograms.items()}
+        return {
+            'uptime_s': round(time.time() - self.started, 1),
+            'counters': _group(counters),
+            'histograms': _group(histograms),
+        }
+
+
+def _group(values):
+    """{(名称, 标签): v, 名称: v} -> {名称: {标签: v} 或 v}"""
+    grouped = {}
+    for key, value in sorted(values.items(), key=lambda item: str(item[0])):
+        if isinstance(key, tuple):
+            grouped.setdefault(key[0], {})[str(key[1])] = value
+        else:
+            grouped[key] = value
+    return grouped
+
+
+def render_text(stats, prefix='chat'):
+    """把统计字典展开为每行一个 '名称{type="标签"} 值' 的文本格式"""
+    lines = [f'{prefix}_uptime_seconds {stats["uptime_s"]}']
+    for section in ('counters', 'gauges'):
+        for name, value in stats.get(section, {}).items():
+            if isinstance(value, dict):
+                for label, inner in value.items():
+                    lines.append(f'{prefix}_{name}{{type="{label}"}} {inner}')
+            else:
+                lines.append(f'{prefix}_{name} {value}')
+    for name, value in stats.get('histograms', {}).items():
+        # 不带标签的直方图直接是摘要，带标签的是 {标签: 摘要}
+        labeled = value.items() if 'count' not in value else [(None, value)]
+        for label, summary in labeled:
+            label_text = f'{{type="{label}"}}' if label is not None else ''
+            for field, inner in summary.items():
+                if inner is not None:
+                    lines.append(f'{prefix}_{name}_{field}{label_text} {inner}')
+    return '\n'.join(lines) + '\n'
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stats = self.server.collect()
+        if self.path.startswith('/metrics'):
+            body, content_type = render_text(stats).encode('utf-8'), 'text/plain; charset=utf-8'
+        elif self.path in ('/', '/stats'):
+            body, content_type = json.dumps(stats, ensure_ascii=False, indent=2).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_stats(host, port, collect):
+    """在后台线程中启动统计端点，collect() 返回当前统计字典"""
+    server = ThreadingHTTPServer((host, port), _StatsHandler)
+    server.daemon_threads = True
+    server.collect = collect
+    thread = threading.Thread(target=server.serve_forever, name='stats-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def dump_periodically(interval, collect):
+    """在后台线程中每隔 interval 秒把统计字典打印为一行 JSON"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            print(json.dumps(collect(), ensure_ascii=False, separators=(',', ':')), flush=True)
+
+    thread = threading.Thread(target=loop, name='stats-dump')
+    thread.daemon = True
+    thread.start()
+    return thread
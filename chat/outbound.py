@@ -0,0 +1,248 @@
+"""每个连接的有界发送队列
+
+广播方只把帧放进接收方的队列就返回，真正的 send 由该连接的发送者
+（线程模式下的发送线程、事件循环模式下的可写事件）完成，
+一个接收窗口已满的慢速客户端不会再拖住发送方和组内其他成员。
+
+队列中除了已编码的帧（bytes），还可以放入 FileRegion：一段文件内容加上它的帧头，
+发送时用 os.sendfile 由内核直接从页缓存写入套接字，文件内容不经过 Python 的缓冲区。
+
+可选的写合并：队列可以设置一个短暂的时间窗口（linger），发往同一连接的
+多条小消息攒够 min_bytes 或最早的一帧等满窗口后才一次写出，
+以不超过 linger 的额外延迟换取更少的系统调用。
+"""
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+# 队列满时的处理策略
+DROP_OLDEST = 'drop_oldest'  # 丢弃最旧的一帧，保留最新消息
+DISCONNECT = 'disconnect'  # 断开慢速客户端
+BLOCK = 'block'  # 阻塞发送方直到有空位或超时（仅线程模式）
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+# 一次从队列取出的最大字节数
+BATCH_BYTES = 256 * 1024
+
+# 支持 sendmsg 的平台可以把多帧一次性交给内核（分散写），无需先拼接
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# Linux 的 TCP_CORK：一批数据需要多次系统调用才能写完时，先塞住再一起发出，避免产生小报文
+HAS_CORK = hasattr(socket, 'TCP_CORK')
+
+HAS_SENDFILE = hasattr(os, 'sendfile')
+
+# 发送 FileRegion 的帧头时告诉内核后面还有数据，帧头和文件内容合成一个报文
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+
+class FileRegion:
+    """发送队列中的一段文件：帧头加上文件中从 offset 开始的 count 字节
+
+    file 为以二进制方式打开的文件对象，由所有引用它的 FileRegion 共享，由它的所有者负责关闭。
+    """
+    __slots__ = ('header', 'file', 'offset', 'count')
+
+    def __init__(self, header, file, offset, count):
+        self.header = header
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return len(self.header) + self.count
+
+    def send(self, sock):
+        """发送一部分，返回发送的字节数"""
+        if self.header:
+            return sock.send(self.header, MSG_MORE)
+        if HAS_SENDFILE:
+            sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.count)
+        else:
+            # 不支持 sendfile 的平台：按块读出再发送
+            self.file.seek(self.offset)
+            data = self.file.read(min(self.count, 65536))
+            sent = sock.send(data) if data else 0
+        if not sent:
+            raise OSError("文件在发送过程中被截断")
+        return sent
+
+    def skip(self, n):
+        """去掉已发送的前 n 字节，返回自身"""
+        if self.header:
+            taken = min(n, len(self.header))
+            self.header = memoryview(self.header)[taken:]
+            n -= taken
+        self.offset += n
+        self.count -= n
+        return self
+
+
+class OutboundQueue:
+    """有界发送队列，按帧计数"""
+
+    def __init__(self, max_frames=1000, policy=DISCONNECT, block_timeout=5.0, linger=0.0, min_bytes=0):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的队列策略: {policy}")
+        self.frames = deque()
+        self.max_frames = max_frames
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.linger = linger  # 写合并窗口（秒），0 表示有帧就写
+        self.min_bytes = min_bytes  # 攒够这么多字节就不再等待窗口结束
+        self.cond = threading.Condition()
+        self.dropped = 0  # DROP_OLDEST 策略下丢弃的帧数
+        self.closed = False
+        self.bytes = 0  # 队列中帧的总字节数
+        self.first_put = 0.0  # 队列由空变为非空的时间（time.monotonic），写合并的窗口从这里算起
+        self.journal = None  # 会话的重放环（deque），put 时按入队顺序记录消息
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, entry=None):
+        """放入一帧；返回 False 表示队列已关闭或应断开这个慢速连接
+
+        entry 不为 None 时记入重放环，即使这一帧没能入队，断线重连后也能补发。
+        """
+        with self.cond:
+            if entry is not None and self.journal is not None:
+                self.journal.append(entry)
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_frames:
+                if self.policy == DROP_OLDEST:
+                    self.bytes -= len(self.frames.popleft())
+                    self.dropped += 1
+                elif self.policy == DISCONNECT:
+                    return False
+                elif not self.cond.wait_for(self._has_room, self.block_timeout) or self.closed:
+                    return False
+            if not self.frames:
+                self.first_put = time.monotonic()
+            self.frames.append(frame)
+            self.bytes += len(frame)
+            # 合并窗口内只在发送线程可能需要醒来时通知，避免每帧一次唤醒
+            if len(self.frames) == 1 or self.bytes >= self.min_bytes:
+                self.cond.notify_all()
+            return True
+
+    def _has_room(self):
+        return self.closed or len(self.frames) < self.max_frames
+
+    def pop_batch(self, max_bytes=BATCH_BYTES):
+        """不阻塞地取出一批帧，总长度约为 max_bytes（至少一帧）"""
+        with self.cond:
+            batch = self._take(max_bytes)
+            if batch:
+                self.cond.notify_all()
+            return batch
+
+    def due(self, now):
+        """现在是否应该写出：没有合并窗口、已攒够 min_bytes 或最早的帧已等满窗口"""
+        return self.bytes >= self.min_bytes or now - self.first_put >= self.linger
+
+    def get_batch(self, max_bytes=BATCH_BYTES):
+        """阻塞直到有帧可取；队列关闭且已取空时返回空列表
+
+        设置了合并窗口时，有帧后再等到攒够 min_bytes 或窗口结束才取出。
+        """
+        with self.cond:
+            while not self.frames and not self.closed:
+                self.cond.wait()
+            if self.linger and self.frames:
+                deadline = self.first_put + self.linger
+                while not self.closed and self.bytes < self.min_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            batch = self._take(max_bytes)
+            if batch:
+                self.cond.notify_all()
+            return batch
+
+    def _take(self, max_bytes):
+        frames = self.frames
+        batch = []
+        size = 0
+        while frames and (not batch or size + len(frames[0]) <= max_bytes):
+            frame = frames.popleft()
+            batch.append(frame)
+            size += len(frame)
+        self.bytes -= size
+        if frames:
+            # 剩下的帧从现在起重新计算合并窗口
+            self.first_put = time.monotonic()
+        return batch
+
+    def close(self, discard=False):
+        """关闭队列；discard 为 True 时丢弃尚未发送的帧"""
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.frames.clear()
+                self.bytes = 0
+            self.cond.notify_all()
+
+
+def send_frames(sock, frames):
+    """把一组帧写入套接字，返回内核接受的字节数（非阻塞套接字可能只写出一部分）
+
+    遇到 FileRegion 时只写到它之前为止，FileRegion 本身单独用 sendfile 发送。
+    """
+    if isinstance(frames[0], FileRegion):
+        return frames[0].send(sock)
+    count = min(len(frames), IOV_MAX)
+    for index in range(1, count):
+        if isinstance(frames[index], FileRegion):
+            count = index
+            break
+    if count == 1:
+        return sock.send(frames[0])
+    if HAS_SENDMSG:
+        return sock.sendmsg(frames[:count])
+    return sock.send(b''.join(frames[:count]))
+
+
+def set_cork(sock, corked):
+    """打开或关闭 TCP_CORK（不支持的平台上什么也不做）"""
+    if HAS_CORK:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if corked else 0)
+        except OSError:
+            pass
+
+
+def advance(frames, sent):
+    """去掉帧列表头部已发送的 sent 字节，返回剩余部分（部分发送的帧用 memoryview 切片，不拷贝）"""
+    index = 0
+    while index < len(frames) and sent >= len(frames[index]):
+        sent -= len(frames[index])
+        index += 1
+    rest = frames[index:]
+    if sent:
+        if isinstance(rest[0], FileRegion):
+            rest[0] = rest[0].skip(sent)
+        else:
+            rest[0] = memoryview(rest[0])[sent:]
+    return rest
+
+
+def sendall_frames(sock, frames):
+    """阻塞套接字上把一组帧全部写完"""
+    corked = len(frames) > IOV_MAX
+    if corked:
+        set_cork(sock, True)
+    try:
+        while frames:
+            frames = advance(frames, send_frames(sock, frames))
+    finally:
+        if corked:
+            set_cork(sock, False)
@@ -0,0 +1,91 @@
+"""聊天协议的分帧层
+
+每一帧由 4 字节大端无符号长度和随后的负载组成，负载是 UTF-8 编码的 JSON
+或注册时协商好的紧凑二进制编码（见 chat.codec）。
+TCP 是字节流，一次 recv 可能包含多条消息或半条消息，FrameDecoder 负责从
+任意切分的数据中取出所有完整的帧。
+"""
+import struct
+
+from chat.codec import JSON, decode_payload, encode_payload
+
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+
+# 单帧负载上限，防止异常长度把内存耗尽
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# 每次 recv 读取的字节数，较大的值可以一次取回一批小消息
+RECV_SIZE = 65536
+
+
+class FrameError(ValueError):
+    """帧格式错误，连接上的后续数据已无法可靠解析"""
+
+
+def encode_frame(payload):
+    """给负载加上长度前缀"""
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_message(message, codec=JSON):
+    """把消息字典按指定编码编码为一帧"""
+    return encode_frame(encode_payload(message, codec))
+
+
+def decode_message(payload):
+    """把一帧负载解码为消息字典（自动识别编码），格式错误时抛出 ValueError"""
+    return decode_payload(payload)
+
+
+class FrameDecoder:
+    """增量帧解码器
+
+    feed() 每次接收一段数据，返回其中所有完整帧的负载；不完整的尾部留在
+    缓冲区等待下一次数据。已解析部分在每次 feed 结束时一次性丢弃，
+    不会为每一帧重新拷贝剩余缓冲区。
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """喂入新数据，返回完整帧负载（bytes）的列表"""
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        frames, offset = self._split(data)
+
+        if data is self.buffer:
+            del self.buffer[:offset]
+        elif offset < len(data):
+            # 缓冲区原本为空：只保存未解析完的尾部
+            self.buffer += data[offset:]
+        return frames
+
+    def _split(self, data):
+        """从 data 中切出所有完整帧，返回 (帧列表, 已消费的字节数)"""
+        frames = []
+        offset = 0
+        end = len(data)
+        unpack_from = HEADER.unpack_from
+        max_frame_size = self.max_frame_size
+        while end - offset >= HEADER_SIZE:
+            (length,) = unpack_from(data, offset)
+            if length > max_frame_size:
+                raise FrameError(f"帧长度 {length} 超过上限 {max_frame_size}")
+            start = offset + HEADER_SIZE
+            if end - start < length:
+                break
+            frames.append(bytes(data[start:start + length]))
+            offset = start + length
+        return frames, offset
+
+
+def recv_frames(sock, decoder):
+    """从阻塞套接字读取一批数据并返回其中的完整帧；连接关闭时返回 None"""
+    data = sock.recv(RECV_SIZE)
+    if not data:
+        return None
+    return decoder.feed(data)
@@ -0,0 +1,79 @@
+"""令牌桶限流
+
+每个已注册连接按消息类型各有一个令牌桶，'*' 对应的桶限制所有类型的总速率。
+桶只由该连接的读取方（线程模式下的连接线程、事件循环）访问，不需要加锁；
+取令牌时按经过的时间补充，不需要定时器。
+"""
+
+# 匹配所有消息类型的限流规则名
+ANY_TYPE = '*'
+
+# 推荐的限流规则（--rate-limit default）：{消息类型: (每秒令牌数, 桶容量)}
+DEFAULT_LIMITS = {
+    'chat_message': (50.0, 200),
+    'create_chat': (2.0, 10),
+    'invite': (2.0, 10),
+    'join_chat': (2.0, 10),
+    'history': (10.0, 20),
+    'file_offer': (2.0, 10),
+    'file_get': (5.0, 20),
+}
+
+
+class TokenBucket:
+    """容量为 burst、每秒补充 rate 个令牌的令牌桶"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def ready(self, now):
+        """按经过的时间补充令牌，返回桶里是否至少有一个令牌（不取走）"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= 1.0
+
+    def take(self, now):
+        """取一个令牌，桶空时返回 False"""
+        if not self.ready(now):
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+def make_buckets(limits, now):
+    """按限流规则为一个连接创建令牌桶"""
+    return {msg_type: TokenBucket(rate, burst, now) for msg_type, (rate, burst) in limits.items()}
+
+
+def allow(buckets, msg_type, now):
+    """一条 msg_type 类型的消息是否放行；该类型的桶和总速率的桶都有令牌时才各取一个，
+    被拒绝的消息不消耗任何令牌"""
+    bucket = buckets.get(msg_type) if msg_type != ANY_TYPE else None
+    total = buckets.get(ANY_TYPE)
+    if (bucket is not None and not bucket.ready(now)) or (total is not None and not total.ready(now)):
+        return False
+    if bucket is not None:
+        bucket.tokens -= 1.0
+    if total is not None:
+        total.tokens -= 1.0
+    return True
+
+
+def parse_limit(spec):
+    """解析 '类型=速率/容量' 形式的限流规则，容量省略时等于速率；速率为 0 表示不限"""
+    msg_type, sep, value = spec.partition('=')
+    rate, _, burst = value.partition('/')
+    try:
+        if not sep or not msg_type:
+            raise ValueError
+        rate = float(rate)
+        burst = int(burst) if burst else max(1, int(rate))
+        if rate < 0 or burst < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"无效的限流规则: {spec}（格式为 类型=速率/容量，例如 chat_message=20/40）")
+    return msg_type, rate, burst
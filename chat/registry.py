@@ -0,0 +1,242 @@
+"""线程安全的会话与聊天组注册表
+
+在线用户、聊天组成员和用户所在组分别放在按键哈希分段的锁（分段锁）后面，
+不同用户、不同组的修改互不阻塞。每个组缓存一份不可变的扇出快照：
+成员用户名、本进程在线成员的连接对象，以及不在本进程在线的成员。
+成员加入、离开或某个成员上下线时只把快照作废（O(1)），下一次广播时才重建；
+广播直接遍历快照里的连接，不需要逐个查在线用户表，遍历期间也不持有任何锁。
+
+每个用户有一个会话：会话令牌和一个有界的重放环，按投递顺序记录经扇出路径发给
+该用户的消息（每条带全局唯一的 event_seq）。在线时由发送队列顺带记录，
+离线时由 stash() 记录，因此它同时就是离线信箱。重新注册时补发离线期间的消息；
+带会话令牌和最后收到的 event_seq 断线重连时，只补发客户端漏掉的消息。
+"""
+import hmac
+import secrets
+import threading
+from collections import deque
+
+
+class _Group:
+    __slots__ = ('members', 'snapshot')
+
+    def __init__(self):
+        self.members = set()
+        self.snapshot = None  # (成员用户名, 在线成员的连接, 不在本进程在线的成员)，None 表示需要重建
+
+
+class _Session:
+    __slots__ = ('token', 'messages', 'anchor')
+
+    def __init__(self, size):
+        self.token = None
+        self.messages = deque(maxlen=size)  # 重放环（兼离线信箱）
+        self.anchor = None  # 上次断线时重放环中最后一条消息的 event_seq
+
+
+class Registration:
+    """注册结果"""
+    __slots__ = ('token', 'messages', 'resumed', 'gap', 'replaced')
+
+    def __init__(self, token, messages, resumed, gap, replaced):
+        self.token = token  # 会话令牌
+        self.messages = messages  # 需要补发的消息
+        self.resumed = resumed  # 是否凭令牌恢复了会话
+        self.gap = gap  # 要补发的消息有一部分已被挤出重放环
+        self.replaced = replaced  # 被新连接顶替的旧连接（断线重连时服务器可能还没发现旧连接已断）
+
+
+def _replay_after(messages, anchor):
+    """返回重放环中 event_seq 为 anchor 的消息之后的部分，以及是否有消息已被挤出"""
+    if anchor is None:
+        return list(messages), bool(messages) and len(messages) == messages.maxlen
+    # 从新往旧找，重连时漏掉的通常只是最后几条
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get('event_seq') == anchor:
+            return [messages[i] for i in range(index + 1, len(messages))], False
+    return list(messages), True
+
+
+class Registry:
+    """在线用户、聊天组、会话和组ID计数器"""
+
+    def __init__(self, stripes=64, mailbox_size=1000):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.clients = {}  # {username: 连接对象}
+        self.groups = {}  # {group_id: _Group}
+        self.user_groups = {}  # {username: set(group_id)}
+        self.sessions = {}  # {username: _Session}
+        self.mailbox_size = mailbox_size  # 重放环长度，0 表示不保存离线消息
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+
+    def _lock(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    # ---- 组ID ----
+
+    def next_group_number(self):
+        """分配下一个组编号，多个线程同时创建聊天也不会重复"""
+        with self.counter_lock:
+            self.counter += 1
+            return self.counter
+
+    def reserve_group_numbers(self, last):
+        """保证以后分配的编号都大于 last（例如重启后跳过已用过的编号）"""
+        with self.counter_lock:
+            self.counter = max(self.counter, last)
+
+    # ---- 在线用户 ----
+
+    def register(self, username, conn, token=None, last_seq=None, prologue=None):
+        """登记连接并返回 Registration；用户名已被占用且没有有效的会话令牌时返回 None
+
+        token 与会话令牌一致时恢复会话：顶替仍登记着的旧连接，补发 event_seq 为 last_seq
+        的消息之后的所有消息。否则签发新令牌，补发上次断线之后的消息。
+        取出待补发的消息、把连接的发送队列接到重放环上和登记连接在同一把锁内完成，
+        之后的消息都直接发给新连接，不会漏掉或插到补发的消息前面。
+        prologue(registration) 在同一把锁内、登记连接之前调用，用来把注册响应和补发的消息
+        先放入发送队列，其他线程的广播只能排在它们后面；它不能再获取注册表的锁。
+        conn 需要有 queue 属性（OutboundQueue）。
+        """
+        with self._lock(username):
+            session = self.sessions.get(username)
+            resumed = (token is not None and session is not None and session.token is not None
+                       and hmac.compare_digest(str(token), session.token))
+            replaced = self.clients.get(username)
+            if replaced is not None and not resumed:
+                return None
+            if session is None:
+                session = self.sessions[username] = _Session(self.mailbox_size)
+            if resumed:
+                messages, gap = _replay_after(session.messages, last_seq)
+            else:
+                session.token = secrets.token_urlsafe(16)
+                messages, gap = _replay_after(session.messages, session.anchor)
+            registration = Registration(session.token, messages, resumed, gap, replaced)
+            if prologue is not None:
+                prologue(registration)
+            if replaced is not None:
+                replaced.queue.journal = None
+            conn.queue.journal = session.messages
+            self.clients[username] = conn
+        self._invalidate_user(username)
+        return registration
+
+    def unregister(self, username, conn):
+        """仅当 username 仍对应 conn 时注销，返回是否注销"""
+        with self._lock(username):
+            if self.clients.get(username) is not conn:
+                return False
+            del self.clients[username]
+            session = self.sessions.get(username)
+            if session is not None and session.messages:
+                session.anchor = session.messages[-1].get('event_seq')
+        self._invalidate_user(username)
+        return True
+
+    def _invalidate_user(self, username):
+        """用户上下线后作废其所在各组的扇出快照"""
+        for group_id in self.groups_of(username):
+            with self._lock(group_id):
+                group = self.groups.get(group_id)
+                if group is not None:
+                    group.snapshot = None
+
+    def stash(self, username, message):
+        """用户不在线时把消息记入其重放环（离线信箱）并返回 None；用户此时已经上线则返回其连接，由调用方直接发送"""
+        with self._lock(username):
+            conn = self.clients.get(username)
+            if conn is None and self.mailbox_size:
+                session = self.sessions.get(username)
+                if session is None:
+                    session = self.sessions[username] = _Session(self.mailbox_size)
+                session.messages.append(message)
+            return conn
+
+    def get(self, username):
+        return self.clients.get(username)
+
+    def __contains__(self, username):
+        return username in self.clients
+
+    def connections(self):
+        """在线用户的 (用户名, 连接) 快照"""
+        return list(self.clients.items())
+
+    # ---- 聊天组 ----
+
+    def group_exists(self, group_id):
+        return group_id in self.groups
+
+    def _snapshot(self, group_id):
+        group = self.groups.get(group_id)
+        if group is None:
+            return (), (), ()
+        snapshot = group.snapshot
+        if snapshot is None:
+            with self._lock(group_id):
+                snapshot = group.snapshot
+                if snapshot is None:
+                    members = tuple(group.members)
+                    conns = []
+                    absent = []
+                    for username in members:
+                        conn = self.clients.get(username)
+                        if conn is None:
+                            absent.append(username)
+                        else:
+                            conns.append(conn)
+                    snapshot = group.snapshot = (members, tuple(conns), tuple(absent))
+        return snapshot
+
+    def members(self, group_id):
+        """组成员的不可变快照；组不存在时为空元组"""
+        return self._snapshot(group_id)[0]
+
+    def fanout(self, group_id):
+        """广播用的快照：(本进程在线成员的连接元组, 其余成员的用户名元组)"""
+        _, conns, absent = self._snapshot(group_id)
+        return conns, absent
+
+    def group_size(self, group_id):
+        group = self.groups.get(group_id)
+        return len(group.members) if group is not None else 0
+
+    def is_member(self, group_id, username):
+        group = self.groups.get(group_id)
+        return group is not None and username in group.members
+
+    def add_members(self, group_id, usernames):
+        """把用户加入组（组不存在时创建）"""
+        with self._lock(group_id):
+            group = self.groups.get(group_id)
+            if group is None:
+                group = self.groups[group_id] = _Group()
+            group.members.update(usernames)
+            group.snapshot = None
+        for username in usernames:
+            with self._lock(username):
+                self.user_groups.setdefault(username, set()).add(group_id)
+
+    def remove_member(self, group_id, username):
+        """把用户移出组，组空时删除。返回 (是否确实移除了该用户, 组是否仍存在)"""
+        with self._lock(group_id):
+            group = self.groups.get(group_id)
+            if group is None or username not in group.members:
+                return False, group is not None
+            group.members.discard(username)
+            group.snapshot = None
+            remaining = bool(group.members)
+            if not remaining:
+                del self.groups[group_id]
+        with self._lock(username):
+            groups = self.user_groups.get(username)
+            if groups is not None:
+                groups.discard(group_id)
+        return True, remaining
+
+    def groups_of(self, username):
+        """用户所在组ID的快照"""
+        with self._lock(username):
+            return tuple(self.user_groups.get(username, ()))
@@ -0,0 +1,147 @@
+"""分块文件传输
+
+文件内容不放进 JSON 消息，而是作为独立的数据块帧与普通消息复用同一个连接：
+
+    [u32 帧长度][0xFF][u32 流ID][u64 偏移][数据]
+
+首字节 0xFF 既不是 JSON 的 '{' 也不是二进制编码的类型码，收到帧时看首字节即可区分。
+流ID 由服务器在 file_offer_response（上传）或 file_get_response（下载）中分配，
+只在这个连接上有效。数据块按偏移顺序发送，每块最多 CHUNK_SIZE 字节。
+
+流量控制按窗口进行：发送方最多有 WINDOW_CHUNKS 块未被确认，接收方每收到半个窗口
+回复一次 file_ack {'stream', 'received'}。在途数据有上限，大文件不会在套接字缓冲区和
+发送队列里堆积，同一连接上的聊天消息最多排在一个窗口的数据之后。
+"""
+import json
+import os
+import re
+import secrets
+import struct
+
+CHUNK_MARK = 0xFF
+CHUNK_HEADER = struct.Struct('!BIQ')  # 标记, 流ID, 偏移
+FRAME_LENGTH = struct.Struct('!I')
+
+# 每个数据块的最大字节数
+CHUNK_SIZE = 64 * 1024
+
+# 发送方最多未被确认的数据块数
+WINDOW_CHUNKS = 8
+
+# 允许上传的最大文件
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+
+FILE_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+
+
+def is_chunk(payload):
+    return payload[:1] == b'\xff'
+
+
+def chunk_header(stream, offset, length):
+    """数据块帧的帧长度前缀和块头（数据本身由调用方另外发送，不与头部拼接）"""
+    return FRAME_LENGTH.pack(CHUNK_HEADER.size + length) + CHUNK_HEADER.pack(CHUNK_MARK, stream, offset)
+
+
+def parse_chunk(payload):
+    """解析数据块帧的负载，返回 (流ID, 偏移, 数据的 memoryview)；格式错误时抛出 ValueError"""
+    try:
+        _, stream, offset = CHUNK_HEADER.unpack_from(payload, 0)
+    except struct.error as e:
+        raise ValueError(f"无效的数据块: {e}") from None
+    return stream, offset, memoryview(payload)[CHUNK_HEADER.size:]
+
+
+class Upload:
+    """正在接收的一个文件：按顺序写入 <file_id>.part，收完后改名为 <file_id>.data"""
+    __slots__ = ('store', 'file_id', 'meta', 'file', 'received', 'acked')
+
+    def __init__(self, store, file_id, meta):
+        self.store = store
+        self.file_id = file_id
+        self.meta = meta
+        self.file = open(store.path(file_id, '.part'), 'wb')
+        self.received = 0
+        self.acked = 0  # 最近一次 file_ack 确认到的字节数
+
+    @property
+    def size(self):
+        return self.meta['size']
+
+    def write(self, offset, data):
+        """写入一个数据块（memoryview，直接写入文件不再拷贝），返回是否已收完"""
+        if offset != self.received or self.received + len(data) > self.size:
+            raise ValueError(f"数据块偏移 {offset} 与已收到的 {self.received} 字节不符")
+        self.file.write(data)
+        self.received += len(data)
+        if self.received < self.size:
+            return False
+        self.file.close()
+        self.store.commit(self.file_id, self.meta)
+        return True
+
+    def abort(self):
+        """连接断开时丢弃没收完的文件"""
+        self.file.close()
+        try:
+            os.unlink(self.store.path(self.file_id, '.part'))
+        except OSError:
+            pass
+
+
+class Download:
+    """正在发送的一个文件（服务器端），FileRegion 共享同一个文件对象
+
+    接收方确认收完或连接关闭时由服务器调用 close()，不依赖垃圾回收释放文件描述符。
+    """
+    __slots__ = ('file', 'size', 'sent', 'acked')
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.sent = 0  # 已放入发送队列的字节数
+        self.acked = 0  # 接收方确认收到的字节数
+
+    @property
+    def done(self):
+        return self.acked >= self.size
+
+    def close(self):
+        self.file.close()
+
+
+class FileStore:
+    """已上传文件的存储：<file_id>.data 为内容，<file_id>.json 为元数据
+
+    文件ID 是随机的 16 位十六进制串，各分片使用同一个目录时也不会冲突，任一分片都能提供下载。
+    """
+
+    def __init__(self, directory, max_size=MAX_FILE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, file_id, suffix):
+        return os.path.join(self.directory, file_id + suffix)
+
+    def create(self, name, size, group_id, owner):
+        """开始接收一个文件"""
+        file_id = secrets.token_hex(8)
+        meta = {'file_id': file_id, 'name': name, 'size': size, 'group_id': group_id, 'from_user': owner}
+        return Upload(self, file_id, meta)
+
+    def commit(self, file_id, meta):
+        with open(self.path(file_id, '.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(self.path(file_id, '.part'), self.path(file_id, '.data'))
+
+    def open(self, file_id):
+        """返回 (元数据, 以二进制只读方式打开的文件)，文件不存在时返回 None"""
+        if not isinstance(file_id, str) or not FILE_ID_PATTERN.match(file_id):
+            return None
+        try:
+            with open(self.path(file_id, '.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            return meta, open(self.path(file_id, '.data'), 'rb')
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,70 @@
+"""空闲连接超时检测用的时间轮
+
+时间被划分为长度为 tick 的槽，每个连接挂在它预计到期的槽里。收到数据时只更新
+连接的 last_seen（一次属性赋值），不移动连接；时间轮每前进一格只检查当前槽中的
+连接：真正超时的返回给调用方，期间有过活动的按新的到期时间重新挂到后面的槽。
+因此无论有多少连接，每条消息的开销都是 O(1)，每格只处理到期的那一小部分连接。
+
+被管理的对象需要有可写的 last_seen 和 wheel_slot 属性。
+"""
+import math
+import threading
+
+
+class TimingWheel:
+    """按 last_seen + timeout 到期的时间轮"""
+
+    def __init__(self, timeout, tick, now):
+        self.timeout = timeout
+        self.tick = tick
+        self.slots = [set() for _ in range(int(math.ceil(timeout / tick)) + 1)]
+        self.current = 0
+        self.last_tick = now
+        self.lock = threading.Lock()  # 线程模式下加入、移除和推进来自不同线程
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def add(self, item, now):
+        """开始跟踪一个对象，last_seen 记为 now"""
+        item.last_seen = now
+        with self.lock:
+            self._place(item, now + self.timeout)
+
+    def remove(self, item):
+        """停止跟踪一个对象"""
+        with self.lock:
+            slot = item.wheel_slot
+            if slot is not None:
+                self.slots[slot].discard(item)
+                item.wheel_slot = None
+
+    def _place(self, item, deadline):
+        ticks = int(math.ceil((deadline - self.last_tick) / self.tick))
+        ticks = max(1, min(ticks, len(self.slots) - 1))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot].add(item)
+        item.wheel_slot = slot
+
+    def advance(self, now):
+        """推进到 now，返回已超时的对象列表（它们已不再被跟踪）"""
+        expired = []
+        with self.lock:
+            elapsed = int((now - self.last_tick) // self.tick)
+            if elapsed <= 0:
+                return expired
+            # 长时间没有推进时，每个槽最多检查一次
+            steps = min(elapsed, len(self.slots))
+            self.last_tick += elapsed * self.tick
+            for step in range(steps):
+                self.current = (self.current + 1) % len(self.slots)
+                bucket = self.slots[self.current]
+                self.slots[self.current] = set()
+                for item in bucket:
+                    deadline = item.last_seen + self.timeout
+                    if deadline <= now:
+                        item.wheel_slot = None
+                        expired.append(item)
+                    else:
+                        self._place(item, deadline)
+        return expired